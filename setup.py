@@ -36,7 +36,7 @@ def main():
                              'pytest-runner',
                              'codecov',
                              'pytest-benchmark'],
-            install_requires = ['doit',
+            install_requires = ['doit>=0.34.0',
                                 'ficus',
                                 'matplotlib',
                                 'numpy',
@@ -46,6 +46,7 @@ def main():
                                 'seaborn',
                                 'filelock',
                                 'ope'],
+            extras_require = {'cache': ['pyarrow']},
             zip_safe = False,
             include_package_data = True )
             
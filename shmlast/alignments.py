@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+'''Parsers for lastal output and for the alignment cache.
+
+These are kept apart from the tasks in last.py, which only build commands,
+so that defining a pipeline doesn't import pandas, ope or pyarrow; the
+actions that read alignments import this module when they run.
+'''
+
+import numpy as np
+import pandas as pd
+
+from ope.io.base import ChunkParser, EmptyFile, convert_dtypes
+from ope.io.maf import MafParser
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+from .last import require_pyarrow
+
+
+class LastTabParser(ChunkParser):
+
+    columns = MafParser.columns
+
+    # (name, dtype) of each column of lastal -f TAB output, in order; the
+    # EG2 and E columns come as key=value strings
+    tab_columns = [('score', np.float64),
+                   ('s_name', str),
+                   ('s_start', np.int64),
+                   ('s_aln_len', np.int64),
+                   ('s_strand', str),
+                   ('s_len', np.int64),
+                   ('q_name', str),
+                   ('q_start', np.int64),
+                   ('q_aln_len', np.int64),
+                   ('q_strand', str),
+                   ('q_len', np.int64),
+                   ('blocks', str),
+                   ('EG2', str),
+                   ('E', str)]
+
+    # same order as the columns produced by MafParser
+    output_columns = ['score', 'EG2', 'E', 's_name', 's_start', 's_aln_len',
+                      's_strand', 's_len', 'q_name', 'q_start', 'q_aln_len',
+                      'q_strand', 'q_len', 'bitscore']
+
+    def __init__(self, filename, chunksize=10000, **kwargs):
+        '''Parser for lastal tabular (-f TAB) output, producing the same
+        DataFrames as MafParser.
+
+        Only the needed columns are read, with the pandas C parser and
+        explicit dtypes; the alignment blocks column is skipped.
+
+        Args:
+            filename (str): Path to the tabular alignment file.
+            chunksize (int): Alignments to parse per iteration.
+        '''
+        self.LAMBDA = None
+        self.K = None
+        super(LastTabParser, self).__init__(filename, chunksize=chunksize, **kwargs)
+
+    def _read_header(self):
+        with open(self.filename) as fp:
+            for line in fp:
+                if not line.startswith('#'):
+                    break
+                if 'lambda' in line:
+                    meta = line.strip(' #\n').split()
+                    meta = {k:v for k, _, v in map(lambda x: x.partition('='), meta)}
+                    self.LAMBDA = float(meta['lambda'])
+                    self.K = float(meta['K'])
+
+    def __iter__(self):
+        '''Iterator yielding DataFrames of length chunksize holding the
+        alignments, with bitscores computed as in MafParser.
+        '''
+
+        self._read_header()
+        names = [name for name, _ in self.tab_columns]
+        usecols = [name for name in names if name != 'blocks']
+        reader = pd.read_csv(self.filename, sep='\t', comment='#', header=None,
+                             names=names, usecols=usecols,
+                             dtype=dict(self.tab_columns), engine='c',
+                             chunksize=self.chunksize)
+
+        n_entries = 0
+        for df in reader:
+            if not len(df):
+                continue
+            if self.LAMBDA is None:
+                raise RuntimeError("old version of lastal; please update")
+            n_entries += len(df)
+            yield self._build_df(df)
+
+        if n_entries == 0:
+            self.raise_empty()
+
+    def _build_df(self, df):
+        df['EG2'] = df['EG2'].str.slice(4).astype(np.float64)
+        df['E'] = df['E'].str.slice(2).astype(np.float64)
+        df['s_name'] = df['s_name'].str.partition(',')[0]
+        df['bitscore'] = (self.LAMBDA * df['score'] - np.log(self.K)) / np.log(2)
+        df = df.reindex(columns=self.output_columns)
+        setattr(df, 'LAMBDA', self.LAMBDA)
+        setattr(df, 'K', self.K)
+        return df
+
+
+# Types used for the alignment cache. Lengths and coordinates fit in 32 bits
+# and scores are integral; E-values can underflow float32, and bitscores are
+# kept at full precision so that results match the uncached path.
+ALIGNMENT_CACHE_COLUMNS = [('score', np.float32),
+                           ('EG2', np.float64),
+                           ('E', np.float64),
+                           ('s_name', 'category'),
+                           ('s_start', np.int32),
+                           ('s_aln_len', np.int32),
+                           ('s_strand', 'category'),
+                           ('s_len', np.int32),
+                           ('q_name', 'category'),
+                           ('q_start', np.int32),
+                           ('q_aln_len', np.int32),
+                           ('q_strand', 'category'),
+                           ('q_len', np.int32),
+                           ('bitscore', np.float64)]
+
+
+def alignment_cache_schema():
+    require_pyarrow()
+    fields = []
+    for name, dtype in ALIGNMENT_CACHE_COLUMNS:
+        if dtype == 'category':
+            fields.append(pa.field(name, pa.dictionary(pa.int32(), pa.string())))
+        else:
+            fields.append(pa.field(name, pa.from_numpy_dtype(dtype)))
+    return pa.schema(fields)
+
+
+def cache_alignments(aln_fn, cache_fn, chunksize=100000):
+    '''Convert a lastal output file into a typed Parquet alignment cache.
+
+    The alignments are parsed and written in chunks, one row group per
+    chunk, so the conversion doesn't hold the whole file in memory.
+
+    Args:
+        aln_fn (str): The MAF or tabular alignment file.
+        cache_fn (str): Destination Parquet file.
+        chunksize (int): Alignments per row group.
+    '''
+
+    schema = alignment_cache_schema()
+    dtypes = dict(ALIGNMENT_CACHE_COLUMNS)
+    columns = [name for name, _ in ALIGNMENT_CACHE_COLUMNS]
+    parser = alignment_parser(aln_fn, chunksize=chunksize)
+
+    with pq.ParquetWriter(cache_fn, schema) as writer:
+        n_alignments = 0
+        try:
+            for aln_df in parser:
+                n_alignments += len(aln_df)
+                aln_df = aln_df[columns].astype(dtypes)
+                writer.write_table(pa.Table.from_pandas(aln_df, schema=schema,
+                                                        preserve_index=False))
+        except EmptyFile:
+            pass
+        if n_alignments == 0:
+            writer.write_table(schema.empty_table())
+
+
+class ParquetAlignmentParser(ChunkParser):
+
+    columns = ALIGNMENT_CACHE_COLUMNS
+
+    def __init__(self, filename, chunksize=None, **kwargs):
+        '''Parser for alignment caches written by cache_alignments.
+
+        Yields one DataFrame per row group; name and strand columns come
+        back as categoricals.
+
+        Args:
+            filename (str): Path to the Parquet alignment cache.
+            chunksize (int): Ignored; the chunks are the row groups.
+        '''
+        require_pyarrow()
+        super(ParquetAlignmentParser, self).__init__(filename, chunksize=chunksize)
+
+    def __iter__(self):
+        cache = pq.ParquetFile(self.filename)
+        n_entries = 0
+        for i in range(cache.num_row_groups):
+            aln_df = cache.read_row_group(i).to_pandas()
+            if not len(aln_df):
+                continue
+            n_entries += len(aln_df)
+            yield aln_df
+
+        if n_entries == 0:
+            self.raise_empty()
+
+
+def empty_alignments():
+    '''Get an empty DataFrame with the columns of parsed MAF alignments,
+    for when there are no alignment files to parse at all.
+    '''
+
+    df = pd.DataFrame(columns=[name for name, _ in MafParser.columns])
+    convert_dtypes(df, dict(MafParser.columns))
+    return df
+
+
+def alignment_parser(filename, fmt=None, **kwargs):
+    '''Get a parser for a lastal output file.
+
+    Args:
+        filename (str): The alignment file.
+        fmt (str): One of ALIGNMENT_FORMATS, or 'parquet' for an alignment
+            cache. If None, it is inferred from the file extension: .parquet
+            files are caches, .tab files are tabular, anything else is MAF.
+        kwargs: Passed to the parser.
+    Returns:
+        MafParser or LastTabParser: The parser.
+    '''
+
+    if fmt is None:
+        if filename.endswith('.parquet'):
+            fmt = 'parquet'
+        elif filename.endswith('.tab'):
+            fmt = 'tab'
+        else:
+            fmt = 'maf'
+    if fmt == 'parquet':
+        return ParquetAlignmentParser(filename, **kwargs)
+    elif fmt == 'tab':
+        return LastTabParser(filename, **kwargs)
+    elif fmt == 'maf':
+        return MafParser(filename, **kwargs)
+    raise ValueError('Unknown alignment format: {0}'.format(fmt))
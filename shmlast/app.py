@@ -1,18 +1,23 @@
 from os import path, getcwd, mkdir
+import sys
 
 from doit.tools import run_once, create_folder
 from doit.task import clean_targets, dict_to_task
 from doit.cmd_base import TaskLoader
 from doit.doit_cmd import DoitMain
-from ope.io.maf import MafParser
-import pandas as pd
-
-from .crbl import (get_reciprocal_best_last_translated, backmap_names,
-                   scale_evalues, fit_crbh_model, filter_hits_from_model,
-                   plot_crbh_fit)
-from .last import lastdb_task, lastal_task
-from .profile import StartProfiler, profile_task
-from .translate import translate_task, rename_task
+
+from .dbcache import cached_lastdb_task, default_cache_dir
+from .incremental import (plan_segments, read_manifest, segment_evalue_scales,
+                          count_fn, merge_segment_best_hits,
+                          database_manifest_task, split_segment_task,
+                          segment_best_hits_task)
+from .last import LastConfig, lastdb_task, lastal_task, alignment_cache_task
+from .names import NameMap
+from .profile import StartProfiler, profile_task, span
+from .progress import StartProgress, ProgressConsoleReporter
+from .shard import (LocalSubmitter, split_fasta_task, sharded_lastal_tasks,
+                    lastal_shard_task)
+from .translate import rename_task, rename_translate_task
 from .util import ShortenedPythonAction, title, hidden_fn
 from .util import create_doit_task as doit_task
 
@@ -29,7 +34,9 @@ class ShmlastApp(TaskLoader):
             mkdir(self.directory)
         except OSError:
             pass
-        self.doit_config = {'verbosity': 2}
+        # the reporter watches lastal's output when progress is reported
+        self.doit_config = {'verbosity': 2,
+                            'reporter': ProgressConsoleReporter}
         if config is not None:
             self.doit_config.update(config)
 
@@ -39,23 +46,50 @@ class ShmlastApp(TaskLoader):
     def load_tasks(self, cmd, opt_values, pos_args):
         return list(self.tasks()), self.doit_config
 
-    def run(self, doit_args=None, move=False, profile_fn=None):
+    def run(self, doit_args=None, move=False, profile_fn=None, trace_fn=None,
+            profile_mode='time', progress_interval=None, status_fn=None):
+        '''Run the pipeline with pydoit.
+
+        Args:
+            doit_args (list): pydoit command line; by default, ['run'].
+            profile_fn (str): Where to write the profile results, or False
+                not to profile; see profile.StartProfiler.
+            trace_fn (str): Where to also write the profile as a Chrome
+                trace.
+            profile_mode (str): One of profile.PROFILE_MODES.
+            progress_interval (float): If given, report the progress of the
+                long-running steps to stderr every this many seconds.
+            status_fn (str): If given, write their progress to this JSON
+                file, every progress_interval or by default
+                progress.PROGRESS_INTERVAL seconds.
+        Returns:
+            int: pydoit's exit status.
+        '''
+
         if doit_args is None:
             doit_args = ['run']
         runner = DoitMain(self)
 
         print('\n--- Begin Task Execution ---')
-        if profile_fn is not False and doit_args[0] == 'run':
-            with StartProfiler(filename=profile_fn):
-                return runner.run(doit_args)
-        else:
+        if doit_args[0] != 'run':
             return runner.run(doit_args)
+        stream = sys.stderr if progress_interval is not None else None
+        with StartProgress(interval=progress_interval, status_fn=status_fn,
+                           stream=stream):
+            if profile_fn is False:
+                return runner.run(doit_args)
+            with StartProfiler(filename=profile_fn, trace_fn=trace_fn,
+                               mode=profile_mode):
+                return runner.run(doit_args)
 
 
 class RBL(ShmlastApp):
 
     def __init__(self, query_fn, database_fn, output_fn=None,
-                 cutoff=.00001, n_threads=1, directory=None):
+                 cutoff=.00001, n_threads=1, directory=None,
+                 min_orf_len=None, aln_format='maf', cache_alignments=False,
+                 incremental=False, n_shards=1, submitter=None, n_jobs=None,
+                 lastdb_cache=None, last_config=None):
         '''Generate and manage the pydoit tasks for the RBL pipeline.
 
         Args:
@@ -65,25 +99,71 @@ class RBL(ShmlastApp):
             cutoff (float): The score cutoff.
             n_threads (int): Number of threads to run on.
             directory (str): The directory to run tasks in.
+            min_orf_len (int): If given, drop translated frames whose longest
+                ORF is shorter than this before aligning.
+            aln_format (str): lastal output format: 'maf', or 'tab' for the
+                smaller tabular format.
+            cache_alignments (bool): Convert the alignments to a Parquet
+                cache once, and read them from there (requires pyarrow).
+            incremental (bool): Align the database in segments, so that when
+                records are appended to it only the new ones are aligned;
+                see incremental.py.
+            n_shards (int): Split the queries of each lastal run into this
+                many shards, each aligned by its own task; see shard.py.
+            submitter (shard.Submitter): Runs the shard alignments, or each
+                whole lastal run as one job if n_shards is 1. By default,
+                they are run locally, sharing n_threads.
+            n_jobs (int): Most tasks to run at once, such as the two
+                directions of alignment. The tasks that can run at the same
+                time share n_threads. By default, n_shards.
+            lastdb_cache (str): Directory of lastdb indexes shared between
+                runs, where the database index is linked from, or built and
+                saved; see dbcache.py. By default, $SHMLAST_LASTDB_CACHE if
+                it's set.
+            last_config (last.LastConfig): The lastdb and lastal options.
+                By default, the default preset.
         '''
 
         self.query_fn = query_fn
         self.renamed_query_fn = hidden_fn(path.basename(self.query_fn))
-        self.query_name_map_fn = self.renamed_query_fn + '.names.csv'
+        self.query_name_map_fn = self.renamed_query_fn + '.names'
         self.translated_query_fn = self.renamed_query_fn + '.pep'
 
         self.database_fn = database_fn
         self.renamed_database_fn = hidden_fn(path.basename(self.database_fn))
-        self.database_name_map_fn = self.renamed_database_fn + '.names.csv'
+        self.database_name_map_fn = self.renamed_database_fn + '.names'
 
         self.n_threads = n_threads
         self.cutoff = cutoff
-
-        self.db_x_query_fn = '{0}.x.{1}.maf'.format(self.renamed_database_fn,
-                                                    self.translated_query_fn.strip('.'))
-
-        self.query_x_db_fn = '{0}.x.{1}.maf'.format(self.translated_query_fn,
-                                                    self.renamed_database_fn.strip('.'))
+        self.min_orf_len = min_orf_len
+        self.aln_format = aln_format
+
+        self.db_x_query_fn = '{0}.x.{1}.{2}'.format(self.renamed_database_fn,
+                                                    self.translated_query_fn.strip('.'),
+                                                    aln_format)
+
+        self.query_x_db_fn = '{0}.x.{1}.{2}'.format(self.translated_query_fn,
+                                                    self.renamed_database_fn.strip('.'),
+                                                    aln_format)
+
+        # the files the reciprocal steps read the alignments from
+        self.cache_alignments = cache_alignments
+        if cache_alignments:
+            self.db_x_query_hits_fn = self.db_x_query_fn + '.parquet'
+            self.query_x_db_hits_fn = self.query_x_db_fn + '.parquet'
+        else:
+            self.db_x_query_hits_fn = self.db_x_query_fn
+            self.query_x_db_hits_fn = self.query_x_db_fn
+
+        self.incremental = incremental
+        if incremental:
+            # planned when the tasks are built; see load_tasks
+            self.manifest_fn = self.renamed_database_fn + '.manifest.json'
+            self.segments = None
+        else:
+            self.query_x_db_hits_fns = [self.query_x_db_hits_fn]
+            self.db_x_query_hits_fns = [self.db_x_query_hits_fn]
+            self.query_x_db_evalue_scales = None
         
         self.output_fn = output_fn
         if self.output_fn is None:
@@ -91,30 +171,145 @@ class RBL(ShmlastApp):
                                                         d=path.basename(self.database_fn))
         self.unmapped_output_fn = hidden_fn(self.output_fn)
         
+        if last_config is None:
+            last_config = LastConfig()
+        self.last_config = last_config
+
+        if lastdb_cache is None:
+            lastdb_cache = default_cache_dir()
+        self.lastdb_cache = lastdb_cache
+
+        self.n_shards = n_shards
+        if n_jobs is None:
+            n_jobs = n_shards
+        self.n_jobs = n_jobs
+        if n_shards > 1 and submitter is None:
+            submitter = LocalSubmitter(max_workers=min(n_jobs, n_threads))
+        self.submitter = submitter
+
         dep_file = '.{0}.shmlast.doit'.format(path.basename(self.query_fn))
-        super(RBL, self).__init__(directory=directory, 
-                                  config={'dep_file': dep_file})
+        config = {'dep_file': dep_file}
+        if n_jobs > 1:
+            # the tasks only wait on lastal or numpy, so threads will do
+            config.update(num_process=n_jobs, par_type='thread')
+        super(RBL, self).__init__(directory=directory, config=config)
+
+    def load_tasks(self, cmd, opt_values, pos_args):
+        # only a run needs the database read to find any new records; the
+        # other commands, such as clean and list, act on the segments of
+        # the last run
+        if self.incremental:
+            self.plan_database_segments(scan=cmd.name == 'run')
+        return super(RBL, self).load_tasks(cmd, opt_values, pos_args)
+
+    def plan_database_segments(self, scan=True):
+        '''Split the database into segments for incremental alignment, and
+        name the files for each one.
+
+        Args:
+            scan (bool): Read the database to add a segment for any new
+                records. If False, the segments are those of the last run,
+                from the manifest, without reading the database.
+        '''
+
+        if scan:
+            self.segments = plan_segments(self.database_fn, self.manifest_fn)
+        else:
+            self.segments = read_manifest(self.manifest_fn)
+        self.query_x_db_evalue_scales = segment_evalue_scales(self.segments)
+
+        translated_query = self.translated_query_fn.strip('.')
+        for segment in self.segments:
+            segment_fn = '{0}.{1}-{2}.{3}'.format(self.renamed_database_fn,
+                                                  segment['start'],
+                                                  segment['stop'],
+                                                  segment['digest'][:8])
+            query_x_seg_fn = '{0}.x.{1}.{2}'.format(self.translated_query_fn,
+                                                    segment_fn.strip('.'),
+                                                    self.aln_format)
+            seg_x_query_fn = '{0}.x.{1}.{2}'.format(segment_fn, translated_query,
+                                                    self.aln_format)
+            segment.update(fn=segment_fn,
+                           query_x_seg_fn=query_x_seg_fn,
+                           seg_x_query_fn=seg_x_query_fn)
+            for aln in ('query_x_seg', 'seg_x_query'):
+                hits_fn = segment[aln + '_fn']
+                if self.cache_alignments:
+                    hits_fn += '.parquet'
+                segment[aln + '_hits_fn'] = hits_fn
+                segment[aln + '_best_fn'] = hits_fn + '.best.csv'
+
+        self.query_x_db_hits_fns = [seg['query_x_seg_hits_fn'] for seg in self.segments]
+        self.db_x_query_hits_fns = [seg['seg_x_query_hits_fn'] for seg in self.segments]
+
+    def task_threads(self, n_tasks):
+        '''Get the threads for each of n_tasks tasks which can run at the
+        same time, sharing n_threads.
+        '''
+        return max(1, self.n_threads // min(n_tasks, self.n_jobs))
+
+    def translate_threads(self):
+        # the database is renamed alongside the translation, on one thread
+        if self.n_jobs > 1:
+            return max(1, self.n_threads - 1)
+        return self.n_threads
+
+    def n_alignments(self):
+        '''The number of lastal runs which can run at the same time.
+        '''
+        return 2
+
+    def segment_best_fns(self, aln):
+        return [seg[aln + '_best_fn'] for seg in self.segments]
+
+    def translated_reciprocal_best_hits(self, hit_columns=None, max_hits=None):
+        '''Get the RBH's, and optionally the selected columns of all (or a
+        sample of) the query vs database hits, from whole alignment files or
+        from the database segments.
+        '''
+
+        from .crbl import (streaming_reciprocal_best_last_translated,
+                           reduce_query_hits, translated_best_hits)
+
+        if not self.incremental:
+            return streaming_reciprocal_best_last_translated(self.query_x_db_hits_fn,
+                                                             self.db_x_query_hits_fn,
+                                                             hit_columns=hit_columns,
+                                                             max_hits=max_hits)
+        if hit_columns is None:
+            qvd_best = merge_segment_best_hits(self.segment_best_fns('query_x_seg'),
+                                               self.query_x_db_evalue_scales)
+            hits_df = None
+        else:
+            qvd_best, hits_df = reduce_query_hits(self.query_x_db_hits_fns,
+                                                  hit_columns=hit_columns,
+                                                  max_hits=max_hits,
+                                                  evalue_scales=self.query_x_db_evalue_scales)
+        dvq_best = merge_segment_best_hits(self.segment_best_fns('seg_x_query'))
+        rbh_df = translated_best_hits().reciprocal_best_hits(qvd_best, dvq_best)
+        return rbh_df, hits_df
 
     @doit_task
     @profile_task
     def reciprocal_best_last_task(self):
        
         def do_reciprocals():
-            rbh_df, qvd_df, dvq_df = get_reciprocal_best_last_translated(self.query_x_db_fn,
-                                                                         self.db_x_query_fn)
-            q_names = pd.read_csv(self.query_name_map_fn)
-            d_names = pd.read_csv(self.database_name_map_fn)
+            from .crbl import backmap_names_indexed
 
-            rbh_df.to_csv(self.unmapped_output_fn, index=False)
-            rbh_df = backmap_names(rbh_df, q_names, d_names)
-            rbh_df.to_csv(self.output_fn, index=False)
+            rbh_df, _ = self.translated_reciprocal_best_hits()
+            with span('write_csv'):
+                rbh_df.to_csv(self.unmapped_output_fn, index=False)
+            with NameMap(self.query_name_map_fn) as q_names, \
+                 NameMap(self.database_name_map_fn) as d_names:
+                rbh_df = backmap_names_indexed(rbh_df, q_names, d_names)
+            with span('write_csv'):
+                rbh_df.to_csv(self.output_fn, index=False)
 
         td = {'name': 'reciprocal_best_last',
               'title': title,
               'actions': [ShortenedPythonAction(do_reciprocals)],
-              'file_dep': [self.query_x_db_fn,
-                           self.db_x_query_fn,
-                           self.query_name_map_fn,
+              'file_dep': self.reciprocal_file_dep() + \
+                          [self.query_name_map_fn,
                            self.database_name_map_fn],
               'targets': [self.unmapped_output_fn,
                           self.output_fn],
@@ -122,10 +317,18 @@ class RBL(ShmlastApp):
         
         return td
 
-    def rename_transcriptome_task(self):
-        return rename_task(self.query_fn,
-                           self.renamed_query_fn,
-                           name_map_fn=self.query_name_map_fn)
+    def reciprocal_file_dep(self, query_best=True):
+        '''The files the reciprocal best hits are found from.
+        '''
+        if not self.incremental:
+            fns = [self.db_x_query_hits_fn]
+            if query_best:
+                fns.append(self.query_x_db_hits_fn)
+            return fns
+        fns = self.segment_best_fns('seg_x_query')
+        if query_best:
+            fns += self.segment_best_fns('query_x_seg')
+        return fns + [count_fn(fn) for fn in fns]
 
     def rename_database_task(self):
         return rename_task(self.database_fn,
@@ -133,52 +336,212 @@ class RBL(ShmlastApp):
                            prefix='db',
                            name_map_fn=self.database_name_map_fn)
 
+    def rename_translate_transcriptome_task(self):
+        return rename_translate_task(self.query_fn,
+                                     self.renamed_query_fn,
+                                     self.translated_query_fn,
+                                     name_map_fn=self.query_name_map_fn,
+                                     n_threads=self.translate_threads(),
+                                     min_orf_len=self.min_orf_len)
+
+    def rename_transcriptome_task(self):
+        '''The transcriptome is renamed as it is translated; this is the same
+        task as rename_translate_transcriptome_task.
+        '''
+        return self.rename_translate_transcriptome_task()
+
     def translate_task(self):
-        return translate_task(self.renamed_query_fn,
-                              self.translated_query_fn)
+        '''The transcriptome is translated as it is renamed; this is the same
+        task as rename_translate_transcriptome_task.
+        '''
+        return self.rename_translate_transcriptome_task()
 
+    # lastdb tasks have no file_dep, so they name the task making their
+    # input, which orders them when tasks run in parallel
     def format_transcriptome_task(self):
         return lastdb_task(self.translated_query_fn,
-                           prot=True)
+                           prot=True,
+                           params=self.last_config.lastdb_params(),
+                           task_dep=[self.rename_translate_transcriptome_task().name])
 
     def format_database_task(self):
-        return lastdb_task(self.renamed_database_fn,
-                           prot=True)
+        return self.database_lastdb_task(self.renamed_database_fn,
+                                         task_dep=[self.rename_database_task().name])
+
+    def database_lastdb_task(self, db_fn, task_dep=None):
+        '''Format the database, or a segment of it, through the index cache
+        if there is one. The transcriptome differs on every run, so it
+        isn't cached.
+        '''
+        if self.lastdb_cache is not None:
+            return cached_lastdb_task(db_fn, self.lastdb_cache, prot=True,
+                                      params=self.last_config.lastdb_params(),
+                                      task_dep=task_dep)
+        return lastdb_task(db_fn, prot=True,
+                           params=self.last_config.lastdb_params(),
+                           task_dep=task_dep)
+
+    def split_query_tasks(self, fasta_fn):
+        '''The tasks to split a FASTA used as lastal queries into shards, if
+        sharding.
+        '''
+        if self.n_shards > 1:
+            return [split_fasta_task(fasta_fn, self.n_shards)]
+        return []
+
+    def lastal_kwds(self):
+        '''The options for lastal_task, other than the threads.
+        '''
+        return dict(translate=False,
+                    cutoff=self.cutoff,
+                    fmt=self.aln_format,
+                    params=self.last_config.lastal_params(),
+                    native_threads=self.last_config.native_threads,
+                    db_params=self.last_config.lastdb_params())
+
+    def lastal_tasks(self, query, db, out_fn):
+        '''The tasks to align query to db, sharded or not.
+        '''
+        lastal_kwds = self.lastal_kwds()
+        if self.n_shards > 1:
+            return sharded_lastal_tasks(query, db, out_fn, self.n_shards,
+                                        submitter=self.submitter,
+                                        n_threads=self.n_threads,
+                                        **lastal_kwds)
+        if self.submitter is not None:
+            # without shards, the whole query goes to the submitter as one job
+            return [lastal_shard_task(query, db, out_fn,
+                                      submitter=self.submitter,
+                                      n_threads=self.submitter.job_threads(self.n_threads, 1),
+                                      **lastal_kwds)]
+        return [lastal_task(query, db, out_fn,
+                            n_threads=self.task_threads(self.n_alignments()),
+                            **lastal_kwds)]
+
+    def align_transcriptome_tasks(self):
+        return self.lastal_tasks(self.translated_query_fn,
+                                 self.renamed_database_fn,
+                                 self.query_x_db_fn)
+
+    def align_database_tasks(self):
+        return self.lastal_tasks(self.renamed_database_fn,
+                                 self.translated_query_fn,
+                                 self.db_x_query_fn)
 
     def align_transcriptome_task(self):
-        return lastal_task(self.translated_query_fn,
-                           self.renamed_database_fn,
-                           self.query_x_db_fn,
-                           translate=False, 
-                           cutoff=self.cutoff,
-                           n_threads=self.n_threads)
+        '''The task which writes the query vs database alignments; when
+        sharded, this is the merge task, and align_transcriptome_tasks has
+        the rest.
+        '''
+        return list(self.align_transcriptome_tasks())[-1]
 
     def align_database_task(self):
-        return lastal_task(self.renamed_database_fn,
-                           self.translated_query_fn,
-                           self.db_x_query_fn,
-                           translate=False, 
-                           cutoff=self.cutoff,
-                           n_threads=self.n_threads)
+        '''The task which writes the database vs query alignments; when
+        sharded, this is the merge task, and align_database_tasks has the
+        rest.
+        '''
+        return list(self.align_database_tasks())[-1]
+
+    def cache_transcriptome_alignments_task(self):
+        return alignment_cache_task(self.query_x_db_fn,
+                                    self.query_x_db_hits_fn)
+
+    def cache_database_alignments_task(self):
+        return alignment_cache_task(self.db_x_query_fn,
+                                    self.db_x_query_hits_fn)
 
+    def incremental_tasks(self, query_best=True, database_alignments=True):
+        '''Iterator over the tasks to rename, format and align the database
+        in segments. Those for existing segments are up to date after the
+        database grows.
+
+        Args:
+            query_best (bool): Save the best hits of the query vs segment
+                alignments, for finding RBH's without re-reading them.
+            database_alignments (bool): Also align the segments to the query.
+        '''
+
+        if self.segments is None:
+            self.plan_database_segments()
+
+        yield self.rename_translate_transcriptome_task()
+        for tsk in self.split_query_tasks(self.translated_query_fn):
+            yield tsk
+        rename_tsk = self.rename_database_task()
+        yield rename_tsk
+        if database_alignments:
+            yield self.format_transcriptome_task()
+        yield database_manifest_task(self.manifest_fn, self.database_fn,
+                                     [{key: seg[key] for key in
+                                       ('start', 'stop', 'letters', 'digest')}
+                                      for seg in self.segments])
+
+        for seg in self.segments:
+            split_tsk = split_segment_task(self.renamed_database_fn, seg['fn'],
+                                           seg['start'], seg['stop'],
+                                           seg['digest'],
+                                           task_dep=[rename_tsk.name])
+            yield split_tsk
+            yield self.database_lastdb_task(seg['fn'], task_dep=[split_tsk.name])
+
+            alignments = [('query_x_seg', 'query_hits_frame', query_best)]
+            for tsk in self.lastal_tasks(self.translated_query_fn, seg['fn'],
+                                         seg['query_x_seg_fn']):
+                yield tsk
+            if database_alignments:
+                alignments.append(('seg_x_query', 'database_hits_frame', True))
+                for tsk in self.split_query_tasks(seg['fn']):
+                    yield tsk
+                for tsk in self.lastal_tasks(seg['fn'], self.translated_query_fn,
+                                             seg['seg_x_query_fn']):
+                    yield tsk
+
+            for aln, frame_func, best in alignments:
+                if self.cache_alignments:
+                    yield alignment_cache_task(seg[aln + '_fn'],
+                                               seg[aln + '_hits_fn'])
+                if best:
+                    yield segment_best_hits_task(seg[aln + '_hits_fn'],
+                                                 seg[aln + '_best_fn'],
+                                                 frame_func)
 
     def tasks(self):
         '''Iterator over all tasks in pipeline.
         '''
-        yield self.rename_transcriptome_task()
+        if self.incremental:
+            for tsk in self.incremental_tasks():
+                yield tsk
+            yield self.reciprocal_best_last_task()
+            return
+
+        yield self.rename_translate_transcriptome_task()
         yield self.rename_database_task()
-        yield self.translate_task()
         yield self.format_transcriptome_task()
         yield self.format_database_task()
-        yield self.align_database_task()
-        yield self.align_transcriptome_task()
+        for tsk in self.split_query_tasks(self.translated_query_fn) + \
+                   self.split_query_tasks(self.renamed_database_fn):
+            yield tsk
+        for tsk in self.align_database_tasks():
+            yield tsk
+        for tsk in self.align_transcriptome_tasks():
+            yield tsk
+        if self.cache_alignments:
+            yield self.cache_database_alignments_task()
+            yield self.cache_transcriptome_alignments_task()
         yield self.reciprocal_best_last_task()
 
 
 class CRBL(RBL):
 
+    # number of hits plotted against the model in low memory mode
+    plot_sample_size = 5000
+
     def __init__(self, query_fn, database_fn, output_fn=None,
-                 model_fn=None, cutoff=.00001, n_threads=1):
+                 model_fn=None, cutoff=.00001, n_threads=1,
+                 min_orf_len=None, aln_format='maf', cache_alignments=False,
+                 low_memory=False, saved_model_fn=None, skip_rbh=False,
+                 incremental=False, n_shards=1, submitter=None, n_jobs=None,
+                 lastdb_cache=None, last_config=None):
         '''Generate and manage the pydoit tasks for the CRBL pipeline.
 
         Args:
@@ -189,7 +552,41 @@ class CRBL(RBL):
             cutoff (float): The score cutoff.
             n_threads (int): Number of threads to run on.
             directory (str): The directory to run tasks in.
+            min_orf_len (int): If given, drop translated frames whose longest
+                ORF is shorter than this before aligning.
+            aln_format (str): lastal output format: 'maf', or 'tab' for the
+                smaller tabular format.
+            cache_alignments (bool): Convert the alignments to a Parquet
+                cache once, and read them from there (requires pyarrow).
+            low_memory (bool): Don't hold all the query vs database hits in
+                memory: filter them with the model a chunk at a time and
+                append those that pass to the output, and plot a sample.
+                Takes an extra pass over the alignments.
+            saved_model_fn (str): A model saved by an earlier run, as .csv
+                or .npz, to apply instead of fitting a new one.
+            skip_rbh (bool): With saved_model_fn, don't find the RBH's at
+                all: skip aligning the database to the query, and report
+                every hit which passes the model. No model plot is made.
+            incremental (bool): Align the database in segments, so that when
+                records are appended to it only the new ones are aligned;
+                see incremental.py.
+            n_shards (int): Split the queries of each lastal run into this
+                many shards, each aligned by its own task; see shard.py.
+            submitter (shard.Submitter): Runs the shard alignments, or each
+                whole lastal run as one job if n_shards is 1. By default,
+                they are run locally, sharing n_threads.
+            n_jobs (int): Most tasks to run at once, such as the two
+                directions of alignment. The tasks that can run at the same
+                time share n_threads. By default, n_shards.
+            lastdb_cache (str): Directory of lastdb indexes shared between
+                runs, where the database index is linked from, or built and
+                saved; see dbcache.py. By default, $SHMLAST_LASTDB_CACHE if
+                it's set.
+            last_config (last.LastConfig): The lastdb and lastal options.
+                By default, the default preset.
         '''
+        if skip_rbh and saved_model_fn is None:
+            raise ValueError('skip_rbh requires a saved model')
         prefix = '{q}.x.{d}.crbl'.format(q=path.basename(query_fn),
                                          d=path.basename(database_fn))
 
@@ -204,46 +601,148 @@ class CRBL(RBL):
             self.model_plot_fn = prefix + '.model.plot.pdf'
         else:
             self.model_plot_fn = self.model_fn + '.plot.pdf'
+        self.low_memory = low_memory
+        self.saved_model_fn = saved_model_fn
+        self.skip_rbh = skip_rbh
 
         super(CRBL, self).__init__(query_fn,
                                     database_fn,
                                     output_fn=None,
                                     cutoff=cutoff,
-                                    n_threads=n_threads)
+                                    n_threads=n_threads,
+                                    min_orf_len=min_orf_len,
+                                    aln_format=aln_format,
+                                    cache_alignments=cache_alignments,
+                                    incremental=incremental,
+                                    n_shards=n_shards,
+                                    submitter=submitter,
+                                    n_jobs=n_jobs,
+                                    lastdb_cache=lastdb_cache,
+                                    last_config=last_config)
+
+    def n_alignments(self):
+        # without the RBH's, the database isn't aligned to the query
+        return 1 if self.skip_rbh else 2
+
+    def get_model(self, rbh_df):
+        '''Load the saved model, or fit one to the RBH's and save it.
+        '''
+        from .crbl import fit_crbh_model, save_crbh_model, load_crbh_model
+
+        if self.saved_model_fn is not None:
+            return load_crbh_model(self.saved_model_fn)
+        model_df = fit_crbh_model(rbh_df)
+        save_crbh_model(model_df, self.model_fn)
+        return model_df
 
     @doit_task
     @profile_task
     def crbl_fit_and_filter_task(self):
+        # pandas, and matplotlib for the plot, are only imported when the
+        # actions run, so that building the tasks (for --version, clean,
+        # list and so on) stays fast
 
         def do_crbl_fit_and_filter():
-            rbh_df, hits_df, _ = get_reciprocal_best_last_translated(self.query_x_db_fn,
-                                                                     self.db_x_query_fn)
-            model_df = fit_crbh_model(rbh_df)
-            model_df.to_csv(self.model_fn, index=False)
-            #model_df = pd.read_csv(self.model_fn)
+            import pandas as pd
 
-            filtered_df = filter_hits_from_model(model_df, rbh_df, hits_df)
-            results = pd.concat([rbh_df, filtered_df], axis=0, sort=True)
-            results, scaled_col = scale_evalues(results, inplace=True)
-            del results['translated_q_name']
+            from .crbl import (backmap_names_indexed, scale_evalues,
+                               filter_hits_from_model, plot_crbh_fit)
 
-            q_names = pd.read_csv(self.query_name_map_fn)
-            d_names = pd.read_csv(self.database_name_map_fn)
-            
-            results = backmap_names(results, q_names, d_names)
-            results.to_csv(self.crbl_output_fn, index=False)
+            # whole rows are kept for all the hits, so those that pass the
+            # model are written without reading the alignments again; the
+            # low-memory mode keeps only a sample and re-reads them instead
+            rbh_df, hits_df = self.translated_reciprocal_best_hits(hit_columns=True)
+            model_df = self.get_model(rbh_df)
+
+            filtered_df = filter_hits_from_model(model_df, rbh_df, hits_df)
+            with span('concat'):
+                # scaled first, so the sorted concat puts E_scaled in its
+                # sorted place among the columns
+                rbh_df, _ = scale_evalues(rbh_df, inplace=True)
+                results = pd.concat([rbh_df, filtered_df], axis=0, sort=True)
+                del results['translated_q_name']
+
+            with NameMap(self.query_name_map_fn) as q_names, \
+                 NameMap(self.database_name_map_fn) as d_names:
+                results = backmap_names_indexed(results, q_names, d_names)
+            with span('write_csv'):
+                results.to_csv(self.crbl_output_fn, index=False)
 
             plot_crbh_fit(model_df, hits_df, self.model_plot_fn)
 
+        def do_crbl_fit_and_filter_low_memory():
+            from .crbl import (backmap_names_indexed, scale_evalues,
+                               iter_crbl_hits, plot_crbh_fit)
+
+            # keep the RBH's and a sample of the hits to plot, then filter
+            # the hits with the model in a second pass
+            rbh_df, sample_df = self.translated_reciprocal_best_hits(hit_columns=['E', 's_aln_len'],
+                                                                     max_hits=self.plot_sample_size)
+            model_df = self.get_model(rbh_df)
+
+            # the same columns as the concatenation in the default mode
+            rbh_df, _ = scale_evalues(rbh_df, inplace=True)
+            columns = sorted(rbh_df.columns)
+            with NameMap(self.query_name_map_fn) as q_names, \
+                 NameMap(self.database_name_map_fn) as d_names, \
+                 open(self.crbl_output_fn, 'w') as fp:
+
+                rbh_ids = rbh_df[['ID']]
+                backmap_names_indexed(rbh_df[columns], q_names,
+                                      d_names).to_csv(fp, index=False)
+                del rbh_df
+                for crbl_df in iter_crbl_hits(model_df, rbh_ids,
+                                              self.query_x_db_hits_fns,
+                                              evalue_scales=self.query_x_db_evalue_scales):
+                    if len(crbl_df):
+                        crbl_df = backmap_names_indexed(crbl_df[columns],
+                                                        q_names, d_names)
+                        crbl_df.to_csv(fp, index=False, header=False)
+
+            plot_crbh_fit(model_df, sample_df, self.model_plot_fn)
+
+        def do_crbl_apply_model():
+            import pandas as pd
+
+            from .crbl import backmap_names_indexed, iter_crbl_hits, load_crbh_model
+
+            # no RBH's to exclude: every hit is compared to the model
+            model_df = load_crbh_model(self.saved_model_fn)
+            no_rbh_df = pd.DataFrame({'ID': []})
+            with NameMap(self.query_name_map_fn) as q_names, \
+                 NameMap(self.database_name_map_fn) as d_names, \
+                 open(self.crbl_output_fn, 'w') as fp:
+
+                header = True
+                for crbl_df in iter_crbl_hits(model_df, no_rbh_df,
+                                              self.query_x_db_hits_fns,
+                                              evalue_scales=self.query_x_db_evalue_scales):
+                    columns = sorted(crbl_df.columns.drop('translated_q_name'))
+                    crbl_df = backmap_names_indexed(crbl_df[columns],
+                                                    q_names, d_names)
+                    crbl_df.to_csv(fp, index=False, header=header)
+                    header = False
+
+        file_dep = self.query_x_db_hits_fns + [self.query_name_map_fn,
+                                               self.database_name_map_fn]
+        targets = [self.crbl_output_fn]
+        if self.skip_rbh:
+            action = do_crbl_apply_model
+        else:
+            action = do_crbl_fit_and_filter_low_memory if self.low_memory \
+                     else do_crbl_fit_and_filter
+            file_dep.extend(self.reciprocal_file_dep(query_best=False))
+            targets.append(self.model_plot_fn)
+        if self.saved_model_fn is None:
+            targets.append(self.model_fn)
+        else:
+            file_dep.append(self.saved_model_fn)
+
         td = {'name': 'fit_and_filter_crbl_hits',
               'title': title,
-              'actions': [ShortenedPythonAction(do_crbl_fit_and_filter)],
-              'file_dep': [self.query_x_db_fn,
-                           self.query_name_map_fn,
-                           self.database_name_map_fn],
-              'targets': [self.crbl_output_fn, 
-                          self.model_plot_fn,
-                          self.model_fn],
+              'actions': [ShortenedPythonAction(action)],
+              'file_dep': file_dep,
+              'targets': targets,
               'clean': [clean_targets]}
         
         return td
@@ -251,8 +750,23 @@ class CRBL(RBL):
     def tasks(self):
         '''Iterator over all pipeline tasks.
         '''
-        for tsk in super(CRBL, self).tasks():
-            if tsk.name != 'reciprocal_best_last':
+        if self.incremental:
+            for tsk in self.incremental_tasks(query_best=False,
+                                              database_alignments=not self.skip_rbh):
                 yield tsk
+        elif self.skip_rbh:
+            # only the query vs database alignments are needed
+            yield self.rename_translate_transcriptome_task()
+            yield self.rename_database_task()
+            yield self.format_database_task()
+            for tsk in self.split_query_tasks(self.translated_query_fn):
+                yield tsk
+            for tsk in self.align_transcriptome_tasks():
+                yield tsk
+            if self.cache_alignments:
+                yield self.cache_transcriptome_alignments_task()
+        else:
+            for tsk in super(CRBL, self).tasks():
+                if tsk.name != 'reciprocal_best_last':
+                    yield tsk
         yield self.crbl_fit_and_filter_task()
-        
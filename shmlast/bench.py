@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+'''Benchmarks of the pipelines over LAST presets and thread counts.
+
+run_benchmark runs RBL or CRBL once for each combination of method,
+preset, thread count and repetition. Each run gets a fresh directory, so no
+step is up to date, and a fresh process, so the peak memory it reports is
+its own. The results are one tidy table with a row for each measure of each
+run: the seconds taken by each stage, from the profiler; the peak resident
+memory of the run and of the lastdb and lastal processes it started; the
+number of hits found; and, when the true pairs are known, how many of them
+were found.
+
+synthetic_dataset makes a database of random proteins and a transcriptome
+of mutated back-translations of some of them, plus random decoys, so that
+the true pairs are known and the sensitivity of each preset can be
+measured.
+'''
+
+import csv
+import itertools
+import multiprocessing
+import os
+import resource
+import sys
+
+import numpy as np
+import pandas as pd
+
+from .app import RBL, CRBL
+from .last import LastConfig
+from .translate import dna_to_aa, complement, reverse
+
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+APPS = {'rbl': RBL, 'crbl': CRBL}
+
+RESULT_COLUMNS = ['method', 'preset', 'n_threads', 'rep', 'stage', 'measure',
+                  'value']
+
+
+def write_fasta(fp, name, sequence):
+    fp.write('>{0}\n{1}\n'.format(name, sequence))
+
+
+def synthetic_dataset(out_dir, n_proteins=500, n_decoys=100,
+                      ortholog_fraction=0.7, min_len=80, max_len=500,
+                      max_divergence=0.5, seed=1):
+    '''Write a random protein database and a transcriptome with a known
+    ortholog for some of its transcripts.
+
+    Each ortholog is a back-translation of a database protein with a
+    random fraction of its residues, up to max_divergence, substituted,
+    padded with random UTRs, and reverse complemented half the time.
+
+    Args:
+        out_dir (str): Directory for the files, created if needed.
+        n_proteins (int): Number of database proteins.
+        n_decoys (int): Number of random transcripts with no ortholog.
+        ortholog_fraction (float): Fraction of the proteins with a
+            transcript.
+        min_len (int): Shortest protein.
+        max_len (int): Longest protein.
+        max_divergence (float): Most substitutions per residue.
+        seed (int): Random seed.
+    Returns:
+        dict: The query_fn, database_fn and truth_fn, a CSV of the true
+            (q_name, s_name) pairs.
+    '''
+
+    rng = np.random.RandomState(seed)
+    aa_to_codons = {}
+    for codon, aa in sorted(dna_to_aa.items()):
+        if aa != 'X':
+            aa_to_codons.setdefault(aa, []).append(codon)
+
+    def random_sequence(alphabet, length):
+        return ''.join(rng.choice(list(alphabet), length))
+
+    try:
+        os.makedirs(out_dir)
+    except OSError:
+        if not os.path.isdir(out_dir):
+            raise
+    files = {'query_fn': os.path.join(out_dir, 'synthetic.cdna.fa'),
+             'database_fn': os.path.join(out_dir, 'synthetic.pep.fa'),
+             'truth_fn': os.path.join(out_dir, 'synthetic.truth.csv')}
+
+    proteins = [random_sequence(AMINO_ACIDS, rng.randint(min_len, max_len + 1))
+                for _ in range(n_proteins)]
+    with open(files['database_fn'], 'w') as fp:
+        for i, protein in enumerate(proteins):
+            write_fasta(fp, 'prot{0}'.format(i), protein)
+
+    orthologs = sorted(rng.choice(n_proteins, int(n_proteins * ortholog_fraction),
+                                  replace=False))
+    with open(files['query_fn'], 'w') as fp, \
+         open(files['truth_fn'], 'w') as truth_fp:
+        truth = csv.writer(truth_fp)
+        truth.writerow(['q_name', 's_name'])
+        for i, p in enumerate(orthologs):
+            divergence = rng.uniform(0, max_divergence)
+            residues = [rng.choice(list(AMINO_ACIDS))
+                        if rng.random_sample() < divergence else aa
+                        for aa in proteins[p]]
+            cds = ''.join(rng.choice(aa_to_codons[aa]) for aa in residues)
+            transcript = random_sequence('ACGT', rng.randint(0, 50)) + cds + \
+                         random_sequence('ACGT', rng.randint(0, 50))
+            if rng.random_sample() < 0.5:
+                transcript = reverse(complement(transcript))
+            name = 'tx{0}'.format(i)
+            write_fasta(fp, name, transcript)
+            truth.writerow([name, 'prot{0}'.format(p)])
+        for i in range(n_decoys):
+            length = 3 * rng.randint(min_len, max_len + 1)
+            write_fasta(fp, 'decoy{0}'.format(i), random_sequence('ACGT', length))
+
+    return files
+
+
+def read_stage_times(profile_fn):
+    '''Get the seconds taken by each task from a profiler CSV, with the
+    whole run as 'total'.
+
+    Returns:
+        dict: Seconds for each stage.
+    '''
+
+    profile_df = pd.read_csv(profile_fn)
+    profile_df['block'] = profile_df['block'].replace('__main__', 'total')
+    return profile_df.groupby('block')['elapsed_t'].sum().to_dict()
+
+
+def count_hits(output_fn, truth_fn=None):
+    '''Count the hits in an output CSV, and how many of the true pairs
+    they include.
+
+    Returns:
+        dict: n_hits; and n_true, recall and precision if truth_fn is
+            given.
+    '''
+
+    hits_df = pd.read_csv(output_fn, usecols=['q_name', 's_name'])
+    counts = {'n_hits': len(hits_df)}
+    if truth_fn is not None:
+        truth_df = pd.read_csv(truth_fn)
+        n_true = len(hits_df.drop_duplicates().merge(truth_df))
+        counts['n_true'] = n_true
+        counts['recall'] = float(n_true) / len(truth_df) if len(truth_df) else np.nan
+        counts['precision'] = float(n_true) / len(hits_df) if len(hits_df) else np.nan
+    return counts
+
+
+def peak_rss_mb():
+    '''Get the peak resident memory of this process and of its largest
+    finished child, in MiB.
+    '''
+
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak / 1024.0 / 1024.0
+    return peak / 1024.0
+
+
+def run_config(config):
+    '''Run and measure one benchmark configuration in its own directory.
+
+    This is meant to run in a fresh process: it changes directory, and the
+    peak memory covers the whole process.
+
+    Args:
+        config (dict): method, preset, n_threads, rep, run_dir, query_fn,
+            database_fn, truth_fn and cutoff.
+    Returns:
+        list: The result rows, as dicts with RESULT_COLUMNS.
+    '''
+
+    os.makedirs(config['run_dir'])
+    os.chdir(config['run_dir'])
+
+    app = APPS[config['method']](config['query_fn'], config['database_fn'],
+                                 n_threads=config['n_threads'],
+                                 cutoff=config['cutoff'],
+                                 last_config=LastConfig(config['preset']))
+    app.doit_config['verbosity'] = 0
+    profile_fn = 'profile.csv'
+    status = app.run(doit_args=['run'], profile_fn=profile_fn)
+
+    measures = [('all', 'exit_status', status),
+                ('all', 'peak_rss_mb', peak_rss_mb())]
+    if os.path.exists(profile_fn):
+        for stage, seconds in sorted(read_stage_times(profile_fn).items()):
+            measures.append((stage, 'seconds', seconds))
+    if status == 0:
+        output_fn = app.crbl_output_fn if config['method'] == 'crbl' \
+                    else app.output_fn
+        for measure, value in sorted(count_hits(output_fn,
+                                                config['truth_fn']).items()):
+            measures.append(('all', measure, value))
+
+    run = {key: config[key] for key in ('method', 'preset', 'n_threads', 'rep')}
+    return [dict(run, stage=stage, measure=measure, value=value)
+            for stage, measure, value in measures]
+
+
+def benchmark_configs(query_fn, database_fn, work_dir, methods=('rbl', 'crbl'),
+                      presets=('fast', 'default', 'sensitive'),
+                      threads=(1, 2, 4), reps=1, truth_fn=None, cutoff=.00001):
+    '''Get the configuration of each run of a benchmark, for run_config.
+    '''
+
+    for method, preset, n_threads, rep in itertools.product(methods, presets,
+                                                            threads,
+                                                            range(reps)):
+        run_dir = os.path.join(os.path.abspath(work_dir),
+                               '{0}.{1}.t{2}.r{3}'.format(method, preset,
+                                                          n_threads, rep))
+        yield {'method': method, 'preset': preset, 'n_threads': n_threads,
+               'rep': rep, 'run_dir': run_dir,
+               'query_fn': os.path.abspath(query_fn),
+               'database_fn': os.path.abspath(database_fn),
+               'truth_fn': os.path.abspath(truth_fn) if truth_fn else None,
+               'cutoff': cutoff}
+
+
+def run_benchmark(query_fn, database_fn, output_fn, work_dir, **config_kwds):
+    '''Run each configuration of a benchmark in a fresh process, and write
+    the results table, rewriting it after each run so that an interrupted
+    benchmark keeps its results.
+
+    Args:
+        query_fn (str): The query transcriptome.
+        database_fn (str): The protein database.
+        output_fn (str): Destination CSV for the results.
+        work_dir (str): Directory for the runs; it must not hold earlier
+            runs.
+        config_kwds: Passed to benchmark_configs.
+    Returns:
+        pandas.DataFrame: The results.
+    '''
+
+    context = multiprocessing.get_context('spawn')
+    rows = []
+    for config in benchmark_configs(query_fn, database_fn, work_dir,
+                                    **config_kwds):
+        print('Running {method}, preset {preset}, {n_threads} threads, '
+              'rep {rep}'.format(**config), file=sys.stderr)
+        with context.Pool(1) as pool:
+            rows.extend(pool.apply(run_config, (config,)))
+        results_df = pd.DataFrame(rows, columns=RESULT_COLUMNS)
+        results_df.to_csv(output_fn, index=False)
+
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+
+def summarize_benchmark(results_df):
+    '''Get the median total seconds, peak memory and hit counts of each
+    configuration over its repetitions.
+    '''
+
+    run_df = results_df[results_df['stage'].isin(['all', 'total'])]
+    run_df = run_df.assign(measure=run_df['measure'].where(run_df['stage'] == 'all',
+                                                           'total_seconds'))
+    return run_df.pivot_table(index=['method', 'preset', 'n_threads'],
+                              columns='measure', values='value',
+                              aggfunc='median')
@@ -1,33 +1,38 @@
 #/usr/bin/env python3
 
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
-from ficus import FigureManager
 import numpy as np
 from os import path
 import pandas as pd
-import seaborn as sns
 
-from ope.io.maf import MafParser
+from ope.io.base import EmptyFile
 
 from .hits import BestHits
+from .alignments import alignment_parser, empty_alignments
+from .names import name_indices
+from .profile import span
+from .progress import ParseProgress, track
 
 float_info = np.finfo(float)
 
+# Dtypes for retained hit columns; lengths fit in 32 bits, while E-values can
+# underflow float32 and stay float64
+COMPACT_HIT_DTYPES = {'s_aln_len': np.int32,
+                      'q_aln_len': np.int32,
+                      's_len': np.int32,
+                      'q_len': np.int32}
 
-def get_reciprocal_best_last_translated(query_maf, database_maf):
-    '''Perform Reciprocal Best Hits between the given MAF files.
+
+def query_hits_frame(qvd_df):
+    '''Split the translated query names of query vs database alignments
+    into transcript name and frame.
 
     Args:
-        query_maf (str): The query MAF file.
-        database_maf (str): The translated datbase MAF file.
+        qvd_df (pandas.DataFrame): Alignments from the query MAF file.
     Returns:
-        tuple: DataFrames with the RBH's, query vs database, and database vs
-            query hits.
+        pandas.DataFrame: The alignments, with q_name holding the transcript
+            name and the original name in translated_q_name.
     '''
-    bh = BestHits(comparison_cols=['E', 'EG2'])
-    qvd_df = MafParser(query_maf).read()
+
     try:
         qvd_df[['qg_name', 'q_frame']] = qvd_df.q_name.str.partition('_')[[0,2]]
     except (KeyError, IndexError):
@@ -37,8 +42,20 @@ def get_reciprocal_best_last_translated(query_maf, database_maf):
                            'qg_name': 'q_name'},
                   inplace=True)
     qvd_df['ID'] = qvd_df.index
+    return qvd_df
+
+
+def database_hits_frame(dvq_df):
+    '''Split the translated subject names of database vs query alignments
+    into transcript name and frame.
+
+    Args:
+        dvq_df (pandas.DataFrame): Alignments from the database MAF file.
+    Returns:
+        pandas.DataFrame: The alignments, with s_name holding the transcript
+            name and the original name in translated_s_name.
+    '''
 
-    dvq_df = MafParser(database_maf).read()
     try:
         dvq_df[['sg_name', 'frame']] = dvq_df.s_name.str.partition('_')[[0,2]]
     except (KeyError, IndexError):
@@ -47,10 +64,218 @@ def get_reciprocal_best_last_translated(query_maf, database_maf):
                            'sg_name': 's_name'},
                   inplace=True)
     dvq_df['ID'] = dvq_df.index
+    return dvq_df
+
+
+def translated_best_hits():
+    '''Get the BestHits used for renamed, translated alignments.
+    '''
+    return BestHits(comparison_cols=['E', 'EG2'], method='hash',
+                    name_prefixes=('tr', 'db'))
+
+
+def get_reciprocal_best_last_translated(query_maf, database_maf):
+    '''Perform Reciprocal Best Hits between the given MAF files.
+
+    Args:
+        query_maf (str): The query MAF file. Tabular lastal output (with a
+            .tab extension) can be given instead.
+        database_maf (str): The translated datbase MAF file.
+    Returns:
+        tuple: DataFrames with the RBH's, query vs database, and database vs
+            query hits.
+    '''
+    bh = translated_best_hits()
+    qvd_df = query_hits_frame(alignment_parser(query_maf).read())
+    dvq_df = database_hits_frame(alignment_parser(database_maf).read())
     
     return bh.reciprocal_best_hits(qvd_df, dvq_df), qvd_df, dvq_df
 
 
+def iter_hits_frames(maf_fn, frame_func, chunksize=100000, evalue_scales=None):
+    '''Iterate over the alignments in a MAF file in chunks, numbering
+    them consecutively across chunks.
+
+    Args:
+        maf_fn (str or list): The MAF file, or tabular lastal output with a
+            .tab extension. A list of files is read in order, as if they
+            were concatenated.
+        frame_func (function): query_hits_frame or database_hits_frame.
+        chunksize (int): Alignments per chunk.
+        evalue_scales (list): If given, a factor for each file to multiply
+            its E-values by, for files aligned against part of a database.
+    Yields:
+        pandas.DataFrame: The next chunk of alignments. An empty file, or an
+            empty list of files, yields a single empty chunk.
+    '''
+
+    maf_fns = [maf_fn] if isinstance(maf_fn, str) else maf_fn
+    if evalue_scales is None:
+        evalue_scales = [None] * len(maf_fns)
+    n_alignments = 0
+    for maf_fn, scale in zip(maf_fns, evalue_scales):
+        parser = alignment_parser(maf_fn, chunksize=chunksize)
+        progress = ParseProgress(maf_fn)
+        try:
+            with track(progress):
+                for chunk in parser:
+                    chunk.index = pd.RangeIndex(n_alignments, n_alignments + len(chunk))
+                    n_alignments += len(chunk)
+                    if scale is not None:
+                        chunk['E'] = chunk['E'] * scale
+                    if len(chunk):
+                        progress.update_chunk(len(chunk), chunk['q_name'].iloc[0],
+                                              chunk['q_name'].iloc[-1])
+                    yield frame_func(chunk)
+        except EmptyFile:
+            pass
+    if n_alignments == 0:
+        yield frame_func(parser.empty() if maf_fns else empty_alignments())
+
+
+def reduce_query_hits(query_maf, hit_columns=None, max_hits=None,
+                      chunksize=100000, seed=0, evalue_scales=None):
+    '''Get the best hit for each query in query vs database alignments,
+    without reading all the alignments into memory.
+
+    Args:
+        query_maf (str or list): The query MAF file or files.
+        hit_columns (list or bool): If given, also keep these columns of
+            every alignment, or all of them if True. Length columns are
+            kept as int32.
+        max_hits (int): If given, keep only a uniform random sample of at
+            most this many of the alignments.
+        chunksize (int): Alignments to parse at a time.
+        seed (int): Random seed for the sample of alignments.
+        evalue_scales (list): E-value factors for each file; see
+            iter_hits_frames.
+    Returns:
+        tuple: DataFrames with the best hits and, if hit_columns was given,
+            the selected columns of the alignments (else None).
+    '''
+
+    bh = translated_best_hits()
+    kept = []
+    random_state = np.random.RandomState(seed)
+
+    def query_chunks():
+        for chunk in iter_hits_frames(query_maf, query_hits_frame, chunksize,
+                                      evalue_scales=evalue_scales):
+            if hit_columns is not None:
+                hits = chunk if hit_columns is True else chunk[hit_columns]
+                hits = hits.astype({col: dtype for col, dtype
+                                    in COMPACT_HIT_DTYPES.items()
+                                    if col in hits.columns})
+                if max_hits is not None:
+                    # keep the alignments with the smallest random keys,
+                    # which are a uniform sample of all those seen so far
+                    hits['_key'] = random_state.random_sample(len(hits))
+                    if kept:
+                        hits = pd.concat([kept.pop(), hits])
+                    hits = hits.nsmallest(max_hits, '_key')
+                kept.append(hits)
+            yield chunk
+
+    with span('query_best_hits'):
+        qvd_best = bh.reduce_best_hits(query_chunks())
+    hits_df = None
+    if hit_columns is not None:
+        hits_df = pd.concat(kept)
+        if max_hits is not None:
+            hits_df = hits_df.sort_index().drop(columns='_key')
+
+    return qvd_best, hits_df
+
+
+def streaming_reciprocal_best_last_translated(query_maf, database_maf,
+                                              hit_columns=None,
+                                              max_hits=None,
+                                              chunksize=100000,
+                                              seed=0):
+    '''Perform Reciprocal Best Hits between the given MAF files without
+    reading all the alignments into memory.
+
+    Each file is parsed in chunks, and only the current best hit for each
+    query is retained between chunks. The results are the same as from
+    get_reciprocal_best_last_translated.
+
+    Args:
+        query_maf (str): The query MAF file.
+        database_maf (str): The translated datbase MAF file.
+        hit_columns (list or bool): If given, also keep these columns of
+            every query vs database alignment, or all of them if True, for
+            example to filter them with the CRBH model afterwards. Length
+            columns are kept as int32.
+        max_hits (int): If given, keep only a uniform random sample of at
+            most this many of the query vs database alignments, for example
+            to plot them, so that memory use doesn't grow with the number
+            of alignments.
+        chunksize (int): Alignments to parse at a time.
+        seed (int): Random seed for the sample of alignments.
+    Returns:
+        tuple: DataFrames with the RBH's and, if hit_columns was given, the
+            selected columns of the query vs database hits (else None).
+    '''
+
+    bh = translated_best_hits()
+    qvd_best, hits_df = reduce_query_hits(query_maf, hit_columns=hit_columns,
+                                          max_hits=max_hits,
+                                          chunksize=chunksize, seed=seed)
+    with span('database_best_hits'):
+        dvq_best = bh.reduce_best_hits(iter_hits_frames(database_maf,
+                                                        database_hits_frame,
+                                                        chunksize))
+
+    return bh.reciprocal_best_hits(qvd_best, dvq_best), hits_df
+
+
+@span('select_hits')
+def select_hits(maf_fn, ids, frame_func=query_hits_frame, chunksize=100000,
+                evalue_scales=None):
+    '''Read only the alignments with the given IDs from a MAF file.
+
+    Args:
+        maf_fn (str or list): The MAF file or files.
+        ids (array-like): Alignment IDs to keep, as assigned by
+            iter_hits_frames.
+        frame_func (function): query_hits_frame or database_hits_frame.
+        chunksize (int): Alignments to parse at a time.
+        evalue_scales (list): E-value factors for each file; see
+            iter_hits_frames.
+    Returns:
+        pandas.DataFrame: The selected alignments.
+    '''
+
+    ids = pd.Index(ids)
+    selected = [chunk[chunk['ID'].isin(ids)] for chunk in
+                iter_hits_frames(maf_fn, frame_func, chunksize,
+                                 evalue_scales=evalue_scales)]
+    return pd.concat(selected)
+
+
+def iter_crbl_hits(model_df, rbh_df, maf_fn, chunksize=100000,
+                   evalue_scales=None):
+    '''Filter the query vs database alignments in a MAF file with the CRBH
+    model, one chunk at a time.
+
+    Args:
+        model_df (pandas.DataFrame): The CRBH model.
+        rbh_df (pandas.DataFrame): The RBH's, which are not repeated.
+        maf_fn (str or list): The query MAF file or files.
+        chunksize (int): Alignments to parse at a time.
+        evalue_scales (list): E-value factors for each file; see
+            iter_hits_frames.
+    Yields:
+        pandas.DataFrame: The alignments in the next chunk which pass the
+            model, with their scaled E-values.
+    '''
+
+    rbh_ids = rbh_df[['ID']]
+    for chunk in iter_hits_frames(maf_fn, query_hits_frame, chunksize,
+                                  evalue_scales=evalue_scales):
+        yield filter_hits_from_model(model_df, rbh_ids, chunk)
+
+
 def backmap_names(results_df, q_names, d_names):
     '''Map names from translated RBH's to original query and database names.
 
@@ -81,6 +306,29 @@ def backmap_names(results_df, q_names, d_names):
     return results_df
 
 
+@span('backmap_names')
+def backmap_names_indexed(results_df, q_names, d_names, q_prefix='tr',
+                          d_prefix='db'):
+    '''Map names from translated RBH's to original query and database names,
+    looking them up by record index in binary name maps rather than joining.
+
+    Args:
+        results_df (pandas.DataFrame): The results to backmap.
+        q_names (NameMap): Query name map.
+        d_names (NameMap): Database name map.
+        q_prefix (str): Renaming prefix of the query names.
+        d_prefix (str): Renaming prefix of the database names.
+    Returns:
+        pandas.DataFrame: Reference to results_df.
+    '''
+
+    results_df['q_name'] = q_names.lookup(name_indices(results_df['q_name'],
+                                                       q_prefix))
+    results_df['s_name'] = d_names.lookup(name_indices(results_df['s_name'],
+                                                       d_prefix))
+    return results_df
+
+
 def scale_evalues(df, name='E', inplace=False):
     '''Log scale the evalue column specified by name.
 
@@ -103,6 +351,50 @@ def scale_evalues(df, name='E', inplace=False):
     return df, scaled_col_name
 
 
+def window_means(lengths, values, left, right):
+    '''Get the mean of the values in each closed window [left, right] of
+    lengths.
+
+    The lengths must be sorted. Window boundaries come from the cumulative
+    length counts, so each window is a contiguous slice of the values and no
+    pass over all the values is made per window. Each slice is summed on its
+    own, rather than as a difference of cumulative sums, so the means are
+    the same as those from pandas, bit for bit. Missing values are skipped.
+
+    Args:
+        lengths (numpy.ndarray): Sorted, non-negative integer lengths.
+        values (numpy.ndarray): The values to average.
+        left (numpy.ndarray): Inclusive lower bounds of the windows.
+        right (numpy.ndarray): Inclusive upper bounds of the windows.
+    Returns:
+        numpy.ndarray: The means, NaN for windows with no values.
+    '''
+
+    lengths = np.asarray(lengths, dtype=np.int64)
+    means = np.full(len(left), np.nan)
+    if not len(lengths) or not len(left):
+        return means
+
+    missing = np.isnan(values)
+    if missing.any():
+        values = np.where(missing, 0.0, values)
+    n_valid = np.concatenate(([0], np.cumsum(~missing)))
+
+    # ends[x] is the number of lengths <= x
+    size = max(int(lengths[-1]), int(right.max())) + 1
+    ends = np.cumsum(np.bincount(lengths, minlength=size))
+    starts = np.where(left > 0, ends[np.clip(left - 1, 0, None)], 0)
+    stops = ends[np.clip(right, 0, None)]
+    stops[right < 0] = 0
+
+    for i in np.flatnonzero(n_valid[stops] > n_valid[starts]):
+        start, stop = starts[i], stops[i]
+        means[i] = values[start:stop].sum() / (n_valid[stop] - n_valid[start])
+
+    return means
+
+
+@span('fit_model')
 def fit_crbh_model(rbh_df, length_col='s_aln_len', feature_col='E'):
     '''Build the CRBH model on the given RBH's.
 
@@ -131,16 +423,75 @@ def fit_crbh_model(rbh_df, length_col='s_aln_len', feature_col='E'):
     fit['right'] = fit['center'] + fit['size']
     
     # do the fitting: it's just a sliding window with an increasing size
-    def bin_mean(fit_row, df):
-        hits = df[(df['length'] >= fit_row.left) & (df['length'] <= fit_row.right)]
-        return hits[feature_col].mean()
-
-    fit['fit'] = fit.apply(bin_mean, args=(data,), axis=1)
+    fit['fit'] = window_means(data['length'].values, data[feature_col].values,
+                              fit['left'].values, fit['right'].values)
     model_df = fit.dropna()
 
     return model_df
 
 
+MODEL_COLUMNS = ['center', 'size', 'left', 'right', 'fit']
+
+
+def save_crbh_model(model_df, model_fn):
+    '''Save a CRBH model, as CSV or, for .npz files, in NumPy's binary
+    format.
+
+    Args:
+        model_df (pandas.DataFrame): The CRBH model.
+        model_fn (str): Destination file.
+    '''
+
+    if model_fn.endswith('.npz'):
+        # write through a file object so numpy doesn't change the name
+        with open(model_fn, 'wb') as fp:
+            np.savez(fp, **{col: model_df[col].values for col in MODEL_COLUMNS})
+    else:
+        model_df.to_csv(model_fn, index=False)
+
+
+def load_crbh_model(model_fn):
+    '''Load a CRBH model saved by save_crbh_model, so that it can be
+    applied to other samples without refitting.
+
+    Args:
+        model_fn (str): The .csv or .npz model file.
+    Returns:
+        pandas.DataFrame: The CRBH model.
+    '''
+
+    if model_fn.endswith('.npz'):
+        with np.load(model_fn) as model_data:
+            missing = [col for col in MODEL_COLUMNS if col not in model_data]
+            if not missing:
+                model_df = pd.DataFrame({col: model_data[col]
+                                         for col in MODEL_COLUMNS})
+    else:
+        model_df = pd.read_csv(model_fn)
+        missing = [col for col in MODEL_COLUMNS if col not in model_df.columns]
+    if missing:
+        raise ValueError('{0} is not a CRBH model; missing columns: '
+                         '{1}'.format(model_fn, ', '.join(missing)))
+
+    return model_df[MODEL_COLUMNS]
+
+
+def model_thresholds(model_df):
+    '''Get the CRBH model as an array of thresholds indexed by length.
+
+    Args:
+        model_df (pandas.DataFrame): The CRBH model.
+    Returns:
+        numpy.ndarray: The fit at each length; NaN for lengths with no fit.
+    '''
+
+    centers = model_df['center'].values.astype(np.int64)
+    thresholds = np.full(centers.max() + 1 if len(centers) else 0, np.nan)
+    thresholds[centers] = model_df['fit'].values
+    return thresholds
+
+
+@span('filter_hits')
 def filter_hits_from_model(model_df, rbh_df, hits_df, feature_col='E',
                            id_col='ID', length_col='s_aln_len'):
     '''Filter a DataFrame of LAST best hits using the CRBH model.
@@ -156,28 +507,35 @@ def filter_hits_from_model(model_df, rbh_df, hits_df, feature_col='E',
         pandas.DataFrame: The CRBH's.
     '''
 
-    hits_df, _ = scale_evalues(hits_df, name=feature_col, inplace=False)
-    rbh_df, scaled_feature_col = scale_evalues(rbh_df, name=feature_col, inplace=False)
-
-    # Merge the model into the subset of the hits which aren't in RBH
-    print(hits_df[length_col].dtype, model_df['center'].dtype)
-    comp_df = pd.merge(hits_df[hits_df[id_col].isin(rbh_df[id_col]) == False], 
-                       model_df, left_on=length_col, right_on='center')
+    scaled_feature_col = feature_col + '_scaled'
+    scores = hits_df[feature_col].values
+    scores = -np.log10(np.where(scores == 0.0, float_info.tiny, scores))
 
-    crbl_df = comp_df[comp_df[scaled_feature_col] >= comp_df['fit']]
+    # Compare each hit which isn't an RBH to the model at its length; hits
+    # with lengths outside the model have a NaN threshold and don't pass
+    thresholds = model_thresholds(model_df)
+    lengths = hits_df[length_col].values
+    in_model = (lengths >= 0) & (lengths < len(thresholds))
+    keep = ~hits_df[id_col].isin(rbh_df[id_col]).values & in_model
+    keep[keep] = scores[keep] >= thresholds[lengths[keep]]
 
-    del crbl_df['center']
-    del crbl_df['left']
-    del crbl_df['right']
-    del crbl_df['fit']
-    del crbl_df['size']
+    crbl_df = hits_df[keep].copy()
+    crbl_df[scaled_feature_col] = scores[keep]
 
     return crbl_df
 
 
+@span('plot')
 def plot_crbh_fit(model_df, hits_df, model_plot_fn, show=False,
                   figsize=(10,10), feature_col='E', length_col='s_aln_len',
                   **fig_kwds):
+    # matplotlib and seaborn are only needed here, and importing them
+    # takes a good part of a second
+    import matplotlib as mpl
+    mpl.use('Agg')
+    import matplotlib.pyplot as plt
+    from ficus import FigureManager
+    import seaborn as sns
 
     plt.style.use('seaborn-ticks')
 
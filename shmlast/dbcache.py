@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+'''A cache of lastdb indexes shared between runs.
+
+Each index is stored in a directory of the cache named by a digest of the
+FASTA's contents and the lastdb options, so a run in a new directory, or
+a new run on the same database, can link to the index instead of building
+it again. The database is renamed before it's formatted, and renaming is
+deterministic, so the renamed FASTA of the same database always has the
+same digest.
+
+An index is built in a temporary directory of the cache and renamed into
+place when lastdb finishes, under a file lock, so concurrent runs build it
+only once and never see a partial index. The run's index files are then
+symlinks into the cache.
+
+The cache directory is given by the lastdb_cache option of the apps, or
+by the SHMLAST_LASTDB_CACHE environment variable. Entries are never
+removed; delete the directory to clear the cache.
+'''
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+from doit.task import clean_targets
+from doit.tools import config_changed
+import filelock
+
+from .last import LASTDB_CFG, lastdb_cmd, clean_lastdb
+from .profile import profile_task
+from .util import create_doit_task as doit_task
+from .util import ShortenedPythonAction, title
+
+
+CACHE_ENV = 'SHMLAST_LASTDB_CACHE'
+
+# the prefix of the index files in each cache entry
+INDEX_PREFIX = 'index'
+
+
+def default_cache_dir():
+    '''Get the cache directory from the environment, or None if unset.
+    '''
+    return os.environ.get(CACHE_ENV) or None
+
+
+def index_key(db_fn, prot=True, params=LASTDB_CFG['params']):
+    '''Get the cache key of the index of a FASTA file.
+
+    Args:
+        db_fn (str): The FASTA file.
+        prot (bool): True if a protein FASTA.
+        params (list): Additional lastdb parameters.
+    Returns:
+        str: A hex digest of the file's contents and the options.
+    '''
+
+    sha = hashlib.sha256()
+    options = {'prot': prot,
+               'params': [str(p) for p in params] if params else []}
+    sha.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    with open(db_fn, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cached_index(db_fn, cache_dir, prot=True, params=LASTDB_CFG['params']):
+    '''Get the cache entry with the index of a FASTA file, building it if
+    there isn't one.
+
+    Args:
+        db_fn (str): The FASTA file.
+        cache_dir (str): The cache directory, created if needed.
+        prot (bool): True if a protein FASTA.
+        params (list): Additional lastdb parameters.
+    Returns:
+        str: The entry directory.
+    '''
+
+    entry = os.path.join(cache_dir, index_key(db_fn, prot=prot, params=params))
+    if os.path.isdir(entry):
+        return entry
+
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+    with filelock.FileLock(entry + '.lock'):
+        # another run may have published the index while we waited
+        if not os.path.isdir(entry):
+            build_dir = tempfile.mkdtemp(prefix='.build-', dir=cache_dir)
+            try:
+                cmd = lastdb_cmd(os.path.abspath(db_fn),
+                                 os.path.join(build_dir, INDEX_PREFIX),
+                                 prot=prot, params=params)
+                subprocess.check_call(cmd, shell=True)
+                os.rename(build_dir, entry)
+            except BaseException:
+                shutil.rmtree(build_dir, ignore_errors=True)
+                raise
+    return entry
+
+
+def link_index(entry, db_out_prefix):
+    '''Symlink the index files of a cache entry to db_out_prefix, replacing
+    any existing files. The .prj file, which lastal reads first, is linked
+    last.
+    '''
+
+    fns = sorted((fn for fn in os.listdir(entry) if fn.startswith(INDEX_PREFIX)),
+                 key=lambda fn: fn.endswith('.prj'))
+    for fn in fns:
+        link_fn = db_out_prefix + fn[len(INDEX_PREFIX):]
+        tmp_fn = link_fn + '.tmp'
+        if os.path.lexists(tmp_fn):
+            os.remove(tmp_fn)
+        os.symlink(os.path.abspath(os.path.join(entry, fn)), tmp_fn)
+        os.replace(tmp_fn, link_fn)
+
+
+def cached_lastdb(db_fn, cache_dir, db_out_prefix=None, prot=True,
+                  params=LASTDB_CFG['params']):
+    '''Link the cached index of db_fn to db_out_prefix, building it first
+    if it isn't in the cache.
+    '''
+
+    if db_out_prefix is None:
+        db_out_prefix = db_fn
+    entry = cached_index(db_fn, cache_dir, prot=prot, params=params)
+    link_index(entry, db_out_prefix)
+
+
+@doit_task
+@profile_task
+def cached_lastdb_task(db_fn, cache_dir, db_out_prefix=None, prot=True,
+                       params=LASTDB_CFG['params'], task_dep=None):
+    '''Create a pydoit task to link a lastdb index from the cache, in place
+    of lastdb_task.
+
+    Unlike lastdb_task, this depends on db_fn, since linking a cached
+    index is cheap: if the FASTA changes, the index for its new contents is
+    linked, or built.
+
+    Args:
+        db_fn (str): The FASTA file to format.
+        cache_dir (str): The cache directory.
+        db_out_prefix (str): Prefix for the database files. Same as db_fn
+                             if None (default).
+        prot (bool): True if a protein FASTA, False otherwise.
+        params (list): A list of additional parameters.
+        task_dep (list): Tasks to run first.
+    Returns:
+        dict: A pydoit task.
+    '''
+
+    if db_out_prefix is None:
+        db_out_prefix = db_fn
+    options = {'cache_dir': os.path.abspath(cache_dir),
+               'prot': prot,
+               'params': [str(p) for p in params] if params else []}
+
+    task_d = {'name': 'lastdb:' + os.path.basename(db_out_prefix),
+              'title': title,
+              'actions': [ShortenedPythonAction(cached_lastdb,
+                                                args=[db_fn, cache_dir,
+                                                      db_out_prefix, prot,
+                                                      params])],
+              'file_dep': [db_fn],
+              'targets': ['{0}.prj'.format(db_out_prefix)],
+              'uptodate': [config_changed(options)],
+              'clean': [clean_targets,
+                        (clean_lastdb, [db_out_prefix])]}
+    if task_dep is not None:
+        task_d['task_dep'] = task_dep
+
+    return task_d
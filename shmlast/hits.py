@@ -1,14 +1,21 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+import numpy as np
 import pandas as pd
 
+from .names import name_indices
+from .profile import span
+
 
 class BestHits(object):
 
+    methods = ('sort', 'hash')
+
     def __init__(self, comparison_cols=['E'], query_name_col='q_name', 
                  subject_name_col='s_name', query_length_col='q_len',
-                 subject_length_col='s_len'):
+                 subject_length_col='s_len', method='sort',
+                 name_prefixes=None):
         '''Build a BestHits object to manage finding best or reciprocal best
         hits.
 
@@ -19,16 +26,84 @@ class BestHits(object):
             subject_name_col (str): The column with the subject suquence names.
             query_length_col (str): The column with the query length.
             subject_length_col (str): The column with the subject length.
+            method (str): How to find the best hits: 'sort' sorts all the
+                hits by query and comparison_cols; 'hash' finds the minimum
+                for each query with grouped passes over integer query codes,
+                in linear time. Both select the same hits.
+            name_prefixes (tuple): If given, the (query, subject) prefixes
+                of renamed sequences, which are named prefix + str(index).
+                Reciprocal best hits are then matched by direct array lookup
+                on the indices instead of by joining on names.
         '''
 
+        if method not in self.methods:
+            raise ValueError('Unknown best hits method: {0}'.format(method))
+
         self.comparison_cols = comparison_cols
         self.query_name_col = query_name_col
         self.subject_name_col = subject_name_col
         self.query_length_col = query_length_col
         self.subject_length_col = subject_length_col
+        self.method = method
+        self.name_prefixes = name_prefixes
 
     def best_hits(self, aln_df, inplace=True):
-        '''Get the best hit for each query in the alignment DataFrame.
+        '''Get the best hit for each query in the alignment DataFrame, using
+        the method chosen at construction.
+
+        Args:
+            aln_df (DataFrame): The MAF alignment DataFrame.
+            inplace (bool): If True, perform the operation in-place and
+                return the same DataFrame. If False, return a copy. The hash
+                method always returns a new DataFrame.
+        Returns:
+            DataFrame with the best hits.
+        '''
+
+        if self.method == 'hash':
+            return self.best_hits_hash(aln_df)
+        return self.best_hits_sort(aln_df, inplace=inplace)
+
+    def best_hits_hash(self, aln_df):
+        '''Get the best hit for each query in the alignment DataFrame without
+        sorting the hits.
+
+        The queries are factorized to integer codes. For each comparison
+        column in turn, hits that don't equal their query's minimum are
+        discarded; of the remaining ties, the first hit is kept. This is the
+        same selection as best_hits_sort, which sorts stably, and the results
+        are likewise ordered by query.
+
+        Args:
+            aln_df (DataFrame): The MAF alignment DataFrame.
+        Returns:
+            DataFrame with the best hits.
+        '''
+
+        if not len(aln_df):
+            return aln_df.copy()
+
+        codes, _ = pd.factorize(aln_df[self.query_name_col], sort=True)
+        # missing query names are grouped together, after all the others
+        codes[codes == -1] = codes.max() + 1
+        positions = np.arange(len(aln_df))
+
+        for col in self.comparison_cols:
+            values = aln_df[col].values[positions]
+            group_min = pd.Series(values).groupby(codes).transform('min').values
+            is_min = (values == group_min) | (pd.isnull(values) & pd.isnull(group_min))
+            positions = positions[is_min]
+            codes = codes[is_min]
+
+        first = ~pd.Series(codes).duplicated().values
+        positions = positions[first]
+        positions = positions[np.argsort(codes[first], kind='stable')]
+
+        return aln_df.iloc[positions]
+
+    def best_hits_sort(self, aln_df, inplace=True):
+        '''Get the best hit for each query in the alignment DataFrame by
+        sorting.
 
         Operates in-place. Sorts the hits by query name and then comparison_cols,
         then uses the drop_duplicates() function to remove all but the
@@ -52,6 +127,115 @@ class BestHits(object):
                        by=[self.query_name_col] + self.comparison_cols
                    ).drop_duplicates(subset=self.query_name_col)
 
+    def reduce_best_hits(self, aln_dfs):
+        '''Get the best hit for each query from an iterable of alignment
+        DataFrames, such as the chunks of a large alignment file.
+
+        Only the best hits seen so far are kept between chunks, so memory
+        use is proportional to the number of queries rather than the number
+        of alignments. Each query is given an integer index (from its
+        renamed name if the BestHits has name_prefixes), and the comparison
+        values of its current best hit are kept in arrays by that index, so
+        each chunk is only compared to the queries it contains. Ties are
+        broken in favor of the earlier alignment, the same as best_hits over
+        the concatenated alignments, and the results are likewise ordered
+        by query. Alignments without a query name are skipped.
+
+        Args:
+            aln_dfs (iterable): The alignment DataFrames.
+        Returns:
+            DataFrame with the best hits.
+        '''
+
+        empty_df = None
+        codes_d = {}
+        prefix = None
+        # the comparison values of each query's best hit, and where the hit
+        # is kept: the index into kept and the row of that DataFrame
+        best_values = [np.empty(0) for _ in self.comparison_cols]
+        kept = []
+        kept_idx = np.empty(0, dtype=np.int64)
+        kept_row = np.empty(0, dtype=np.int64)
+        n_best = n_kept = 0
+
+        for aln_df in aln_dfs:
+            # parsing the chunk is left to the enclosing span
+            with span('best_hits'):
+                if empty_df is None:
+                    empty_df = aln_df.iloc[:0]
+                labels, names = pd.factorize(aln_df[self.query_name_col])
+                if (labels == -1).any():
+                    aln_df = aln_df[labels != -1]
+                    labels = labels[labels != -1]
+                if not len(aln_df):
+                    continue
+
+                # only the names of the queries in this chunk are indexed
+                if prefix is None:
+                    prefix = next((p for p in self.name_prefixes or ()
+                                   if names[0].startswith(p)), '')
+                if not prefix:
+                    codes = np.fromiter((codes_d.setdefault(name, len(codes_d))
+                                         for name in names),
+                                        dtype=np.int64, count=len(names))
+                else:
+                    codes = name_indices(pd.Series(names), prefix)
+                codes = codes[labels]
+
+                # the chunk's best hit for each query: the first after a
+                # stable sort by query and then the comparison columns
+                new_values = [aln_df[col].to_numpy(dtype=np.float64, na_value=np.nan)
+                              for col in self.comparison_cols]
+                order = np.lexsort(new_values[::-1] + [codes])
+                codes = codes[order]
+                first = np.ones(len(codes), dtype=bool)
+                first[1:] = codes[1:] != codes[:-1]
+                positions = order[first]
+                codes = codes[first]
+                new_values = [new[positions] for new in new_values]
+
+                n_queries = codes.max() + 1
+                if n_queries > len(kept_idx):
+                    size = max(n_queries, 2 * len(kept_idx))
+                    best_values = [_grow(values, size, np.nan)
+                                   for values in best_values]
+                    kept_idx = _grow(kept_idx, size, -1)
+                    kept_row = _grow(kept_row, size, -1)
+
+                better = kept_idx[codes] == -1
+                n_best += better.sum()
+                undecided = ~better
+                for new, values in zip(new_values, best_values):
+                    old = values[codes]
+                    # missing values sort last, as in best_hits
+                    lt = (new < old) | (np.isnan(old) & ~np.isnan(new))
+                    gt = (new > old) | (np.isnan(new) & ~np.isnan(old))
+                    better |= undecided & lt
+                    undecided &= ~(lt | gt)
+
+                codes = codes[better]
+                for new, values in zip(new_values, best_values):
+                    values[codes] = new[better]
+                kept_idx[codes] = len(kept)
+                kept_row[codes] = np.arange(len(codes))
+                kept.append(aln_df.iloc[positions[better]])
+                n_kept += len(codes)
+
+                # drop the hits that have since been beaten once they
+                # outnumber the current best hits
+                if n_kept > 2 * n_best:
+                    best_df, codes = _take_kept(kept, kept_idx, kept_row)
+                    kept = [best_df]
+                    kept_idx[codes] = 0
+                    kept_row[codes] = np.arange(len(codes))
+                    n_kept = n_best
+
+        if not kept:
+            return empty_df
+        best_df, _ = _take_kept(kept, kept_idx, kept_row)
+        return best_df.sort_values(self.query_name_col, kind='mergesort')
+
+    @span('reciprocal_best_hits')
     def reciprocal_best_hits(self, aln_df_A, aln_df_B, inplace=False, drop=True):
         '''Given to DataFrames with reciprocal MAF alignments, get the
         reciprocal best hits.
@@ -71,6 +255,10 @@ class BestHits(object):
         aln_df_A = self.best_hits(aln_df_A, inplace=inplace)
         aln_df_B = self.best_hits(aln_df_B, inplace=inplace)
 
+        if self.name_prefixes is not None:
+            return self._reciprocal_best_hits_indexed(aln_df_A, aln_df_B,
+                                                      drop=drop)
+
         # Join between subject A and query B
         rbh_df = pd.merge(aln_df_A, aln_df_B, how='inner', 
                           left_on=self.subject_name_col, 
@@ -95,3 +283,70 @@ class BestHits(object):
             return rbh_df
 
 
+
+    def _reciprocal_best_hits_indexed(self, best_df_A, best_df_B, drop=True):
+        '''Find the reciprocals among best hits by record index.
+
+        With best_B mapping each B query index to its best subject index,
+        the A hit from q to s is reciprocal when best_B[s] == q. Only the
+        matching rows are materialized, and the result has the same rows
+        and columns as the join in reciprocal_best_hits.
+
+        Args:
+            best_df_A (DataFrame): The query best hits.
+            best_df_B (DataFrame): The subject best hits.
+            drop (bool): Drop extraneous columns and rename.
+        Returns:
+            DataFrame with the reciprocal best hits.
+        '''
+
+        query_prefix, subject_prefix = self.name_prefixes
+        q_A = name_indices(best_df_A[self.query_name_col], query_prefix)
+        s_A = name_indices(best_df_A[self.subject_name_col], subject_prefix)
+        q_B = name_indices(best_df_B[self.query_name_col], subject_prefix)
+        s_B = name_indices(best_df_B[self.subject_name_col], query_prefix)
+
+        n_subjects = q_B.max() + 1 if len(q_B) else 0
+        best_B = np.full(n_subjects, -1, dtype=np.int64)
+        best_B[q_B] = s_B
+        row_B = np.full(n_subjects, -1, dtype=np.int64)
+        row_B[q_B] = np.arange(len(q_B))
+
+        in_B = s_A < n_subjects
+        is_rbh = np.zeros(len(q_A), dtype=bool)
+        is_rbh[in_B] = best_B[s_A[in_B]] == q_A[in_B]
+
+        rbh_A = best_df_A[is_rbh]
+        common = [col for col in best_df_A.columns if col in best_df_B.columns]
+        if drop:
+            return rbh_A[common + ['q_frame']]
+
+        rbh_B = best_df_B.iloc[row_B[s_A[is_rbh]]]
+        rbh_A = rbh_A.rename(columns={col: col + '_A' for col in common})
+        rbh_B = rbh_B.rename(columns={col: col + '_B' for col in common})
+        return pd.concat([rbh_A.reset_index(drop=True),
+                          rbh_B.reset_index(drop=True)], axis=1)
+
+
+def _grow(values, size, fill):
+    grown = np.full(size, fill, dtype=values.dtype)
+    grown[:len(values)] = values
+    return grown
+
+
+def _take_kept(kept, kept_idx, kept_row):
+    '''Gather the current best hits from the DataFrames they were kept in.
+
+    Returns:
+        tuple: The best hits, and the query index of each of them.
+    '''
+
+    codes = np.flatnonzero(kept_idx != -1)
+    # the best hits of the same DataFrame are taken together
+    order = np.argsort(kept_idx[codes], kind='stable')
+    codes = codes[order]
+    bounds = np.searchsorted(kept_idx[codes], np.arange(len(kept) + 1))
+    best_df = pd.concat([kept[i].iloc[kept_row[codes[start:stop]]]
+                         for i, (start, stop) in enumerate(zip(bounds[:-1],
+                                                               bounds[1:]))])
+    return best_df, codes
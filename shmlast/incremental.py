@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+'''Incremental alignment against a growing database.
+
+The renamed database is split into segments of consecutive records, each
+with its own lastdb index and its own alignments in both directions. When
+records are appended to the database, the existing segments are unchanged,
+so pydoit only formats and aligns a new segment holding the new records.
+
+A manifest records the segments, each with the number of letters in it and
+a digest of all the records up to its end. The digest is what tells an
+appended database, which keeps its segments, from an edited one, which is
+started over as a single segment.
+
+E-values from lastal are proportional to the size of the database that was
+searched. E-values of query vs segment alignments are multiplied by the
+ratio of the whole database's letters to the segment's, which puts them on
+the scale of a search of the whole database. The database vs query
+alignments search the translated query, so they need no rescaling.
+'''
+
+import hashlib
+import json
+from os import path
+
+from doit.task import clean_targets
+from doit.tools import config_changed
+
+from .profile import profile_task
+from .util import create_doit_task as doit_task
+from .util import ShortenedPythonAction, title
+
+
+def scan_database(database_fn, checkpoint=None):
+    '''Count the records and letters in a FASTA file, and digest them.
+
+    Args:
+        database_fn (str): The FASTA file.
+        checkpoint (int): If given, also get the digest and letter count of
+            the first this many records.
+    Returns:
+        dict: n_records, n_letters and digest for the whole file, and
+            checkpoint_letters and checkpoint_digest for the first
+            checkpoint records (None if there are fewer records).
+    '''
+
+    import screed
+
+    sha = hashlib.sha256()
+    n_records, n_letters = 0, 0
+    result = {'checkpoint_letters': None, 'checkpoint_digest': None}
+    for record in screed.open(database_fn):
+        if n_records == checkpoint:
+            result['checkpoint_letters'] = n_letters
+            result['checkpoint_digest'] = sha.hexdigest()
+        sha.update('{0}\n{1}\n'.format(record.name,
+                                       record.sequence).encode('utf-8'))
+        n_records += 1
+        n_letters += len(record.sequence)
+    if n_records == checkpoint:
+        result['checkpoint_letters'] = n_letters
+        result['checkpoint_digest'] = sha.hexdigest()
+
+    result.update(n_records=n_records, n_letters=n_letters,
+                  digest=sha.hexdigest())
+    return result
+
+
+def read_manifest(manifest_fn):
+    '''Read the segments from a database manifest.
+
+    Args:
+        manifest_fn (str): The manifest file.
+    Returns:
+        list: The segments, or an empty list if there is no usable manifest.
+    '''
+
+    try:
+        with open(manifest_fn) as fp:
+            return json.load(fp)['segments']
+    except (IOError, ValueError, KeyError):
+        return []
+
+
+def write_manifest(manifest_fn, database_fn, segments):
+    with open(manifest_fn, 'w') as fp:
+        json.dump({'database': database_fn, 'segments': segments}, fp,
+                  indent=2)
+
+
+def plan_segments(database_fn, manifest_fn):
+    '''Work out the database segments from the previous manifest.
+
+    If the database starts with the same records as when the manifest was
+    written, the previous segments are kept, and any new records become a
+    new segment. Otherwise, the whole database is one segment.
+
+    Args:
+        database_fn (str): The database FASTA.
+        manifest_fn (str): The manifest from the previous run.
+    Returns:
+        list: Dicts with the start and stop record of each segment, its
+            number of letters, and the digest of records [0, stop).
+    '''
+
+    segments = read_manifest(manifest_fn)
+    stop = segments[-1]['stop'] if segments else None
+    scan = scan_database(database_fn, checkpoint=stop)
+
+    if not segments or scan['checkpoint_digest'] != segments[-1]['digest']:
+        return [{'start': 0, 'stop': scan['n_records'],
+                 'letters': scan['n_letters'], 'digest': scan['digest']}]
+    if scan['n_records'] > stop:
+        segments.append({'start': stop, 'stop': scan['n_records'],
+                         'letters': scan['n_letters'] - scan['checkpoint_letters'],
+                         'digest': scan['digest']})
+    return segments
+
+
+def segment_evalue_scales(segments):
+    '''Get the factors which rescale E-values from searches of each segment
+    to those of a search of the whole database.
+    '''
+
+    total = sum(segment['letters'] for segment in segments)
+    return [float(total) / segment['letters'] if segment['letters'] else 1.0
+            for segment in segments]
+
+
+def split_segment(renamed_db_fn, segment_fn, start, stop):
+    '''Write records [start, stop) of the renamed database to segment_fn.
+
+    The lines are copied as they are, without parsing the records, which
+    the renaming step has already written out in a uniform format.
+    '''
+
+    n = -1
+    with open(renamed_db_fn) as db_fp, open(segment_fn, 'w') as fp:
+        for line in db_fp:
+            if line.startswith('>'):
+                n += 1
+                if n >= stop:
+                    break
+            if n >= start:
+                fp.write(line)
+
+
+def count_fn(best_fn):
+    return best_fn + '.json'
+
+
+def write_segment_best_hits(aln_fn, best_fn, frame_func, chunksize=100000):
+    '''Save the best hit for each query in one segment's alignments, with
+    E-values as lastal reported them, and the number of alignments.
+
+    Args:
+        aln_fn (str): The alignment file.
+        best_fn (str): Destination CSV for the best hits.
+        frame_func (function or str): query_hits_frame or
+            database_hits_frame, or the name of either.
+        chunksize (int): Alignments to parse at a time.
+    '''
+
+    from . import crbl
+
+    if isinstance(frame_func, str):
+        frame_func = getattr(crbl, frame_func)
+    n_alignments = [0]
+
+    def counted(chunks):
+        for chunk in chunks:
+            n_alignments[0] += len(chunk)
+            yield chunk
+
+    best_df = crbl.translated_best_hits().reduce_best_hits(
+                  counted(crbl.iter_hits_frames(aln_fn, frame_func, chunksize)))
+    best_df.to_csv(best_fn, index=False)
+    with open(count_fn(best_fn), 'w') as fp:
+        json.dump({'n_alignments': n_alignments[0]}, fp)
+
+
+def merge_segment_best_hits(best_fns, evalue_scales=None):
+    '''Merge the saved best hits of each segment into the best hits over
+    all of them.
+
+    Alignment IDs are offset by the alignments in the preceding segments,
+    so they match the IDs from iter_hits_frames over all the segments'
+    alignment files in order.
+
+    Args:
+        best_fns (list): Best hit files from write_segment_best_hits.
+        evalue_scales (list): E-value factors for each segment, if any.
+    Returns:
+        pandas.DataFrame: The best hits.
+    '''
+
+    import pandas as pd
+
+    from .crbl import translated_best_hits
+
+    if evalue_scales is None:
+        evalue_scales = [None] * len(best_fns)
+    text_columns = {'q_frame': str, 'frame': str}
+    best_dfs, offset = [], 0
+    for best_fn, scale in zip(best_fns, evalue_scales):
+        best_df = pd.read_csv(best_fn, dtype=text_columns,
+                              float_precision='round_trip')
+        best_df['ID'] += offset
+        if scale is not None:
+            best_df['E'] *= scale
+        best_dfs.append(best_df)
+        with open(count_fn(best_fn)) as fp:
+            offset += json.load(fp)['n_alignments']
+
+    return translated_best_hits().best_hits(pd.concat(best_dfs,
+                                                      ignore_index=True))
+
+
+@doit_task
+@profile_task
+def database_manifest_task(manifest_fn, database_fn, segments):
+    '''Create a pydoit task to record the database segments for the next
+    run.
+
+    Args:
+        manifest_fn (str): Destination for the manifest.
+        database_fn (str): The database FASTA.
+        segments (list): The segments from plan_segments.
+    Returns:
+        dict: A pydoit task.
+    '''
+
+    return {'name': 'manifest:{0}'.format(path.basename(manifest_fn)),
+            'title': title,
+            'actions': [ShortenedPythonAction(write_manifest,
+                                              args=[manifest_fn, database_fn,
+                                                    segments])],
+            'targets': [manifest_fn],
+            'uptodate': [config_changed({'segments': segments})],
+            'clean': [clean_targets]}
+
+
+@doit_task
+@profile_task
+def split_segment_task(renamed_db_fn, segment_fn, start, stop, digest,
+                       task_dep=None):
+    '''Create a pydoit task to write one segment of the renamed database.
+
+    The segment's records are fixed by its bounds and the digest of the
+    records up to its end, so the task doesn't depend on the whole renamed
+    database: when records are appended, the existing segments stay up to
+    date instead of each re-reading the database.
+
+    Args:
+        renamed_db_fn (str): The renamed database FASTA.
+        segment_fn (str): Destination for the segment.
+        start (int): First record of the segment.
+        stop (int): One past the last record of the segment.
+        digest (str): Digest of the database records [0, stop).
+        task_dep (list): The task which writes the renamed database.
+    Returns:
+        dict: A pydoit task.
+    '''
+
+    task_d = {'name': 'split:{0}'.format(path.basename(segment_fn)),
+              'title': title,
+              'actions': [ShortenedPythonAction(split_segment,
+                                                args=[renamed_db_fn, segment_fn,
+                                                      start, stop])],
+              'targets': [segment_fn],
+              'uptodate': [config_changed({'start': start, 'stop': stop,
+                                           'digest': digest})],
+              'clean': [clean_targets]}
+    if task_dep is not None:
+        task_d['task_dep'] = task_dep
+
+    return task_d
+
+
+@doit_task
+@profile_task
+def segment_best_hits_task(aln_fn, best_fn, frame_func):
+    '''Create a pydoit task to save the best hits of one segment's
+    alignments.
+
+    Args:
+        aln_fn (str): The alignment file.
+        best_fn (str): Destination CSV for the best hits.
+        frame_func (str): 'query_hits_frame' or 'database_hits_frame',
+            looked up in crbl when the task runs.
+    Returns:
+        dict: A pydoit task.
+    '''
+
+    return {'name': 'best_hits:{0}'.format(path.basename(aln_fn)),
+            'title': title,
+            'actions': [ShortenedPythonAction(write_segment_best_hits,
+                                              args=[aln_fn, best_fn,
+                                                    frame_func])],
+            'file_dep': [aln_fn],
+            'targets': [best_fn, count_fn(best_fn)],
+            'clean': [clean_targets]}
@@ -1,26 +1,124 @@
 #!/usr/bin/env python
 
 from doit.task import clean_targets
-from doit.tools import LongRunning
+from doit.tools import LongRunning, config_changed
 import glob
+import importlib.util
 from itertools import count
-import numpy as np
 import os
-import pandas as pd
-
-from ope.io.maf import MafParser
+import re
 
 from .profile import profile_task
 from .util import create_doit_task as doit_task
-from .util import which, title
-
-float_info = np.finfo(float)
+from .util import which, title, ShortenedPythonAction, DependencyError
 
 LASTAL_CFG = { "params": [],
                "frameshift": 15 }
 
 LASTDB_CFG = { "params": ["-w3"] }
 
+ALIGNMENT_FORMATS = {'maf': '',
+                     'tab': '-f TAB'}
+
+
+class LastConfig(object):
+
+    # the options set by each preset, unless they're given explicitly
+    presets = {'fast': {'step': 5, 'multiplicity': 5},
+               'default': {'step': 3, 'multiplicity': None},
+               'sensitive': {'step': 1, 'multiplicity': 100}}
+
+    def __init__(self, preset='default', step=None, seed=None,
+                 volume_size=None, multiplicity=None, native_threads=False):
+        '''The lastdb and lastal options which trade speed, memory and
+        sensitivity. The default preset gives the same commands as
+        LASTDB_CFG and LASTAL_CFG.
+
+        Args:
+            preset (str): One of presets: 'fast', 'default' or 'sensitive'.
+            step (int): lastdb -w: index only every step-th position of the
+                database. Larger steps are faster and less sensitive.
+            seed (str): lastdb -u: a subset seed name or file.
+            volume_size (str): lastdb -s: most bytes in each volume of the
+                index, such as "4G", to bound lastal's memory.
+            multiplicity (int): lastal -m: most initial matches for each
+                query position. Larger is slower and more sensitive.
+            native_threads (bool): Thread lastal with its -P option, instead
+                of running a lastal per thread with ope parallel. Requires a
+                LAST release with -P.
+        '''
+
+        if preset not in self.presets:
+            raise ValueError('Unknown preset: {0}; choose from {1}'.format(preset,
+                             ', '.join(sorted(self.presets))))
+        options = dict(self.presets[preset])
+        if step is not None:
+            options['step'] = step
+        if multiplicity is not None:
+            options['multiplicity'] = multiplicity
+
+        for name in ('step', 'multiplicity'):
+            value = options[name]
+            if value is not None and (int(value) != value or value < 1):
+                raise ValueError('{0} must be a positive integer, '
+                                 'got {1}'.format(name, value))
+        if seed is not None and (not seed or re.search(r'\s', seed)):
+            raise ValueError('Invalid subset seed: {0!r}'.format(seed))
+        if volume_size is not None and \
+           not re.match(r'^\d+[KMGT]?$', str(volume_size)):
+            raise ValueError('Invalid volume size: {0!r}; use a number of '
+                             'bytes with an optional K, M, G or T '
+                             'suffix'.format(volume_size))
+
+        self.preset = preset
+        self.step = options['step']
+        self.multiplicity = options['multiplicity']
+        self.seed = seed
+        self.volume_size = volume_size
+        self.native_threads = native_threads
+
+    def lastdb_params(self):
+        params = ['-w{0}'.format(self.step)]
+        if self.seed is not None:
+            params.extend(['-u', self.seed])
+        if self.volume_size is not None:
+            params.extend(['-s', str(self.volume_size)])
+        return params
+
+    def lastal_params(self):
+        if self.multiplicity is None:
+            return []
+        return ['-m{0}'.format(self.multiplicity)]
+
+
+class options_changed(config_changed):
+    '''config_changed for tasks whose LAST options are recorded. Targets
+    made before the options were recorded were made with the defaults, so
+    they're up to date if the options are still the defaults.
+    '''
+
+    def __init__(self, config, default):
+        super(options_changed, self).__init__(config)
+        self.default = default
+
+    def __call__(self, task, values):
+        unchanged = super(options_changed, self).__call__(task, values)
+        if values.get('_config_changed') is None:
+            return self.config == self.default
+        return unchanged
+
+
+def lastal_uptodate(params=None, db_params=LASTDB_CFG['params']):
+    '''Get the uptodate check for the LAST options of a lastal task: the
+    alignments are redone if the lastal options, or those the database
+    was formatted with, change.
+    '''
+    config = {'params': [str(p) for p in params or []],
+              'db_params': [str(p) for p in db_params or []]}
+    default = {'params': [str(p) for p in LASTAL_CFG['params']],
+               'db_params': [str(p) for p in LASTDB_CFG['params']]}
+    return options_changed(config, default)
+
 def clean_lastdb(db_prefix):
     files = glob.glob('{0}.*'.format(db_prefix))
     for fn in files:
@@ -30,6 +128,23 @@ def clean_lastdb(db_prefix):
             pass
 
 
+def lastdb_cmd(db_fn, db_out_prefix, prot=True, params=LASTDB_CFG['params']):
+    '''Build the shell command to run lastdb. The arguments are those of
+    lastdb_task.
+
+    Returns:
+        str: The command.
+    '''
+
+    cmd = [which('lastdb')]
+    if prot:
+        cmd.append('-p')
+    if params is not None:
+        cmd.extend([str(p) for p in params])
+    cmd.extend([db_out_prefix, db_fn])
+    return ' '.join(cmd)
+
+
 @doit_task
 @profile_task
 def lastdb_task(db_fn, db_out_prefix=None, prot=True,
@@ -51,23 +166,20 @@ def lastdb_task(db_fn, db_out_prefix=None, prot=True,
         dict: A pydoit task.
     '''
 
-    cmd = [which('lastdb')]
-    if prot:
-        cmd.append('-p')
-    if params is not None:
-        cmd.extend([str(p) for p in params])
     if db_out_prefix is None:
         db_out_prefix = db_fn
-    cmd.extend([db_out_prefix, db_fn])
-    cmd = ' '.join(cmd)
+    cmd = lastdb_cmd(db_fn, db_out_prefix, prot=prot, params=params)
 
     name = 'lastdb:' + os.path.basename(db_out_prefix)
+    # an existing index is kept unless the options change
+    uptodate = options_changed({'params': [str(p) for p in params or []]},
+                               {'params': [str(p) for p in LASTDB_CFG['params']]})
 
     task_d =  {'name': name,
               'title': title,
               'actions': [cmd],
               'targets': ['{0}.prj'.format(db_out_prefix)],
-              'uptodate': [True],
+              'uptodate': [uptodate],
               'clean': [clean_targets,
                         (clean_lastdb, [db_out_prefix])]}
     if task_dep is not None:
@@ -76,11 +188,50 @@ def lastdb_task(db_fn, db_out_prefix=None, prot=True,
     return task_d
 
 
+def lastal_cmd(query, db, out_fn, translate=False,
+               frameshift=LASTAL_CFG['frameshift'], cutoff=0.00001,
+               n_threads=1, params=None, fmt='maf', native_threads=False):
+    '''Build the shell command to run lastal, split over n_threads
+    processes with ope parallel, or threaded by lastal itself. The
+    arguments are those of lastal_task.
+
+    Returns:
+        str: The command.
+    '''
+
+    if fmt not in ALIGNMENT_FORMATS:
+        raise ValueError('Unknown alignment format: {0}'.format(fmt))
+    lastal_exc = which('lastal')
+
+    if native_threads:
+        cmd = [lastal_exc, '-P{0}'.format(n_threads)]
+    else:
+        cmd = ['ope', 'parallel', '-j', n_threads, query,
+               lastal_exc]
+    if translate:
+        cmd.append('-F' + str(frameshift))
+    if cutoff is not None:
+        cutoff = round(1.0 / cutoff, 2)
+        cmd.append('-D' + str(cutoff))
+    if ALIGNMENT_FORMATS[fmt]:
+        cmd.append(ALIGNMENT_FORMATS[fmt])
+    if params is not None:
+        cmd.extend(params)
+    cmd.append(db)
+    if native_threads:
+        cmd.append(query)
+    cmd.extend(['>', out_fn])
+
+    cmd = [str(token) for token in cmd]
+    return ' '.join(cmd)
+
+
 @doit_task
 @profile_task
 def lastal_task(query, db, out_fn, translate=False,
                 frameshift=LASTAL_CFG['frameshift'], cutoff=0.00001, 
-                n_threads=1, params=None):
+                n_threads=1, params=None, fmt='maf', native_threads=False,
+                db_params=LASTDB_CFG['params']):
     '''Create a pydoit task to run lastal
 
     Args:
@@ -90,30 +241,72 @@ def lastal_task(query, db, out_fn, translate=False,
         translate (bool): True if query is a nucleotide FASTA.
         frameshift (int): Frameshift penalty for translated alignment.
         n_threads (int): Number of threads to run with.
+        params (list): A list of additional parameters.
+        fmt (str): Output format, one of ALIGNMENT_FORMATS: 'maf' (the
+            default) or 'tab' for lastal's tabular format, which omits
+            the aligned sequences.
+        native_threads (bool): Use lastal's -P option for threading
+            instead of ope parallel.
+        db_params (list): The lastdb parameters the database was formatted
+            with, so the alignments are redone when they change.
     Returns:
         dict: A pydoit task.
     '''
 
-    lastal_exc = which('lastal')
+    cmd = lastal_cmd(query, db, out_fn, translate=translate,
+                     frameshift=frameshift, cutoff=cutoff,
+                     n_threads=n_threads, params=params, fmt=fmt,
+                     native_threads=native_threads)
     name = 'lastal:{0}'.format(os.path.join(out_fn))
 
-    cmd = ['ope', 'parallel', '-j', n_threads, query,
-           lastal_exc]
-    if translate:
-        cmd.append('-F' + str(frameshift))
-    if cutoff is not None:
-        cutoff = round(1.0 / cutoff, 2)
-        cmd.append('-D' + str(cutoff))
-    if params is not None:
-        cmd.extend(params)
-    cmd.extend([db, '>', out_fn])
-
-    cmd = [str(token) for token in cmd]
-    cmd = ' '.join(cmd)
-
     return {'name': name,
             'title': title,
             'actions': [cmd],
             'targets': [out_fn],
             'file_dep': [query, db + '.prj'],
+            'uptodate': [lastal_uptodate(params, db_params)],
+            'meta': {'progress': {'query_fn': query, 'output_fn': out_fn}},
+            'clean': [clean_targets]}
+
+
+def require_pyarrow():
+    if importlib.util.find_spec('pyarrow') is None:
+        raise DependencyError('pyarrow is required for the alignment cache; '
+                              'install it with `pip install pyarrow`')
+
+
+def cache_alignments(aln_fn, cache_fn, chunksize=100000):
+    '''Convert a lastal output file into a typed Parquet alignment cache;
+    see alignments.cache_alignments.
+    '''
+
+    from .alignments import cache_alignments
+    cache_alignments(aln_fn, cache_fn, chunksize=chunksize)
+
+
+@doit_task
+@profile_task
+def alignment_cache_task(aln_fn, cache_fn=None):
+    '''Create a pydoit task to convert a lastal output file into a Parquet
+    alignment cache, which is much faster to read back than MAF.
+
+    Args:
+        aln_fn (str): The MAF or tabular alignment file.
+        cache_fn (str): Destination for the cache. Defaults to
+            aln_fn + '.parquet'.
+    Returns:
+        dict: A pydoit task.
+    '''
+
+    require_pyarrow()
+    if cache_fn is None:
+        cache_fn = aln_fn + '.parquet'
+
+    return {'name': 'cache_alignments:{0}'.format(os.path.basename(aln_fn)),
+            'title': title,
+            'actions': [ShortenedPythonAction(cache_alignments,
+                                              args=[aln_fn, cache_fn])],
+            'file_dep': [aln_fn],
+            'targets': [cache_fn],
             'clean': [clean_targets]}
+
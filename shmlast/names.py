@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+'''Compact on-disk storage for the mapping from renamed sequence identifiers
+back to the originals.
+
+The renaming step gives the n-th record of a file the name prefix + str(n),
+so the map only needs to store the original names in order. They are stored
+as a single UTF-8 blob plus an array of offsets into it:
+
+    header:  magic (8 bytes), record count (uint64), offsets position (uint64)
+    blob:    the original names, concatenated
+    offsets: count + 1 little-endian int64 offsets into the blob
+
+The file is memory-mapped when read, so looking up a name does not require
+loading the whole map.
+'''
+
+from array import array
+import mmap
+import struct
+import sys
+
+
+MAGIC = b'SHMLNAME'
+HEADER = struct.Struct('<8sQQ')
+
+
+class NameMapWriter(object):
+
+    def __init__(self, filename):
+        '''Stream the original names of renamed records to a binary name map.
+
+        Records must be appended in the order they were renamed.
+
+        Args:
+            filename (str): Destination for the name map.
+        '''
+
+        self.filename = filename
+        self.fp = open(filename, 'wb')
+        self.fp.write(HEADER.pack(MAGIC, 0, 0))
+        self.offsets = array('q', [0])
+
+    def append(self, names):
+        '''Add a record.
+
+        Args:
+            names (tuple): The (old_name, new_name) pair. The new name is
+                implied by the position of the record and is not stored.
+        '''
+
+        old_name, _ = names
+        encoded = old_name.encode('utf-8')
+        self.fp.write(encoded)
+        self.offsets.append(self.offsets[-1] + len(encoded))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def close(self):
+        '''Write the offsets and header and close the file.
+        '''
+
+        if self.fp.closed:
+            return
+        offsets_pos = self.fp.tell()
+        if sys.byteorder != 'little':
+            self.offsets.byteswap()
+        self.fp.write(self.offsets.tobytes())
+        self.fp.seek(0)
+        self.fp.write(HEADER.pack(MAGIC, len(self), offsets_pos))
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CSVNameMapWriter(list):
+
+    def __init__(self, filename):
+        '''Collect (old_name, new_name) pairs and write them as CSV on close,
+        for callers that want a human-readable name map.
+
+        Args:
+            filename (str): Destination for the name map.
+        '''
+
+        self.filename = filename
+        super(CSVNameMapWriter, self).__init__()
+
+    def close(self):
+        import pandas as pd
+
+        pd.DataFrame(self,
+                     columns=['old_name', 'new_name']).to_csv(self.filename,
+                                                              index=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def name_map_writer(filename):
+    '''Get a writer for the name map format implied by the filename: CSV
+    for .csv files, and the binary format otherwise.
+
+    Args:
+        filename (str): Destination for the name map.
+    Returns:
+        NameMapWriter or CSVNameMapWriter: The writer.
+    '''
+
+    if filename.endswith('.csv'):
+        return CSVNameMapWriter(filename)
+    return NameMapWriter(filename)
+
+
+class NameMap(object):
+
+    def __init__(self, filename):
+        '''Read-only, memory-mapped view of a binary name map.
+
+        Args:
+            filename (str): The name map file.
+        '''
+
+        import numpy as np
+
+        self.filename = filename
+        with open(filename, 'rb') as fp:
+            self._mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n_names, offsets_pos = HEADER.unpack_from(self._mm)
+        if magic != MAGIC:
+            self._mm.close()
+            raise ValueError('{0} is not a shmlast name map'.format(filename))
+        self.offsets = np.frombuffer(self._mm, dtype='<i8', count=n_names + 1,
+                                     offset=offsets_pos)
+        self.blob_start = HEADER.size
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        start = self.blob_start + self.offsets[index]
+        end = self.blob_start + self.offsets[index + 1]
+        return self._mm[start:end].decode('utf-8')
+
+    def lookup(self, indices):
+        '''Get the original names for the given record indices.
+
+        Args:
+            indices (array-like): Integer record indices.
+        Returns:
+            numpy.ndarray: The names, as an object array.
+        '''
+
+        import numpy as np
+
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) and (indices.min() < 0 or indices.max() >= len(self)):
+            raise IndexError('name index out of range for {0}'.format(self.filename))
+        starts = self.blob_start + self.offsets[indices]
+        ends = self.blob_start + self.offsets[indices + 1]
+        mm = self._mm
+        return np.array([mm[s:e].decode('utf-8') for s, e in zip(starts, ends)],
+                        dtype=object)
+
+    def close(self):
+        # the offsets array holds a buffer export on the mmap
+        self.offsets = None
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def name_indices(names, prefix):
+    '''Recover the record indices from renamed identifiers.
+
+    Args:
+        names (pandas.Series): Names of the form prefix + str(index).
+        prefix (str): The renaming prefix.
+    Returns:
+        numpy.ndarray: The integer indices.
+    '''
+
+    import numpy as np
+
+    if not len(names):
+        return np.empty(0, dtype=np.int64)
+    return names.str[len(prefix):].astype(np.int64).values
@@ -1,7 +1,14 @@
+from collections import OrderedDict
+import cProfile
 import csv
 import filelock
 from functools import wraps
+import json
+import pstats
+import re
+import resource
 import sys
+import threading
 import time
 import warnings
 from contextlib import contextmanager
@@ -28,22 +35,184 @@ def cleaned_actions(actions):
     return txt
 
 
+# the resources recorded for each block, besides its wall time
+USAGE_COLUMNS = ['user_t', 'sys_t', 'child_user_t', 'child_sys_t',
+                 'max_rss_kb', 'child_max_rss_kb', 'read_bytes', 'write_bytes',
+                 'disk_read_bytes', 'disk_write_bytes']
+
+PROFILE_COLUMNS = ['run_id', 'block', 'start_t', 'end_t', 'elapsed_t',
+                   'thread'] + USAGE_COLUMNS
+
+# separates the names of nested spans in their block names
+SPAN_SEP = ' > '
+
+# ru_maxrss is in kilobytes, except on macOS, where it's in bytes
+RSS_UNITS = 1024 if sys.platform == 'darwin' else 1
+
+# the usage of the calling thread, where the platform can tell it apart
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+# Function-level profilers for the Python actions of profiled tasks. Each is
+# a factory for an object with enable(), disable() and dump_stats(filename)
+# methods, writing pstats files, as cProfile.Profile does; others, such as
+# an adapter for a sampling profiler, can be added here.
+FUNCTION_PROFILERS = {'cprofile': cProfile.Profile}
+
+# 'time' records only the blocks and spans
+PROFILE_MODES = ['time'] + sorted(FUNCTION_PROFILERS)
+
+# functions listed in the summary of the function profiles
+N_TOP_FUNCTIONS = 20
+
+
+def read_proc_io():
+    '''Get the I/O counts of this process and its finished children from
+    /proc/self/io.
+
+    Returns:
+        dict: The rchar, wchar, read_bytes and write_bytes counts, or None
+            if /proc isn't available.
+    '''
+
+    try:
+        with open('/proc/self/io') as fp:
+            return {key: int(value) for key, value in
+                    (line.split(':') for line in fp)}
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def read_peak_rss():
+    '''Get the peak RSS of this process in kB, from /proc/self/status if
+    it's available, since that can be reset, and from getrusage otherwise.
+    '''
+
+    try:
+        with open('/proc/self/status') as fp:
+            for line in fp:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // RSS_UNITS
+
+
+class PeakRSS(object):
+    '''The peak RSS of this process, which can be reset to measure the peak
+    of each block, while keeping the peak of the whole process.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.overall = 0
+
+    def reset(self):
+        '''Reset the peak to the current RSS, where Linux allows it.
+        '''
+        with self.lock:
+            self.overall = max(self.overall, read_peak_rss())
+            try:
+                with open('/proc/self/clear_refs', 'w') as fp:
+                    fp.write('5')
+            except (IOError, OSError):
+                pass
+
+    def overall_peak(self):
+        with self.lock:
+            return max(self.overall, read_peak_rss())
+
+
+peak_rss = PeakRSS()
+
+
+class ResourceUsage(object):
+
+    def __init__(self, who=RUSAGE_THREAD):
+        '''A snapshot of the resources used so far by the calling thread,
+        and by the finished children of this process.
+
+        Args:
+            who (int): RUSAGE_THREAD, or resource.RUSAGE_SELF for the whole
+                process.
+        '''
+
+        self.own = resource.getrusage(who)
+        self.children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io = read_proc_io()
+
+    def since(self, start):
+        '''Get the resources used between an earlier snapshot and this one.
+
+        The CPU times of children are counted when they finish, so a task's
+        child CPU includes any children of other tasks which finished while
+        it ran in parallel with them. The peak RSS of this process is the
+        peak since the most recent block started, which covers the other
+        tasks running in parallel. The peak RSS of children is only known
+        if one finishing during the task set a new peak for this process's
+        children; otherwise it's None.
+
+        Args:
+            start (ResourceUsage): The earlier snapshot.
+        Returns:
+            dict: The measures in USAGE_COLUMNS.
+        '''
+
+        usage = {'user_t': self.own.ru_utime - start.own.ru_utime,
+                 'sys_t': self.own.ru_stime - start.own.ru_stime,
+                 'child_user_t': self.children.ru_utime - start.children.ru_utime,
+                 'child_sys_t': self.children.ru_stime - start.children.ru_stime,
+                 'max_rss_kb': read_peak_rss(),
+                 'child_max_rss_kb': None}
+        if self.children.ru_maxrss > start.children.ru_maxrss:
+            usage['child_max_rss_kb'] = self.children.ru_maxrss // RSS_UNITS
+
+        if self.io is not None and start.io is not None:
+            usage['read_bytes'] = self.io['rchar'] - start.io['rchar']
+            usage['write_bytes'] = self.io['wchar'] - start.io['wchar']
+            usage['disk_read_bytes'] = self.io['read_bytes'] - start.io['read_bytes']
+            usage['disk_write_bytes'] = self.io['write_bytes'] - start.io['write_bytes']
+        else:
+            # getrusage counts 512-byte blocks, for this process only
+            usage['read_bytes'] = usage['write_bytes'] = None
+            usage['disk_read_bytes'] = 512 * (self.own.ru_inblock -
+                                              start.own.ru_inblock)
+            usage['disk_write_bytes'] = 512 * (self.own.ru_oublock -
+                                               start.own.ru_oublock)
+        return usage
+
+
 class Profiler(object):
     '''Thread-safe performance profiler.
+
+    Results are kept in memory, and written to the file when the profiler
+    stops.
     '''
 
     def __init__(self):
         self.running = False
+        self.rows = []
+        self.rows_lock = threading.Lock()
 
-    def start_profiler(self, filename=None, blockname='__main__'):
+    def start_profiler(self, filename=None, blockname='__main__',
+                       trace_fn=None, mode='time'):
         '''Start the profiler, with results stored in the given filename.
 
         Args:
             filename (str): Path to store profiling results. If not given,
                 uses a representation of the current time
             blockname (str): Name assigned to the main block.
+            trace_fn (str): If given, also write the run's results here as
+                a Chrome trace.
+            mode (str): One of PROFILE_MODES. Other than 'time', the Python
+                actions of each task are also profiled with the named
+                function profiler, and their stats written to a .pstats
+                file for each task, next to the results.
         '''
 
+        if mode not in PROFILE_MODES:
+            raise ValueError('Unknown profile mode {0!r}; expected one of '
+                             '{1}'.format(mode, ', '.join(PROFILE_MODES)))
+
         self.run_name = time.strftime("%a_%d_%b_%Y_%H%M%S", time.localtime())
         if filename is None:
             self.filename = '{0}.csv'.format(self.run_name)
@@ -51,13 +220,19 @@ class Profiler(object):
             self.filename = filename
         self.run_name = time.ctime()
         self.start_time = time.time()
+        self.start_usage = ResourceUsage(resource.RUSAGE_SELF)
         self.blockname = blockname
+        self.trace_fn = trace_fn
+        self.function_profiler = FUNCTION_PROFILERS.get(mode)
+        self.stats_fns = OrderedDict()
+        self.rows = []
         self.running = True
         self.lock = filelock.FileLock('{0}.lock'.format(self.filename))
         print('Profiling is ON:', self.filename, '\n', file=sys.stderr)
 
-    def write_result(self, task_name, start_time, end_time, elapsed_time):
-        '''Write results to the file, using the given task name as the
+    def write_result(self, task_name, start_time, end_time, elapsed_time,
+                     usage=None):
+        '''Record the results of a block, using the given task name as the
         name for the results block.
 
         Args:
@@ -65,27 +240,82 @@ class Profiler(object):
             start_time (float): Time of block start.
             end_time (float): Time of block end.
             elapsed_time (float): Total time.
+            usage (dict): The resources used, from ResourceUsage.since.
+        '''
+
+        row = {'run_id': self.run_name, 'block': task_name,
+               'start_t': start_time, 'end_t': end_time,
+               'elapsed_t': elapsed_time,
+               'thread': threading.current_thread().name}
+        if usage is not None:
+            row.update(usage)
+        with self.rows_lock:
+            self.rows.append(row)
+
+    def stats_fn(self, task_name):
+        '''Get the .pstats file for a task, next to the results file, and
+        remember it for the summary.
         '''
 
+        root, _ = path.splitext(self.filename)
+        stats_fn = '{0}.{1}.pstats'.format(root,
+                                           re.sub(r'[^\w.-]+', '_', task_name))
+        with self.rows_lock:
+            self.stats_fns[task_name] = stats_fn
+        return stats_fn
+
+    def print_function_summary(self, n_functions=N_TOP_FUNCTIONS):
+        '''Print the functions which took the most time of their own over
+        all the profiled tasks.
+        '''
+
+        stats_fns = [fn for fn in self.stats_fns.values() if path.isfile(fn)]
+        if not stats_fns:
+            return
+        print('\nFunction profiles:', ', '.join(stats_fns), file=sys.stderr)
+        stats = pstats.Stats(*stats_fns, stream=sys.stderr)
+        stats.sort_stats('tottime').print_stats(n_functions)
+
+    def flush(self):
+        '''Append the recorded results to the file. A file written with
+        other columns, by an older version, is rewritten with these.
+        '''
+
+        with self.rows_lock:
+            rows, self.rows = self.rows, []
         try:
             with self.lock.acquire(timeout=10):
-                header = not path.isfile(self.filename)
-                with open(self.filename, 'a') as fp:
-                    writer = csv.writer(fp, delimiter=',')
-                    if header:
-                        writer.writerow(['run_id', 'block', 'start_t', 'end_t',
-                                      'elapsed_t'])
-                    row = [self.run_name, task_name, start_time, end_time, elapsed_time]
-                    writer.writerow(row)
+                old_rows = []
+                if path.isfile(self.filename):
+                    with open(self.filename) as fp:
+                        reader = csv.DictReader(fp)
+                        if reader.fieldnames != PROFILE_COLUMNS:
+                            old_rows = list(reader)
+                mode = 'a' if path.isfile(self.filename) and not old_rows else 'w'
+                with open(self.filename, mode) as fp:
+                    writer = csv.DictWriter(fp, PROFILE_COLUMNS,
+                                            extrasaction='ignore')
+                    if mode == 'w':
+                        writer.writeheader()
+                    writer.writerows(old_rows + rows)
         except filelock.Timeout as e:
             warnings.warn(e, RuntimeWarning, stacklevel=1)
 
     def stop_profiler(self):
-        '''Shut down the profiler and write the final elapsed time.
+        '''Shut down the profiler, record the final elapsed time, and write
+        the results.
         '''
         self.end_time = time.time()
         elapsed = self.end_time - self.start_time
-        self.write_result(self.blockname, self.start_time, self.end_time, elapsed)
+        usage = ResourceUsage(resource.RUSAGE_SELF).since(self.start_usage)
+        usage['max_rss_kb'] = peak_rss.overall_peak()
+        self.write_result(self.blockname, self.start_time, self.end_time, elapsed,
+                          usage=usage)
+        print(format_profile_tree(self.rows), file=sys.stderr)
+        if self.trace_fn is not None:
+            write_chrome_trace(self.rows, self.trace_fn)
+        self.flush()
+        self.print_function_summary()
         self.running = False
         return elapsed
 
@@ -106,6 +336,107 @@ class Timer(object):
         return self.end_time - self.start_time
 
 
+class ResourceTimer(Timer):
+    '''Timer which also records the resources used while it runs.
+    '''
+
+    def start(self):
+        peak_rss.reset()
+        self.start_usage = ResourceUsage()
+        super(ResourceTimer, self).start()
+
+    def stop(self):
+        elapsed = super(ResourceTimer, self).stop()
+        self.usage = ResourceUsage().since(self.start_usage)
+        return elapsed
+
+
+def profile_tree(rows):
+    '''Total the time of each block and span, keeping their nesting.
+
+    Args:
+        rows (list): Profile rows, as dicts with block and elapsed_t.
+    Returns:
+        list: (depth, name, count, seconds) for each block or span, in the
+            order they were first seen, with spans after their parents.
+    '''
+
+    totals = OrderedDict()
+    for row in rows:
+        path = tuple(row['block'].split(SPAN_SEP))
+        count, seconds = totals.get(path, (0, 0.0))
+        totals[path] = (count + 1, seconds + float(row['elapsed_t']))
+
+    children = OrderedDict()
+    for path in totals:
+        children.setdefault(path[:-1], []).append(path)
+
+    tree = []
+    def visit(parent):
+        for path in children.pop(parent, []):
+            count, seconds = totals[path]
+            tree.append((len(path) - 1, path[-1], count, seconds))
+            visit(path)
+    visit(())
+    # spans whose enclosing block wasn't recorded, such as a failed task's
+    for paths in list(children.values()):
+        for path in paths:
+            count, seconds = totals[path]
+            tree.append((0, SPAN_SEP.join(path), count, seconds))
+    return tree
+
+
+def format_profile_tree(rows):
+    '''Format profile rows as an indented tree of total times.
+    '''
+
+    lines = []
+    for depth, name, count, seconds in profile_tree(rows):
+        line = '{0}{1}: {2:.3f}s'.format('  ' * depth, name, seconds)
+        if count > 1:
+            line += ' ({0} calls)'.format(count)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def write_chrome_trace(rows, trace_fn):
+    '''Write profile rows as Chrome trace events, which can be viewed in
+    chrome://tracing or Perfetto. Each thread gets its own track, and spans
+    are drawn inside the blocks that contain them.
+
+    Args:
+        rows (list): Profile rows, as dicts.
+        trace_fn (str): Destination JSON file.
+    '''
+
+    if not rows:
+        origin = 0.0
+    else:
+        origin = min(float(row['start_t']) for row in rows)
+    thread_ids = OrderedDict()
+    events = []
+    for row in rows:
+        thread = row.get('thread') or 'MainThread'
+        tid = thread_ids.setdefault(thread, len(thread_ids))
+        path = row['block'].split(SPAN_SEP)
+        args = {key: row[key] for key in USAGE_COLUMNS
+                if row.get(key) not in (None, '')}
+        events.append({'name': path[-1],
+                       'cat': 'span' if len(path) > 1 else 'task',
+                       'ph': 'X',
+                       'ts': (float(row['start_t']) - origin) * 1e6,
+                       'dur': float(row['elapsed_t']) * 1e6,
+                       'pid': 1,
+                       'tid': tid,
+                       'args': args})
+    for thread, tid in thread_ids.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                       'tid': tid, 'args': {'name': thread}})
+
+    with open(trace_fn, 'w') as fp:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+
+
 def title_without_profile_actions(task):
     """Generate title without profiling actions"""
     title = ''
@@ -119,23 +450,106 @@ def title_without_profile_actions(task):
 def setup_profiler():
 
     profiler = Profiler()
+    # the names of the task and spans running in each thread
+    span_stacks = threading.local()
+
     @contextmanager
-    def profiler_manager(filename=None, blockname='__main__'):
-        profiler.start_profiler(filename=filename, blockname=blockname)
-        yield
-        profiler.stop_profiler()
+    def profiler_manager(filename=None, blockname='__main__', trace_fn=None,
+                         mode='time'):
+        profiler.start_profiler(filename=filename, blockname=blockname,
+                                trace_fn=trace_fn, mode=mode)
+        try:
+            yield profiler
+        finally:
+            profiler.stop_profiler()
 
-    def add_profile_actions(task):
+    @contextmanager
+    def span(name):
+        '''Time a step inside a task, as a context manager or a decorator.
+
+        Spans nest: one that starts inside another, or inside a profiled
+        task, is recorded under it, with the names joined by SPAN_SEP. Does
+        nothing unless the profiler is running.
+
+        Args:
+            name (str): Name of the step.
+        '''
+
+        if not profiler.running:
+            yield
+            return
+
+        stack = getattr(span_stacks, 'names', None)
+        if stack is None:
+            stack = span_stacks.names = []
+        stack.append(name)
+        block = SPAN_SEP.join(stack)
         timer = Timer()
+        start_usage = ResourceUsage()
+        timer.start()
+        try:
+            yield
+        finally:
+            elapsed = timer.stop()
+            usage = ResourceUsage().since(start_usage)
+            # the peak is only reset for whole tasks
+            usage['max_rss_kb'] = None
+            profiler.write_result(block, timer.start_time, timer.end_time,
+                                  elapsed, usage=usage)
+            stack.pop()
+
+    def add_profile_actions(task):
+        timer = ResourceTimer()
+        # the task's function profile, shared by its Python actions
+        function_profile = {}
+
         def start_profiling():
+            function_profile.clear()
             if profiler.running:
+                span_stacks.names = [task['name']]
                 timer.start()
 
+        def profile_function(func):
+            # only the thread running the action is profiled
+            @wraps(func)
+            def func_profiled(*args, **kwargs):
+                if not profiler.running or profiler.function_profiler is None:
+                    return func(*args, **kwargs)
+                if 'profile' not in function_profile:
+                    function_profile['profile'] = profiler.function_profiler()
+                profile = function_profile['profile']
+                try:
+                    profile.enable()
+                except ValueError as e:
+                    # another thread's profile is active, which newer
+                    # Pythons only allow one of at a time
+                    warnings.warn('{0} not profiled: {1}'.format(task['name'], e),
+                                  RuntimeWarning, stacklevel=1)
+                    return func(*args, **kwargs)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    profile.disable()
+                    # written after each action, so failed tasks have theirs
+                    profile.dump_stats(profiler.stats_fn(task['name']))
+            return func_profiled
+
+        def wrap_python_action(action):
+            if isinstance(action, PythonAction):
+                action.py_callable = profile_function(action.py_callable)
+            elif isinstance(action, tuple) and action and callable(action[0]):
+                action = (profile_function(action[0]),) + action[1:]
+            elif callable(action):
+                action = profile_function(action)
+            return action
+
         def stop_profiling():
             if profiler.running:
+                span_stacks.names = []
                 elapsed = timer.stop()
                 profiler.write_result(task['name'], timer.start_time,
-                                      timer.end_time, elapsed)
+                                      timer.end_time, elapsed,
+                                      usage=timer.usage)
         
         if isinstance(task, DoitTask):
             actions = task._actions
@@ -144,6 +558,7 @@ def setup_profiler():
             actions = task['actions']
             task['title'] = title_without_profile_actions
 
+        actions[:] = [wrap_python_action(action) for action in actions]
         actions.insert(0, start_profiling)
         actions.append(stop_profiling)
 
@@ -158,7 +573,7 @@ def setup_profiler():
         
         return func
 
-    return profiler_manager, profile_decorator
+    return profiler_manager, profile_decorator, span
 
-StartProfiler, profile_task = setup_profiler()
+StartProfiler, profile_task, span = setup_profiler()
 
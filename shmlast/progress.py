@@ -0,0 +1,484 @@
+'''Progress reports for long-running steps.
+
+While a run is being reported on, the steps which can take hours report how
+far along they are: translation and renaming count the records and bytes of
+their input, the parsers count alignments, and lastal, which can't report
+for itself, is watched through the growth of its output. Every interval,
+the reporter prints a line for each running step, with its rates and an
+estimated time left, and optionally writes the same as JSON to a status
+file, so that a slow run can be told apart from a hung one.
+
+lastal's progress is estimated from the numbered names shmlast gives the
+sequences (tr0, tr1, ... and db0, db1, ...): the query named last in the
+output, against the first and last names in the query file. Alignment
+parsing estimates its total the same way.
+'''
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+from doit.reporter import ConsoleReporter
+
+
+# seconds between reports
+PROGRESS_INTERVAL = 30.0
+
+# bytes read from the end of a file to find its last sequence name
+TAIL_BYTES = 65536
+
+NUMBERED_NAME = re.compile(r'([A-Za-z]+)(\d+)')
+
+
+def name_number(name):
+    '''Split a numbered sequence name, such as tr12 or its frame tr12_3,
+    into its prefix and number.
+
+    Returns:
+        tuple: The prefix and number, or (None, None) if the name isn't
+            numbered.
+    '''
+
+    match = NUMBERED_NAME.match(name)
+    if match is None:
+        return None, None
+    return match.group(1), int(match.group(2))
+
+
+def read_tail(filename, n_bytes=TAIL_BYTES):
+    '''Get the complete lines among the last n_bytes of a file.
+    '''
+
+    with open(filename, 'rb') as fp:
+        fp.seek(0, os.SEEK_END)
+        size = fp.tell()
+        fp.seek(max(0, size - n_bytes))
+        data = fp.read().decode('utf-8', 'replace')
+    lines = data.split('\n')
+    # the first line may be cut off, and the last may be half written
+    if size > n_bytes:
+        lines = lines[1:]
+    return lines[:-1]
+
+
+def fasta_numbers(fasta_fn):
+    '''Get the prefix, first number and last number of the numbered names
+    in a FASTA file.
+
+    Returns:
+        tuple: (prefix, first, last), or None if the names aren't numbered.
+    '''
+
+    with open(fasta_fn) as fp:
+        prefix, first = name_number(fp.readline().lstrip('>'))
+    headers = [line for line in read_tail(fasta_fn) if line.startswith('>')]
+    if prefix is None or not headers:
+        return None
+    last_prefix, last = name_number(headers[-1][1:])
+    if last_prefix != prefix:
+        return None
+    return prefix, first, last
+
+
+def last_query_number(aln_fn, prefix):
+    '''Get the number of the query named last in lastal's MAF or tabular
+    output.
+
+    Args:
+        aln_fn (str): The alignment file.
+        prefix (str): The prefix of the query names, which tells them from
+            the subject names.
+    Returns:
+        int: The number, or None if no query is found.
+    '''
+
+    for line in reversed(read_tail(aln_fn)):
+        fields = line.split()
+        if line.startswith('s '):
+            name = fields[1]
+        elif line[:1].isdigit() and len(fields) > 6:
+            name = fields[6]
+        else:
+            continue
+        name_prefix, number = name_number(name)
+        if name_prefix == prefix:
+            return number
+    return None
+
+
+def format_bytes(n_bytes):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(n_bytes) < 1024.0:
+            return '{0:.1f} {1}'.format(n_bytes, unit)
+        n_bytes /= 1024.0
+    return '{0:.1f} TB'.format(n_bytes)
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+class Progress(object):
+    '''The progress of one step: the records and bytes it has done, out of
+    their totals when they are known.
+    '''
+
+    def __init__(self, name, unit='records', total=None, total_bytes=None):
+        self.name = name
+        self.unit = unit
+        self.total = total
+        self.total_bytes = total_bytes
+        self.done = 0
+        self.bytes_done = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+    def update(self, n=0, n_bytes=0):
+        '''Count records and bytes done.
+        '''
+        self.done += n
+        self.bytes_done += n_bytes
+
+    def poll(self):
+        '''Bring the counts up to date before a report; for steps which are
+        watched rather than counted.
+        '''
+        pass
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def fraction(self):
+        '''Get the fraction done, from the records if their total is known,
+        else from the bytes, or None.
+        '''
+        if self.total:
+            return min(1.0, float(self.done) / self.total)
+        if self.total_bytes:
+            return min(1.0, float(self.bytes_done) / self.total_bytes)
+        return None
+
+    def status(self):
+        '''Get the progress as a dict, with rates per second, the estimated
+        seconds left and whether the step has finished.
+        '''
+
+        end_time = self.end_time if self.end_time is not None else time.time()
+        elapsed = max(end_time - self.start_time, 1e-9)
+        fraction = self.fraction()
+        eta = None
+        if self.end_time is None and fraction:
+            eta = elapsed * (1 - fraction) / fraction
+        return OrderedDict([('name', self.name),
+                            ('unit', self.unit),
+                            ('done', self.done),
+                            ('total', self.total),
+                            ('bytes_done', self.bytes_done),
+                            ('total_bytes', self.total_bytes),
+                            ('elapsed_s', elapsed),
+                            ('per_s', self.done / elapsed),
+                            ('bytes_per_s', self.bytes_done / elapsed),
+                            ('fraction', fraction),
+                            ('eta_s', eta),
+                            ('finished', self.end_time is not None)])
+
+
+def format_status(status):
+    '''Format a Progress status as one line.
+    '''
+
+    parts = ['{0:,} {1}'.format(status['done'], status['unit'])]
+    if status['total']:
+        parts[0] = '{0:,}/{1:,} {2}'.format(status['done'], status['total'],
+                                            status['unit'])
+    parts[0] += ' ({0:,.0f}/s)'.format(status['per_s'])
+    if status['bytes_done']:
+        size = format_bytes(status['bytes_done'])
+        if status['total_bytes']:
+            size += ' of ' + format_bytes(status['total_bytes'])
+        parts.append('{0} ({1}/s)'.format(size,
+                                          format_bytes(status['bytes_per_s'])))
+    if status['finished']:
+        parts.append('done in ' + format_seconds(status['elapsed_s']))
+    else:
+        if status['fraction'] is not None:
+            parts.append('{0:.0%}'.format(status['fraction']))
+        if status['eta_s'] is not None:
+            parts.append('ETA ' + format_seconds(status['eta_s']))
+    return '[progress] {0}: {1}'.format(status['name'], ', '.join(parts))
+
+
+class AlignmentWatcher(Progress):
+    '''The progress of lastal, estimated from its output.
+
+    The queries done are estimated from the number of the query named last
+    in the output, so the estimate is rough when lastal is split over
+    several processes, which each write their own stretch of the queries.
+    '''
+
+    def __init__(self, name, query_fn, output_fn):
+        super(AlignmentWatcher, self).__init__(name, unit='queries')
+        self.query_fn = query_fn
+        self.output_fn = output_fn
+        self.numbers = None
+
+    def poll(self):
+        if self.numbers is None and os.path.isfile(self.query_fn):
+            self.numbers = fasta_numbers(self.query_fn) or ()
+            if self.numbers:
+                _, first, last = self.numbers
+                self.total = last - first + 1
+        if not os.path.isfile(self.output_fn):
+            return
+        self.bytes_done = os.path.getsize(self.output_fn)
+        if self.numbers:
+            prefix, first, _ = self.numbers
+            number = last_query_number(self.output_fn, prefix)
+            if number is not None:
+                self.done = max(self.done, number - first + 1)
+
+
+class ParseProgress(Progress):
+    '''The progress of parsing lastal output, with the total number of
+    alignments estimated from how far through the numbered queries the
+    parser is.
+    '''
+
+    def __init__(self, aln_fn):
+        super(ParseProgress, self).__init__('parse:' + aln_fn,
+                                            unit='alignments')
+        self.aln_fn = aln_fn
+        self.numbers = None
+
+    def update_chunk(self, n, first_name, last_name):
+        '''Count a chunk of alignments.
+
+        Args:
+            n (int): Alignments in the chunk.
+            first_name (str): Query name of its first alignment.
+            last_name (str): Query name of its last alignment.
+        '''
+
+        self.update(n)
+        if self.numbers is None:
+            prefix, first = name_number(first_name)
+            last = last_query_number(self.aln_fn, prefix) \
+                   if prefix is not None else None
+            self.numbers = (first, last) if last is not None else ()
+        if self.numbers:
+            first, last = self.numbers
+            _, number = name_number(last_name)
+            if number is not None and number >= first:
+                self.total = int(self.done * float(last - first + 1) /
+                                 (number - first + 1))
+
+
+class ProgressReporter(object):
+    '''Report the progress of the running steps every interval, to a stream
+    and optionally to a JSON status file.
+    '''
+
+    def __init__(self):
+        self.running = False
+        self.stages = OrderedDict()
+        self.finished = []
+        self.stages_lock = threading.Lock()
+
+    def start(self, interval=PROGRESS_INTERVAL, status_fn=None,
+              stream=sys.stderr):
+        '''Start reporting.
+
+        Args:
+            interval (float): Seconds between reports.
+            status_fn (str): If given, a JSON file rewritten with the
+                progress of each step at every report.
+            stream (file): Where the report lines are written; None to
+                write only the status file.
+        '''
+
+        self.interval = interval
+        self.status_fn = status_fn
+        self.stream = stream
+        self.stages = OrderedDict()
+        self.finished = []
+        self.stopping = threading.Event()
+        self.running = True
+        self.thread = threading.Thread(target=self._report_loop,
+                                       name='shmlast-progress')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _report_loop(self):
+        while not self.stopping.wait(self.interval):
+            self.report()
+
+    def stop(self):
+        '''Stop reporting, and write the status file a last time.
+        '''
+        if not self.running:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.running = False
+        with self.stages_lock:
+            for progress in self.stages.values():
+                progress.finish()
+                self.finished.append(progress.status())
+            self.stages.clear()
+        self.write_status([])
+
+    def add(self, progress):
+        if self.running:
+            with self.stages_lock:
+                self.stages[id(progress)] = progress
+
+    def remove(self, progress):
+        '''Stop reporting on a step, and report it as finished.
+        '''
+        try:
+            progress.poll()
+        except (IOError, OSError):
+            pass
+        progress.finish()
+        if not self.running:
+            return
+        with self.stages_lock:
+            if self.stages.pop(id(progress), None) is None:
+                return
+            status = progress.status()
+            self.finished.append(status)
+        if self.stream is not None:
+            print(format_status(status), file=self.stream)
+
+    def report(self):
+        '''Report the progress of each running step.
+        '''
+
+        with self.stages_lock:
+            stages = list(self.stages.values())
+        statuses = []
+        for progress in stages:
+            try:
+                progress.poll()
+            except (IOError, OSError):
+                # the output may be replaced while it's read
+                pass
+            statuses.append(progress.status())
+        if self.stream is not None:
+            for status in statuses:
+                print(format_status(status), file=self.stream)
+            self.stream.flush()
+        self.write_status(statuses)
+
+    def write_status(self, statuses):
+        if self.status_fn is None:
+            return
+        with self.stages_lock:
+            finished = list(self.finished)
+        tmp_fn = '{0}.tmp{1}'.format(self.status_fn, os.getpid())
+        with open(tmp_fn, 'w') as fp:
+            json.dump({'time': time.time(), 'running': statuses,
+                       'finished': finished}, fp, indent=1)
+        os.replace(tmp_fn, self.status_fn)
+
+
+reporter = ProgressReporter()
+
+
+@contextmanager
+def StartProgress(interval=None, status_fn=None, stream=sys.stderr):
+    '''Report progress while the block runs. Does nothing unless an interval
+    or a status file is given.
+    '''
+
+    if interval is None and status_fn is None:
+        yield reporter
+        return
+    reporter.start(interval=interval or PROGRESS_INTERVAL, status_fn=status_fn,
+                   stream=stream)
+    try:
+        yield reporter
+    finally:
+        reporter.stop()
+
+
+@contextmanager
+def track(progress):
+    '''Report on a Progress while the block runs, if reporting is on.
+    '''
+
+    reporter.add(progress)
+    try:
+        yield progress
+    finally:
+        reporter.remove(progress)
+
+
+def record_bytes(record):
+    # the approximate size of a FASTA record, from a screed record or a
+    # (name, sequence) tuple
+    if isinstance(record, tuple):
+        name, sequence = record
+    else:
+        name, sequence = record.name, record.sequence
+    return len(name) + len(sequence) + 3
+
+
+def track_records(records, name, filename=None):
+    '''Count FASTA records as they pass, reporting on them as a step.
+
+    Args:
+        records (iterable): screed records or (name, sequence) tuples.
+        name (str): Name of the step.
+        filename (str): The file the records are read from, whose size is
+            the total.
+    Yields:
+        The records.
+    '''
+
+    total_bytes = os.path.getsize(filename) if filename is not None else None
+    with track(Progress(name, total_bytes=total_bytes)) as progress:
+        for record in records:
+            progress.update(1, record_bytes(record))
+            yield record
+
+
+class ProgressConsoleReporter(ConsoleReporter):
+    '''doit's console reporter, which also watches the output of the tasks
+    with progress meta data while they run. A task with
+    'meta': {'progress': {'query_fn': ..., 'output_fn': ...}} is watched
+    with an AlignmentWatcher.
+    '''
+
+    def __init__(self, outstream, options):
+        super(ProgressConsoleReporter, self).__init__(outstream, options)
+        self.watchers = {}
+
+    def execute_task(self, task):
+        super(ProgressConsoleReporter, self).execute_task(task)
+        watch = (task.meta or {}).get('progress')
+        if reporter.running and watch is not None:
+            watcher = AlignmentWatcher(task.name, watch['query_fn'],
+                                       watch['output_fn'])
+            self.watchers[task.name] = watcher
+            reporter.add(watcher)
+
+    def _stop_watching(self, task):
+        watcher = self.watchers.pop(task.name, None)
+        if watcher is not None:
+            reporter.remove(watcher)
+
+    def add_success(self, task):
+        self._stop_watching(task)
+        super(ProgressConsoleReporter, self).add_success(task)
+
+    def add_failure(self, task, exception):
+        self._stop_watching(task)
+        super(ProgressConsoleReporter, self).add_failure(task, exception)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+'''Sharded lastal execution.
+
+The query FASTA is split into shards of consecutive records, each shard is
+aligned by its own pydoit task with its own output file, and the shard
+outputs are concatenated in order. Since E-values don't depend on the
+number of queries searched, the merged alignments are the same as those of
+a single lastal run. An interrupted alignment is resumed from the shards
+that hadn't finished.
+
+How the shard commands are run is up to a Submitter: LocalSubmitter runs
+them as local processes, and CommandTemplateSubmitter wraps them in a
+command for a cluster scheduler. The shards only run at the same time if
+pydoit runs tasks in parallel, which the apps do when sharding.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import shlex
+import subprocess
+
+from doit.exceptions import TaskFailed
+from doit.task import clean_targets
+from doit.tools import config_changed
+
+from .last import LASTDB_CFG, lastal_cmd, lastal_uptodate
+from .profile import profile_task
+from .util import create_doit_task as doit_task
+from .util import ShortenedPythonAction, title
+
+
+class Submitter(object):
+
+    def __init__(self, max_workers=1):
+        '''Base class for running shard commands.
+
+        Commands are submitted to a pool of at most max_workers threads,
+        each of which runs one command at a time and waits for it.
+        Subclasses override command() to change what is run.
+
+        Args:
+            max_workers (int): Most commands to run at once.
+        '''
+
+        self.max_workers = max_workers
+        self._executor = None
+
+    def command(self, cmd, name, n_threads):
+        '''Get the shell command to run for a job.
+
+        Args:
+            cmd (str): The job's shell command.
+            name (str): A name for the job.
+            n_threads (int): Threads the job uses.
+        Returns:
+            str: The command to run.
+        '''
+        return cmd
+
+    def job_threads(self, n_threads, n_jobs):
+        '''Get the threads for each of n_jobs jobs, given n_threads in all.
+        '''
+        return n_threads
+
+    def submit(self, cmd, name, n_threads=1):
+        '''Submit a job.
+
+        Returns:
+            concurrent.futures.Future: The future exit status of the job.
+        '''
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor.submit(subprocess.call,
+                                     self.command(cmd, name, n_threads),
+                                     shell=True)
+
+    def run(self, cmd, name, n_threads=1):
+        '''Run a job and wait for it, as a pydoit Python action.
+
+        Returns:
+            TaskFailed: If the job failed; None otherwise.
+        '''
+
+        status = self.submit(cmd, name, n_threads=n_threads).result()
+        if status != 0:
+            return TaskFailed('{0} exited with status {1}'.format(name, status))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
+
+
+class LocalSubmitter(Submitter):
+
+    def job_threads(self, n_threads, n_jobs):
+        # the threads are shared by the jobs that run at once
+        return max(1, n_threads // min(n_jobs, self.max_workers))
+
+
+class CommandTemplateSubmitter(Submitter):
+
+    def __init__(self, template, max_workers=64):
+        '''Run each job through a command for a cluster scheduler, which
+        must wait for the job to finish and exit with its status.
+
+        The template is formatted with {cmd}, the shell-quoted job command;
+        {name}, the job name; and {threads}, its thread count. For example,
+        for SLURM:
+
+            sbatch --wait -J {name} -c {threads} --wrap {cmd}
+
+        Args:
+            template (str): The command template.
+            max_workers (int): Most jobs to have submitted at once.
+        '''
+
+        if '{cmd}' not in template:
+            raise ValueError('Submit template must contain {cmd}')
+        self.template = template
+        super(CommandTemplateSubmitter, self).__init__(max_workers=max_workers)
+
+    def command(self, cmd, name, n_threads):
+        return self.template.format(cmd=shlex.quote(cmd),
+                                    name=shlex.quote(name),
+                                    threads=n_threads)
+
+
+def shard_fns(input_fn, n_shards):
+    return ['{0}.shard{1}of{2}'.format(input_fn, i, n_shards)
+            for i in range(n_shards)]
+
+
+def split_fasta(input_fn, output_fns):
+    '''Split a FASTA file into files of consecutive records with about
+    the same number of letters each.
+
+    Args:
+        input_fn (str): The FASTA file.
+        output_fns (list): The destination files, in order. Some may be
+            empty if there are fewer records than files.
+    '''
+
+    import screed
+
+    total = sum(len(record.sequence) for record in screed.open(input_fn))
+    per_shard = float(total) / len(output_fns)
+
+    fps = [open(fn, 'w') for fn in output_fns]
+    try:
+        written = 0
+        for record in screed.open(input_fn):
+            # the shard which the middle of the record falls in
+            middle = written + len(record.sequence) / 2.0
+            shard = min(int(middle / per_shard) if per_shard else 0,
+                        len(fps) - 1)
+            fps[shard].write('>{0}\n{1}\n'.format(record.name, record.sequence))
+            written += len(record.sequence)
+    finally:
+        for fp in fps:
+            fp.close()
+
+
+def merge_alignments(aln_fns, out_fn):
+    '''Concatenate lastal outputs, keeping the header comments only from
+    the first.
+
+    Args:
+        aln_fns (list): The alignment files, in order.
+        out_fn (str): Destination file.
+    '''
+
+    with open(out_fn, 'w') as out_fp:
+        for n, aln_fn in enumerate(aln_fns):
+            with open(aln_fn) as fp:
+                for line in fp:
+                    if n == 0 or not line.startswith('#'):
+                        out_fp.write(line)
+
+
+@doit_task
+@profile_task
+def split_fasta_task(input_fn, n_shards):
+    '''Create a pydoit task to split a FASTA file into shards.
+
+    Args:
+        input_fn (str): The FASTA file.
+        n_shards (int): Number of shards.
+    Returns:
+        dict: A pydoit task.
+    '''
+
+    output_fns = shard_fns(input_fn, n_shards)
+    return {'name': 'split_shards:{0}'.format(os.path.basename(input_fn)),
+            'title': title,
+            'actions': [ShortenedPythonAction(split_fasta,
+                                              args=[input_fn, output_fns])],
+            'file_dep': [input_fn],
+            'targets': output_fns,
+            'uptodate': [config_changed({'n_shards': n_shards})],
+            'clean': [clean_targets]}
+
+
+@doit_task
+@profile_task
+def lastal_shard_task(query_shard, db, out_fn, submitter=None, n_threads=1,
+                      db_params=LASTDB_CFG['params'], **lastal_kwds):
+    '''Create a pydoit task to run lastal on one shard of the queries.
+
+    Args:
+        query_shard (str): The shard of the query FASTA.
+        db (str): The database file prefix.
+        out_fn (str): Destination file for the shard's alignments.
+        submitter (Submitter): Runs the command; if None, pydoit runs it.
+        n_threads (int): Number of threads for the shard.
+        db_params (list): The lastdb parameters of the database, as for
+            lastal_task.
+        lastal_kwds: Passed to lastal_cmd.
+    Returns:
+        dict: A pydoit task.
+    '''
+
+    cmd = lastal_cmd(query_shard, db, out_fn, n_threads=n_threads,
+                     **lastal_kwds)
+    name = 'lastal:{0}'.format(out_fn)
+    if submitter is None:
+        action = cmd
+    else:
+        action = ShortenedPythonAction(submitter.run,
+                                       args=[cmd, os.path.basename(out_fn),
+                                             n_threads])
+
+    return {'name': name,
+            'title': title,
+            'actions': [action],
+            'targets': [out_fn],
+            'file_dep': [query_shard, db + '.prj'],
+            'uptodate': [lastal_uptodate(lastal_kwds.get('params'), db_params)],
+            'meta': {'progress': {'query_fn': query_shard,
+                                  'output_fn': out_fn}},
+            'clean': [clean_targets]}
+
+
+@doit_task
+@profile_task
+def merge_alignments_task(aln_fns, out_fn):
+    '''Create a pydoit task to merge shard alignments.
+
+    Args:
+        aln_fns (list): The shard alignment files, in order.
+        out_fn (str): Destination file.
+    Returns:
+        dict: A pydoit task.
+    '''
+
+    return {'name': 'merge_shards:{0}'.format(out_fn),
+            'title': title,
+            'actions': [ShortenedPythonAction(merge_alignments,
+                                              args=[aln_fns, out_fn])],
+            'file_dep': aln_fns,
+            'targets': [out_fn],
+            'clean': [clean_targets]}
+
+
+def sharded_lastal_tasks(query, db, out_fn, n_shards, submitter=None,
+                         n_threads=1, **lastal_kwds):
+    '''Get the tasks to align the shards of a query FASTA, split by
+    split_fasta_task, and merge their alignments.
+
+    Args:
+        query (str): The query FASTA.
+        db (str): The database file prefix.
+        out_fn (str): Destination file for the merged alignments.
+        n_shards (int): Number of shards.
+        submitter (Submitter): Runs the shard commands; if None, pydoit runs
+            them.
+        n_threads (int): Total number of threads, divided among the shards
+            by the submitter.
+        lastal_kwds: Passed to lastal_shard_task.
+    Yields:
+        doit.task.Task: The shard tasks, then the merge task.
+    '''
+
+    if submitter is not None:
+        n_threads = submitter.job_threads(n_threads, n_shards)
+    else:
+        n_threads = max(1, n_threads // n_shards)
+
+    aln_fns = shard_fns(out_fn, n_shards)
+    for shard_fn, aln_fn in zip(shard_fns(query, n_shards), aln_fns):
+        yield lastal_shard_task(shard_fn, db, aln_fn, submitter=submitter,
+                                n_threads=n_threads, **lastal_kwds)
+    yield merge_alignments_task(aln_fns, out_fn)
@@ -0,0 +1,115 @@
+import pytest
+
+from shmlast.app import RBL, CRBL
+from shmlast.last import LastConfig
+from shmlast.shard import CommandTemplateSubmitter
+
+
+@pytest.fixture
+def fake_last(monkeypatch):
+    monkeypatch.setattr('shmlast.last.which', lambda program: program)
+
+
+def lastal_threads(app):
+    threads = {}
+    for tsk in app.tasks():
+        if tsk.name.startswith('lastal:'):
+            action = tsk.actions[1]
+            # sharded alignments are run by a submitter
+            cmd = action.args[0] if hasattr(action, 'args') else action.action
+            tokens = cmd.split()
+            threads[tsk.name] = int(tokens[tokens.index('-j') + 1])
+    return threads
+
+
+def test_rbl_serial(tmpdir, fake_last):
+    with tmpdir.as_cwd():
+        rbl = RBL('query.fa', 'db.fa', n_threads=8)
+
+        assert 'num_process' not in rbl.doit_config
+        assert rbl.translate_threads() == 8
+        assert list(lastal_threads(rbl).values()) == [8, 8]
+
+
+@pytest.mark.parametrize('n_jobs,expected', [(2, 4), (4, 4), (3, 4)])
+def test_rbl_jobs_share_threads(tmpdir, fake_last, n_jobs, expected):
+    with tmpdir.as_cwd():
+        rbl = RBL('query.fa', 'db.fa', n_threads=8, n_jobs=n_jobs)
+
+        assert rbl.doit_config['num_process'] == n_jobs
+        assert rbl.doit_config['par_type'] == 'thread'
+        assert rbl.translate_threads() == 7
+        assert list(lastal_threads(rbl).values()) == [expected, expected]
+
+
+def test_crbl_skip_rbh_jobs(tmpdir, fake_last):
+    with tmpdir.as_cwd():
+        crbl = CRBL('query.fa', 'db.fa', n_threads=8, n_jobs=2,
+                    saved_model_fn='model.csv', skip_rbh=True)
+
+        # the only alignment gets all the threads
+        assert list(lastal_threads(crbl).values()) == [8]
+
+
+def test_submitter_without_shards(tmpdir, fake_last):
+    submitter = CommandTemplateSubmitter('sbatch --wait -c {threads} '
+                                         '--wrap {cmd}')
+    with tmpdir.as_cwd():
+        rbl = RBL('query.fa', 'db.fa', n_threads=8, submitter=submitter)
+        lastal_tsks = [tsk for tsk in rbl.tasks()
+                       if tsk.name.startswith('lastal:')]
+
+    # each whole alignment is submitted as one job, with all the threads
+    assert len(lastal_tsks) == 2
+    for tsk in lastal_tsks:
+        assert tsk.actions[1].py_callable.__name__ == 'run'
+    assert list(lastal_threads(rbl).values()) == [8, 8]
+    assert not any(tsk.name.startswith('split_shards:') for tsk in rbl.tasks())
+
+
+def test_sharded_jobs(tmpdir, fake_last):
+    with tmpdir.as_cwd():
+        rbl = RBL('query.fa', 'db.fa', n_threads=8, n_shards=4)
+        assert rbl.doit_config['num_process'] == 4
+        assert set(lastal_threads(rbl).values()) == {2}
+
+        rbl = RBL('query.fa', 'db.fa', n_threads=8, n_shards=4, n_jobs=2)
+        assert rbl.doit_config['num_process'] == 2
+        assert set(lastal_threads(rbl).values()) == {4}
+
+
+def test_last_config(tmpdir, fake_last):
+    with tmpdir.as_cwd():
+        rbl = RBL('query.fa', 'db.fa', n_shards=2,
+                  last_config=LastConfig('sensitive'))
+        tasks = list(rbl.tasks())
+
+        lastdb_cmds = [tsk.actions[1].action for tsk in tasks
+                       if tsk.name.startswith('lastdb:')]
+        assert len(lastdb_cmds) == 2
+        assert all(' -w1 ' in cmd for cmd in lastdb_cmds)
+
+        lastal_cmds = [tsk.actions[1].args[0] for tsk in tasks
+                       if tsk.name.startswith('lastal:')]
+        assert len(lastal_cmds) == 4
+        assert all(' -m100 ' in cmd for cmd in lastal_cmds)
+
+
+def test_rename_and_translate_tasks(tmpdir, fake_last):
+    with tmpdir.as_cwd():
+        rbl = RBL('query.fa', 'db.fa')
+        fused = rbl.rename_translate_transcriptome_task()
+
+        for tsk in (rbl.rename_transcriptome_task(), rbl.translate_task()):
+            assert tsk.name == fused.name
+            assert rbl.renamed_query_fn in tsk.targets
+            assert rbl.translated_query_fn in tsk.targets
+
+
+@pytest.mark.parametrize('n_shards', [1, 4])
+def test_align_tasks(tmpdir, fake_last, n_shards):
+    with tmpdir.as_cwd():
+        rbl = RBL('query.fa', 'db.fa', n_shards=n_shards)
+
+        assert rbl.align_transcriptome_task().targets == [rbl.query_x_db_fn]
+        assert rbl.align_database_task().targets == [rbl.db_x_query_fn]
@@ -0,0 +1,81 @@
+import pandas as pd
+import pytest
+import screed
+
+from shmlast.bench import (synthetic_dataset, read_stage_times, count_hits,
+                           benchmark_configs, summarize_benchmark,
+                           RESULT_COLUMNS)
+from shmlast.translate import translate_numpy
+
+
+def test_synthetic_dataset(tmpdir):
+    files = synthetic_dataset(tmpdir.join('data').strpath, n_proteins=20,
+                              n_decoys=5, ortholog_fraction=0.5,
+                              max_divergence=0, seed=2)
+
+    proteins = {r.name: r.sequence for r in screed.open(files['database_fn'])}
+    transcripts = {r.name: r.sequence for r in screed.open(files['query_fn'])}
+    truth_df = pd.read_csv(files['truth_fn'])
+
+    assert len(proteins) == 20
+    assert len(transcripts) == 15
+    assert len(truth_df) == 10
+    # without divergence, each transcript encodes its protein exactly
+    for q_name, s_name in truth_df.itertuples(index=False):
+        assert any(proteins[s_name] in frame
+                   for frame in translate_numpy(transcripts[q_name]))
+
+    again = synthetic_dataset(tmpdir.join('again').strpath, n_proteins=20,
+                              n_decoys=5, ortholog_fraction=0.5,
+                              max_divergence=0, seed=2)
+    assert open(again['query_fn']).read() == open(files['query_fn']).read()
+
+
+def test_read_stage_times(tmpdir):
+    profile_fn = tmpdir.join('profile.csv')
+    profile_fn.write('run_id,block,start_t,end_t,elapsed_t\n'
+                     'x,lastdb:db,0,1,1.0\n'
+                     'x,lastal:out,1,3,2.0\n'
+                     'x,__main__,0,3,3.5\n')
+
+    assert read_stage_times(profile_fn.strpath) == {'lastdb:db': 1.0,
+                                                    'lastal:out': 2.0,
+                                                    'total': 3.5}
+
+
+def test_count_hits(tmpdir):
+    output_fn = tmpdir.join('out.csv')
+    output_fn.write('q_name,s_name,E\ntx0,prot0,1e-10\ntx1,prot5,1e-8\n'
+                    'decoy0,prot2,1e-6\n')
+    truth_fn = tmpdir.join('truth.csv')
+    truth_fn.write('q_name,s_name\ntx0,prot0\ntx1,prot1\n')
+
+    assert count_hits(output_fn.strpath) == {'n_hits': 3}
+    counts = count_hits(output_fn.strpath, truth_fn.strpath)
+    assert counts['n_true'] == 1
+    assert counts['recall'] == 0.5
+    assert counts['precision'] == pytest.approx(1 / 3.)
+
+
+def test_benchmark_configs(tmpdir):
+    configs = list(benchmark_configs('q.fa', 'db.fa', tmpdir.strpath,
+                                     methods=['crbl'],
+                                     presets=['fast', 'sensitive'],
+                                     threads=[1, 4], reps=2))
+
+    assert len(configs) == 8
+    assert len(set(config['run_dir'] for config in configs)) == 8
+    assert configs[0]['truth_fn'] is None
+
+
+def test_summarize_benchmark():
+    rows = []
+    for rep, seconds in enumerate([10.0, 20.0, 60.0]):
+        run = ['rbl', 'fast', 2, rep]
+        rows.append(run + ['lastal:out', 'seconds', seconds - 1])
+        rows.append(run + ['total', 'seconds', seconds])
+        rows.append(run + ['all', 'n_hits', 100 + rep])
+    summary = summarize_benchmark(pd.DataFrame(rows, columns=RESULT_COLUMNS))
+
+    assert summary.loc[('rbl', 'fast', 2), 'total_seconds'] == 20.0
+    assert summary.loc[('rbl', 'fast', 2), 'n_hits'] == 101
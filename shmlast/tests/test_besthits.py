@@ -1,10 +1,19 @@
+import numpy as np
 import pytest
 import pandas as pd
 
-from shmlast.tests.utils import datadir, run_task, run_tasks
+from shmlast.tests.utils import (datadir, run_task, run_tasks, write_maf,
+                                 write_last_tab)
 from shmlast.hits import BestHits
-from shmlast.crbl import scale_evalues
+from shmlast.alignments import cache_alignments
+from shmlast.crbl import (scale_evalues, get_reciprocal_best_last_translated,
+                          streaming_reciprocal_best_last_translated,
+                          select_hits, iter_hits_frames, query_hits_frame,
+                          window_means, fit_crbh_model,
+                          filter_hits_from_model, save_crbh_model,
+                          load_crbh_model)
 from shmlast.app  import CRBL
+from shmlast.names import NameMapWriter
 
 
 def check_df_equals(dfA, dfB, col='E'):
@@ -55,6 +64,163 @@ def test_reciprocal_best_hits(datadir):
     assert check_df_equals(results_df, expected_df)
 
 
+@pytest.mark.parametrize('comparison_cols', [['E'], ['E', 'EG2'], ['EG2', 'E']])
+def test_besthits_hash(datadir, comparison_cols):
+    input_df = pd.read_csv(datadir('query.maf.csv'))
+    expected_df = BestHits(comparison_cols=comparison_cols).best_hits(input_df.copy())
+    results_df = BestHits(comparison_cols=comparison_cols,
+                          method='hash').best_hits(input_df)
+
+    assert list(results_df['ID']) == list(expected_df['ID'])
+    assert list(results_df.columns) == list(expected_df.columns)
+
+
+def test_besthits_hash_ties():
+    input_df = pd.DataFrame({'q_name': ['b', 'a', 'b', 'a', 'b', None],
+                             'E':      [1.0, 2.0, 0.5, 2.0, 0.5, 1.0],
+                             'EG2':    [1.0, 3.0, 2.0, 1.0, 2.0, 1.0],
+                             'ID':     [0, 1, 2, 3, 4, 5]})
+    bh = BestHits(comparison_cols=['E', 'EG2'], method='hash')
+    results_df = bh.best_hits(input_df)
+    expected_df = BestHits(comparison_cols=['E', 'EG2']).best_hits(input_df.copy())
+
+    assert list(results_df['ID']) == [3, 2, 5]
+    assert list(results_df['ID']) == list(expected_df['ID'])
+    assert len(bh.best_hits(input_df.iloc[:0])) == 0
+
+
+def test_besthits_bad_method():
+    with pytest.raises(ValueError):
+        BestHits(method='nope')
+
+
+def test_reduce_best_hits(datadir):
+    input_df = pd.read_csv(datadir('query.maf.csv'))
+    expected_df = BestHits().best_hits(input_df.copy(), inplace=True)
+
+    chunks = [input_df.iloc[i:i+5].copy() for i in range(0, len(input_df), 5)]
+    results_df = BestHits().reduce_best_hits(chunks)
+
+    assert list(results_df['ID']) == list(expected_df['ID'])
+
+
+def random_best_hits_input(n_alignments, n_queries, seed=0):
+    random_state = np.random.RandomState(seed)
+    q_idx = random_state.randint(0, n_queries, n_alignments)
+    return pd.DataFrame({'q_name': ['tr{0}'.format(i) for i in q_idx],
+                         's_name': 'db0',
+                         'E': random_state.randint(0, 5, n_alignments) / 10.0,
+                         'EG2': random_state.randint(0, 3, n_alignments) / 10.0,
+                         'ID': np.arange(n_alignments)})
+
+
+@pytest.mark.parametrize('name_prefixes', [None, ('tr', 'db')])
+@pytest.mark.parametrize('chunksize', [1, 37, 1000])
+def test_reduce_best_hits_ties(name_prefixes, chunksize):
+    input_df = random_best_hits_input(2000, 150)
+    bh = BestHits(comparison_cols=['E', 'EG2'], method='hash',
+                  name_prefixes=name_prefixes)
+    expected_df = bh.best_hits(input_df.copy())
+
+    chunks = [input_df.iloc[i:i+chunksize].copy()
+              for i in range(0, len(input_df), chunksize)]
+    results_df = bh.reduce_best_hits(chunks)
+
+    assert list(results_df['ID']) == list(expected_df['ID'])
+    assert list(results_df['q_name']) == list(expected_df['q_name'])
+
+
+@pytest.mark.benchmark(group='reduce-best-hits')
+def test_reduce_best_hits_chunks(benchmark):
+    input_df = random_best_hits_input(300000, 20000)
+    bh = BestHits(comparison_cols=['E', 'EG2'], method='hash',
+                  name_prefixes=('tr', 'db'))
+    chunks = [input_df.iloc[i:i+10000] for i in range(0, len(input_df), 10000)]
+
+    results_df = benchmark.pedantic(bh.reduce_best_hits, args=(chunks,),
+                                    rounds=3, iterations=1)
+
+    assert list(results_df['ID']) == list(bh.best_hits(input_df)['ID'])
+
+
+@pytest.fixture(params=['maf', 'tab', 'parquet'])
+def maf_pair(request, tmpdir, datadir):
+    writer = write_last_tab if request.param == 'tab' else write_maf
+    ext = 'tab' if request.param == 'tab' else 'maf'
+    with tmpdir.as_cwd():
+        query_maf = tmpdir.join('query.' + ext).strpath
+        db_maf = tmpdir.join('db.' + ext).strpath
+        writer(pd.read_csv(datadir('query.maf.csv')), query_maf,
+               q_name_col='translated_q_name')
+        writer(pd.read_csv(datadir('db.maf.csv')), db_maf,
+               s_name_col='translated_s_name')
+
+    if request.param == 'parquet':
+        pytest.importorskip('pyarrow')
+        for aln_fn in (query_maf, db_maf):
+            cache_alignments(aln_fn, aln_fn + '.parquet', chunksize=5)
+        query_maf, db_maf = query_maf + '.parquet', db_maf + '.parquet'
+
+    return query_maf, db_maf
+
+
+@pytest.mark.parametrize('chunksize', [1, 4, 1000])
+def test_streaming_reciprocal_best_last(maf_pair, chunksize):
+    query_maf, db_maf = maf_pair
+    expected_rbh, qvd_df, _ = get_reciprocal_best_last_translated(query_maf,
+                                                                  db_maf)
+    rbh_df, hits_df = streaming_reciprocal_best_last_translated(query_maf, db_maf,
+                                                                hit_columns=['ID', 'E'],
+                                                                chunksize=chunksize)
+
+    assert len(rbh_df) > 0
+    assert check_df_equals(rbh_df, expected_rbh, col='ID')
+    assert hits_df.equals(qvd_df[['ID', 'E']])
+
+    selected = select_hits(query_maf, [3, 0, 20], chunksize=chunksize)
+    assert check_df_equals(selected, qvd_df.loc[[0, 3, 20]], col='ID')
+
+
+def test_streaming_reciprocal_best_last_empty(tmpdir):
+    query_maf = tmpdir.join('query.maf')
+    db_maf = tmpdir.join('db.maf')
+    query_maf.write('# lambda=0.3 K=0.1\n')
+    db_maf.write('# lambda=0.3 K=0.1\n')
+
+    rbh_df, hits_df = streaming_reciprocal_best_last_translated(query_maf.strpath,
+                                                                db_maf.strpath,
+                                                                hit_columns=['ID'])
+    assert len(rbh_df) == 0
+    assert len(hits_df) == 0
+
+
+def test_iter_hits_frames_no_files(tmpdir):
+    maf_fn = tmpdir.join('query.maf')
+    maf_fn.write('# lambda=0.3 K=0.1\n')
+    expected, = iter_hits_frames(maf_fn.strpath, query_hits_frame)
+
+    chunk, = iter_hits_frames([], query_hits_frame)
+    assert len(chunk) == 0
+    assert list(chunk.columns) == list(expected.columns)
+
+
+@pytest.mark.parametrize('drop', [True, False])
+@pytest.mark.parametrize('method', ['sort', 'hash'])
+def test_reciprocal_best_hits_indexed(datadir, drop, method):
+    query_df = pd.read_csv(datadir('query.maf.csv'))
+    db_df = pd.read_csv(datadir('db.maf.csv'))
+
+    expected_df = BestHits().reciprocal_best_hits(query_df.copy(), db_df.copy(),
+                                                  inplace=False, drop=drop)
+    bh = BestHits(method=method, name_prefixes=('tr', 'db'))
+    results_df = bh.reciprocal_best_hits(query_df, db_df, inplace=False,
+                                         drop=drop)
+
+    assert len(results_df) > 0
+    assert list(results_df.columns) == list(expected_df.columns)
+    assert check_df_equals(results_df, expected_df, col='ID_A' if not drop else 'ID')
+
+
 def test_scale_evalues():
     test_df = pd.DataFrame({'E': [.1, 0.01, 0.0]})
     expected_df = pd.DataFrame({'E_scaled': [1.0, 2.0, 307.652655568]})
@@ -64,6 +230,220 @@ def test_scale_evalues():
         pytest.approx(list(expected_df['E_scaled']))
 
 
+def test_window_means():
+    lengths = np.array([10, 12, 12, 15, 30])
+    values = np.array([1.0, 2.0, np.nan, 4.0, 8.0])
+    left = np.array([-5, 10, 13, 16, 40])
+    right = np.array([5, 12, 20, 30, 50])
+    means = window_means(lengths, values, left, right)
+
+    assert np.isnan(means[0])
+    assert means[1] == 1.5
+    assert means[2] == 4.0
+    assert means[3] == 8.0
+    assert np.isnan(means[4])
+
+
+def test_fit_crbh_model_matches_bin_mean():
+    rng = np.random.RandomState(42)
+    rbh_df = pd.DataFrame({'s_aln_len': rng.randint(1, 500, 2000),
+                           'E': 10 ** (-rng.rand(2000) * 100)})
+    rbh_df.loc[:10, 'E'] = 0.0
+    model_df = fit_crbh_model(rbh_df)
+
+    # the original implementation: filter all the RBH's for every window
+    data = rbh_df.rename(columns={'s_aln_len': 'length'})
+    data.sort_values('length', inplace=True)
+    data, scaled_col = scale_evalues(data, inplace=True)
+    def bin_mean(fit_row):
+        hits = data[(data['length'] >= fit_row.left) & (data['length'] <= fit_row.right)]
+        return hits[scaled_col].mean()
+    expected = model_df.apply(bin_mean, axis=1)
+
+    assert list(model_df['center']) == list(range(10, 499))
+    assert np.array_equal(model_df['fit'].values, expected.values)
+
+
+def test_filter_hits_from_model():
+    model_df = pd.DataFrame({'center': [10, 11, 13],
+                             'fit': [2.0, 3.0, 4.0]})
+    rbh_df = pd.DataFrame({'ID': [0], 'E': [1e-10], 's_aln_len': [10]})
+    hits_df = pd.DataFrame({'ID': [0, 1, 2, 3, 4, 5, 6],
+                            'E': [1e-10, 1e-1, 1e-2, 0.0, 1e-5, 1e-9, 1e-9],
+                            's_aln_len': [10, 10, 11, 11, 12, 13, 40]})
+    crbl_df = filter_hits_from_model(model_df, rbh_df, hits_df)
+
+    # 0 is an RBH, 1 and 2 fall below the fit, 4 and 6 have no fit
+    assert list(crbl_df['ID']) == [3, 5]
+    assert list(crbl_df.columns) == ['ID', 'E', 's_aln_len', 'E_scaled']
+    assert list(crbl_df['E_scaled']) == pytest.approx([307.652655568, 9.0])
+
+
+def random_alignments(q_names, s_names, E, aln_lens):
+    n = len(q_names)
+    return pd.DataFrame({'score': 100, 'EG2': E * 10, 'E': E,
+                         's_name': s_names, 's_start': 0,
+                         's_aln_len': aln_lens, 's_strand': '+', 's_len': 100,
+                         'q_name': q_names, 'q_start': 0,
+                         'q_aln_len': aln_lens, 'q_strand': '+', 'q_len': 100},
+                        index=range(n))
+
+
+@pytest.fixture
+def crbl_inputs(tmpdir):
+    rng = np.random.RandomState(1)
+    n_queries, n_hits = 40, 400
+    crbl = CRBL('query.fa', 'db.fa')
+    with tmpdir.as_cwd():
+        # tr{i}_1 and db{i} are reciprocal best hits; the rest are random
+        rbh_lens = rng.randint(20, 60, n_queries)
+        rbh_E = 10 ** -rng.uniform(20, 40, n_queries)
+        q_idx = rng.randint(0, n_queries, n_hits)
+        d_idx = rng.randint(0, n_queries, n_hits)
+        hit_lens = rng.randint(15, 70, n_hits)
+        hit_E = 10 ** -rng.uniform(0, 40, n_hits)
+        hit_E = np.maximum(hit_E, rbh_E[q_idx] * 2)
+
+        tr_names = ['tr{0}_1'.format(i) for i in range(n_queries)]
+        db_names = ['db{0}'.format(i) for i in range(n_queries)]
+        qvd = pd.concat([random_alignments(tr_names, db_names, rbh_E, rbh_lens),
+                         random_alignments(['tr{0}_2'.format(i) for i in q_idx],
+                                           ['db{0}'.format(i) for i in d_idx],
+                                           hit_E, hit_lens)])
+        dvq = random_alignments(db_names, tr_names, rbh_E, rbh_lens)
+        write_maf(qvd, crbl.query_x_db_hits_fn)
+        write_maf(dvq, crbl.db_x_query_hits_fn)
+
+        for fn, prefix in ((crbl.query_name_map_fn, 'query'),
+                           (crbl.database_name_map_fn, 'protein')):
+            with NameMapWriter(fn) as writer:
+                for i in range(n_queries):
+                    writer.append(('{0}{1}'.format(prefix, i), None))
+    return crbl
+
+
+def test_crbl_low_memory(crbl_inputs, tmpdir, monkeypatch):
+    plotted = []
+    monkeypatch.setattr('shmlast.crbl.plot_crbh_fit',
+                        lambda model_df, hits_df, fn: plotted.append(hits_df))
+    crbl_inputs.plot_sample_size = 100
+    with tmpdir.as_cwd():
+        results = []
+        for low_memory in (False, True):
+            crbl_inputs.low_memory = low_memory
+            task = crbl_inputs.crbl_fit_and_filter_task()
+            task.actions[1].py_callable()
+            results.append(pd.read_csv(crbl_inputs.crbl_output_fn))
+
+    expected_df, results_df = results
+    assert len(expected_df) > 40
+    assert list(results_df.columns) == list(expected_df.columns)
+    assert results_df.equals(expected_df)
+    assert results_df['q_name'].str.startswith('query').all()
+    assert len(plotted[0]) == 440
+    assert len(plotted[1]) == 100
+
+
+def run_crbl_filter(crbl):
+    task = crbl.crbl_fit_and_filter_task()
+    task.actions[1].py_callable()
+    return pd.read_csv(crbl.crbl_output_fn)
+
+
+CRBL_OUTPUT_COLUMNS = ['E', 'EG2', 'E_scaled', 'ID', 'bitscore', 'q_aln_len',
+                       'q_frame', 'q_len', 'q_name', 'q_start', 'q_strand',
+                       's_aln_len', 's_len', 's_name', 's_start', 's_strand',
+                       'score']
+
+
+@pytest.mark.parametrize('low_memory', [False, True])
+def test_crbl_output_columns(crbl_inputs, tmpdir, monkeypatch, low_memory):
+    monkeypatch.setattr('shmlast.crbl.plot_crbh_fit', lambda *args: None)
+    crbl_inputs.low_memory = low_memory
+    with tmpdir.as_cwd():
+        results_df = run_crbl_filter(crbl_inputs)
+        assert list(results_df.columns) == CRBL_OUTPUT_COLUMNS
+
+        crbl = CRBL('query.fa', 'db.fa', output_fn='applied.csv',
+                    saved_model_fn=crbl_inputs.model_fn, skip_rbh=True,
+                    low_memory=low_memory)
+        assert list(run_crbl_filter(crbl).columns) == CRBL_OUTPUT_COLUMNS
+
+
+@pytest.mark.parametrize('ext', ['csv', 'npz'])
+def test_crbh_model_save_load(tmpdir, ext):
+    model_df = pd.DataFrame({'center': [10, 11], 'size': [5, 5],
+                             'left': [5, 6], 'right': [15, 16],
+                             'fit': [1.5, 2.5]})
+    model_fn = tmpdir.join('model.' + ext).strpath
+    save_crbh_model(model_df, model_fn)
+
+    assert load_crbh_model(model_fn).equals(model_df)
+
+
+def test_crbh_model_load_bad(tmpdir):
+    model_fn = tmpdir.join('model.csv')
+    model_fn.write('center,fit\n10,1.0\n')
+
+    with pytest.raises(ValueError):
+        load_crbh_model(model_fn.strpath)
+
+
+@pytest.mark.parametrize('low_memory', [False, True])
+def test_crbl_saved_model(crbl_inputs, tmpdir, monkeypatch, low_memory):
+    monkeypatch.setattr('shmlast.crbl.plot_crbh_fit', lambda *args: None)
+    with tmpdir.as_cwd():
+        expected_df = run_crbl_filter(crbl_inputs)
+        saved_model_fn = tmpdir.join('saved.model.npz').strpath
+        save_crbh_model(pd.read_csv(crbl_inputs.model_fn), saved_model_fn)
+
+        crbl = CRBL('query.fa', 'db.fa', output_fn='reused.csv',
+                    low_memory=low_memory, saved_model_fn=saved_model_fn)
+        assert crbl.model_fn not in crbl.crbl_fit_and_filter_task().targets
+        results_df = run_crbl_filter(crbl)
+
+    assert results_df.equals(expected_df)
+
+
+def test_crbl_skip_rbh(crbl_inputs, tmpdir, monkeypatch):
+    monkeypatch.setattr('shmlast.crbl.plot_crbh_fit', lambda *args: None)
+    with tmpdir.as_cwd():
+        expected_df = run_crbl_filter(crbl_inputs)
+        crbl = CRBL('query.fa', 'db.fa', output_fn='applied.csv',
+                    saved_model_fn=crbl_inputs.model_fn, skip_rbh=True)
+        task = crbl.crbl_fit_and_filter_task()
+        assert crbl.db_x_query_hits_fn not in task.file_dep
+        results_df = run_crbl_filter(crbl)
+
+    assert list(results_df.columns) == list(expected_df.columns)
+    assert len(results_df) > 0
+    # the hits that pass the model are reported whether or not they're RBH's
+    filtered = ~expected_df['q_frame'].isin([1])
+    assert set(expected_df['ID'][filtered]) <= set(results_df['ID'])
+    assert (results_df['E_scaled'] >= 0).all()
+
+
+def test_crbl_skip_rbh_requires_model():
+    with pytest.raises(ValueError):
+        CRBL('query.fa', 'db.fa', skip_rbh=True)
+
+
+def test_streaming_reciprocal_best_last_sample(maf_pair):
+    query_maf, db_maf = maf_pair
+    _, hits_df = streaming_reciprocal_best_last_translated(query_maf, db_maf,
+                                                           hit_columns=['ID', 's_aln_len'])
+    _, sample_df = streaming_reciprocal_best_last_translated(query_maf, db_maf,
+                                                             hit_columns=['ID', 's_aln_len'],
+                                                             max_hits=10,
+                                                             chunksize=4)
+
+    assert len(sample_df) == 10
+    assert list(sample_df.columns) == ['ID', 's_aln_len']
+    assert sample_df['s_aln_len'].dtype == np.int32
+    assert sample_df['ID'].is_monotonic_increasing
+    assert sample_df['ID'].isin(hits_df['ID']).all()
+
+
 def test_crbl_tasks_empty(tmpdir, datadir):
     with tmpdir.as_cwd():
         input_fa   = datadir('pom.single.fa')
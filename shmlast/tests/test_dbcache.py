@@ -0,0 +1,125 @@
+import os
+
+import pytest
+
+from shmlast.app import RBL
+from shmlast.dbcache import (CACHE_ENV, index_key, cached_index, cached_lastdb,
+                             cached_lastdb_task)
+from shmlast.tests.utils import run_tasks
+
+
+FAKE_LASTDB = '''#!/bin/sh
+# writes an index of two files for the last two arguments, and counts builds
+for last; do :; done
+prefix=$(eval echo \\${{$(($#-1))}})
+echo "$last" > "$prefix.prj"
+cat "$last" > "$prefix.suf"
+echo built >> {log}
+'''
+
+
+@pytest.fixture
+def fake_lastdb(tmpdir, monkeypatch):
+    bin_dir = tmpdir.mkdir('bin')
+    log = tmpdir.join('builds.log')
+    script = bin_dir.join('lastdb')
+    script.write(FAKE_LASTDB.format(log=log.strpath))
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', bin_dir.strpath + os.pathsep + os.environ['PATH'])
+
+    def n_builds():
+        return len(log.readlines()) if log.check() else 0
+    return n_builds
+
+
+def test_index_key(tmpdir):
+    db_fn = tmpdir.join('db.fa')
+    db_fn.write('>db0\nMKV\n')
+    key = index_key(db_fn.strpath)
+
+    assert index_key(db_fn.strpath) == key
+    assert index_key(db_fn.strpath, params=['-w2']) != key
+    assert index_key(db_fn.strpath, prot=False) != key
+    db_fn.write('>db0\nMKL\n')
+    assert index_key(db_fn.strpath) != key
+
+
+def test_cached_lastdb_shared(tmpdir, fake_lastdb):
+    cache_dir = tmpdir.join('cache').strpath
+    for run in ('run1', 'run2'):
+        with tmpdir.mkdir(run).as_cwd():
+            with open('.db.fa', 'w') as fp:
+                fp.write('>db0\nMKV\n')
+            cached_lastdb('.db.fa', cache_dir)
+
+            assert os.path.islink('.db.fa.prj')
+            assert open('.db.fa.suf').read() == '>db0\nMKV\n'
+    assert fake_lastdb() == 1
+
+    # only the published index is left in the cache
+    entry = cached_index(tmpdir.join('run1', '.db.fa').strpath, cache_dir)
+    assert sorted(os.listdir(cache_dir)) == sorted([os.path.basename(entry),
+                                                    os.path.basename(entry) + '.lock'])
+
+
+def test_cached_lastdb_changed(tmpdir, fake_lastdb):
+    cache_dir = tmpdir.join('cache').strpath
+    with tmpdir.as_cwd():
+        with open('.db.fa', 'w') as fp:
+            fp.write('>db0\nMKV\n')
+        cached_lastdb('.db.fa', cache_dir)
+        with open('.db.fa', 'a') as fp:
+            fp.write('>db1\nMKL\n')
+        cached_lastdb('.db.fa', cache_dir)
+
+        assert fake_lastdb() == 2
+        assert open('.db.fa.suf').read() == '>db0\nMKV\n>db1\nMKL\n'
+
+
+def test_cached_lastdb_failed(tmpdir, monkeypatch):
+    bin_dir = tmpdir.mkdir('bin')
+    script = bin_dir.join('lastdb')
+    script.write('#!/bin/sh\nexit 1\n')
+    script.chmod(0o755)
+    monkeypatch.setenv('PATH', bin_dir.strpath + os.pathsep + os.environ['PATH'])
+
+    cache_dir = tmpdir.join('cache')
+    with tmpdir.as_cwd():
+        with open('db.fa', 'w') as fp:
+            fp.write('>db0\nMKV\n')
+        with pytest.raises(Exception):
+            cached_lastdb('db.fa', cache_dir.strpath)
+
+    # nothing partial is published
+    assert [fn for fn in cache_dir.listdir() if not fn.ext == '.lock'] == []
+
+
+def test_cached_lastdb_task(tmpdir, fake_lastdb):
+    cache_dir = tmpdir.join('cache').strpath
+    with tmpdir.as_cwd():
+        with open('.db.fa', 'w') as fp:
+            fp.write('>db0\nMKV\n')
+        tsk = cached_lastdb_task('.db.fa', cache_dir)
+        assert run_tasks([tsk], ['run']) == 0
+        assert os.path.islink('.db.fa.prj')
+
+        os.remove('.db.fa.prj')
+        assert run_tasks([cached_lastdb_task('.db.fa', cache_dir)], ['run']) == 0
+        assert os.path.islink('.db.fa.prj')
+        assert fake_lastdb() == 1
+
+
+def test_app_lastdb_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr('shmlast.last.which', lambda program: program)
+    with tmpdir.as_cwd():
+        rbl = RBL('query.fa', 'db.fa')
+        assert rbl.lastdb_cache is None
+        assert isinstance(rbl.format_database_task().actions[1].action, str)
+
+        monkeypatch.setenv(CACHE_ENV, 'cache')
+        rbl = RBL('query.fa', 'db.fa')
+        tsk = rbl.format_database_task()
+        assert rbl.lastdb_cache == 'cache'
+        assert tsk.file_dep == {rbl.renamed_database_fn}
+        # the transcriptome isn't cached
+        assert isinstance(rbl.format_transcriptome_task().actions[1].action, str)
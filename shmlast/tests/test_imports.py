@@ -0,0 +1,64 @@
+import json
+import os
+import stat
+import subprocess
+import sys
+
+import pytest
+
+import shmlast
+
+
+HEAVY_MODULES = ['numpy', 'pandas', 'matplotlib', 'seaborn', 'ficus',
+                 'screed', 'ope', 'pyarrow', 'scipy']
+
+LOAD_TASKS = '''
+import json, sys
+from shmlast.app import CRBL
+app = CRBL('q.fa', 'd.fa', incremental={incremental})
+app.run(['list'])
+print(json.dumps(sorted(m for m in {modules!r} if m in sys.modules)))
+'''
+
+
+@pytest.fixture
+def env():
+    # the subprocesses must find this copy of shmlast, installed or not
+    env = dict(os.environ)
+    package_dir = os.path.dirname(os.path.dirname(shmlast.__file__))
+    if env.get('PYTHONPATH'):
+        package_dir += os.pathsep + env['PYTHONPATH']
+    env['PYTHONPATH'] = package_dir
+    return env
+
+
+@pytest.fixture
+def fake_last(tmpdir, env):
+    bin_dir = tmpdir.mkdir('bin')
+    for name in ('lastal', 'lastdb'):
+        exe = bin_dir.join(name)
+        exe.write('#!/bin/sh\nexit 0\n')
+        exe.chmod(exe.stat().mode | stat.S_IXUSR)
+    env = dict(env)
+    env['PATH'] = bin_dir.strpath + os.pathsep + env['PATH']
+    return env
+
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_tasks_skip_heavy_imports(tmpdir, fake_last, incremental):
+    with tmpdir.as_cwd():
+        tmpdir.join('q.fa').write('>a\nACGTACGT\n')
+        tmpdir.join('d.fa').write('>p\nMKV\n')
+        script = LOAD_TASKS.format(incremental=incremental,
+                                   modules=HEAVY_MODULES)
+        output = subprocess.check_output([sys.executable, '-c', script],
+                                         env=fake_last)
+
+    assert json.loads(output.decode('utf-8').splitlines()[-1]) == []
+
+
+@pytest.mark.benchmark(group='import')
+def test_import_time(benchmark, env):
+    benchmark.pedantic(subprocess.check_call,
+                       args=([sys.executable, '-c', 'import shmlast.app'],),
+                       kwargs={'env': env}, rounds=5, iterations=1)
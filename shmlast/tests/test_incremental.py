@@ -0,0 +1,172 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from shmlast.app import RBL, CRBL
+from shmlast.crbl import query_hits_frame, database_hits_frame
+from shmlast.incremental import (scan_database, plan_segments, write_manifest,
+                                 segment_evalue_scales, split_segment,
+                                 split_segment_task, write_segment_best_hits)
+from shmlast.names import NameMapWriter
+from shmlast.tests.utils import write_maf, run_tasks, check_status
+
+
+def write_fasta(filename, records, mode='w'):
+    with open(filename, mode) as fp:
+        for name, sequence in records:
+            fp.write('>{0}\n{1}\n'.format(name, sequence))
+
+
+def test_plan_segments(tmpdir):
+    db_fn = tmpdir.join('db.fa').strpath
+    manifest_fn = tmpdir.join('db.fa.manifest.json').strpath
+    write_fasta(db_fn, [('a', 'MKV'), ('b', 'MKVL')])
+
+    segments = plan_segments(db_fn, manifest_fn)
+    assert [(seg['start'], seg['stop'], seg['letters']) for seg in segments] == \
+           [(0, 2, 7)]
+    write_manifest(manifest_fn, db_fn, segments)
+    assert plan_segments(db_fn, manifest_fn) == segments
+
+    write_fasta(db_fn, [('c', 'MK'), ('d', 'MKVLA')], mode='a')
+    segments = plan_segments(db_fn, manifest_fn)
+    assert [(seg['start'], seg['stop'], seg['letters']) for seg in segments] == \
+           [(0, 2, 7), (2, 4, 7)]
+    assert segments[1]['digest'] == scan_database(db_fn)['digest']
+    assert segment_evalue_scales(segments) == [2.0, 2.0]
+
+    # an edited record invalidates the segments
+    write_manifest(manifest_fn, db_fn, segments)
+    write_fasta(db_fn, [('a', 'MKV'), ('b', 'MKVW'), ('c', 'MK')])
+    segments = plan_segments(db_fn, manifest_fn)
+    assert [(seg['start'], seg['stop'], seg['letters']) for seg in segments] == \
+           [(0, 3, 9)]
+
+
+def test_split_segment(tmpdir):
+    db_fn = tmpdir.join('db.fa').strpath
+    segment_fn = tmpdir.join('db.fa.1-3').strpath
+    write_fasta(db_fn, [('db0', 'MKV'), ('db1', 'MKVL'), ('db2', 'MK'),
+                        ('db3', 'M')])
+    split_segment(db_fn, segment_fn, 1, 3)
+
+    assert open(segment_fn).read() == '>db1\nMKVL\n>db2\nMK\n'
+
+
+def test_split_segment_task_appended(tmpdir):
+    with tmpdir.as_cwd():
+        write_fasta('db.fa', [('db0', 'MKV'), ('db1', 'MKVL')])
+        old_tsk = split_segment_task('db.fa', 'db.fa.0-2', 0, 2, 'abc')
+        assert run_tasks([old_tsk], ['run']) == 0
+
+        # the existing segment isn't rewritten when records are appended
+        write_fasta('db.fa', [('db2', 'MK'), ('db3', 'M')], mode='a')
+        old_tsk = split_segment_task('db.fa', 'db.fa.0-2', 0, 2, 'abc')
+        new_tsk = split_segment_task('db.fa', 'db.fa.2-4', 2, 4, 'def')
+        assert check_status(old_tsk).status == 'up-to-date'
+        assert check_status(new_tsk).status == 'run'
+        assert run_tasks([old_tsk, new_tsk], ['run']) == 0
+
+        assert open('db.fa.0-2').read() == '>db0\nMKV\n>db1\nMKVL\n'
+        assert open('db.fa.2-4').read() == '>db2\nMK\n>db3\nM\n'
+
+
+@pytest.mark.parametrize('command,expected', [('run', [(0, 2), (2, 3)]),
+                                              ('list', [(0, 2)]),
+                                              ('clean', [(0, 2)])])
+def test_load_tasks_scans_for_run(tmpdir, monkeypatch, command, expected):
+    monkeypatch.setattr('shmlast.last.which', lambda program: program)
+    with tmpdir.as_cwd():
+        write_fasta('db.fa', [('a', 'MKV'), ('b', 'MKVL')])
+        write_manifest('.db.fa.manifest.json', 'db.fa',
+                       plan_segments('db.fa', '.db.fa.manifest.json'))
+        write_fasta('db.fa', [('c', 'MKVLA')], mode='a')
+
+        app = RBL('query.fa', 'db.fa', incremental=True)
+        assert app.segments is None
+        app.load_tasks(SimpleNamespace(name=command), {}, [])
+
+    assert [(seg['start'], seg['stop']) for seg in app.segments] == expected
+
+
+def alignments(q_names, s_names, E, length=30):
+    return pd.DataFrame({'score': 100, 'EG2': E * 10, 'E': E,
+                         's_name': s_names, 's_start': 0,
+                         's_aln_len': length, 's_strand': '+', 's_len': 100,
+                         'q_name': q_names, 'q_start': 0,
+                         'q_aln_len': length, 'q_strand': '+', 'q_len': 100})
+
+
+@pytest.mark.parametrize('app_class', [RBL, CRBL])
+def test_incremental_reciprocals(tmpdir, monkeypatch, app_class):
+    monkeypatch.setattr('shmlast.crbl.plot_crbh_fit', lambda *args: None)
+    rng = np.random.RandomState(3)
+    n_queries, n_old, n_new = 20, 20, 10
+
+    with tmpdir.as_cwd():
+        # the first run saw n_old records; n_new have been appended
+        write_fasta('db.fa', [('prot{0}'.format(i), 'M' * 20)
+                              for i in range(n_old)])
+        manifest_fn = '.db.fa.manifest.json'
+        write_manifest(manifest_fn, 'db.fa', plan_segments('db.fa', manifest_fn))
+        write_fasta('db.fa', [('prot{0}'.format(i), 'M' * 60)
+                              for i in range(n_old, n_old + n_new)], mode='a')
+
+        app = app_class('query.fa', 'db.fa', incremental=True)
+        full = app_class('query.fa', 'db.fa')
+        app.plan_database_segments()
+        segments = app.segments
+        assert [(seg['start'], seg['stop']) for seg in segments] == \
+               [(0, n_old), (n_old, n_old + n_new)]
+        scales = app.query_x_db_evalue_scales
+        assert scales == pytest.approx([2.5, 1000 / 600.])
+
+        for fn, prefix, n in ((app.query_name_map_fn, 'query', n_queries),
+                              (app.database_name_map_fn, 'protein', n_old + n_new)):
+            with NameMapWriter(fn) as writer:
+                for i in range(n):
+                    writer.append(('{0}{1}'.format(prefix, i), None))
+
+        # alignments against the whole database, in segment order, and the
+        # same alignments as if searched against each segment
+        qvd, dvq = [], []
+        for seg in segments:
+            n_hits = 200
+            q_idx = rng.randint(0, n_queries, n_hits)
+            d_idx = rng.randint(seg['start'], seg['stop'], n_hits)
+            E = 10 ** -rng.uniform(5, 50, n_hits)
+            qvd.append(alignments(['tr{0}_1'.format(i) for i in q_idx],
+                                  ['db{0}'.format(i) for i in d_idx], E))
+            dvq.append(alignments(['db{0}'.format(i) for i in d_idx],
+                                  ['tr{0}_1'.format(i) for i in q_idx], E))
+        write_maf(pd.concat(qvd), full.query_x_db_hits_fn)
+        write_maf(pd.concat(dvq), full.db_x_query_hits_fn)
+
+        for seg, seg_qvd, seg_dvq, scale in zip(segments, qvd, dvq, scales):
+            seg_qvd = seg_qvd.assign(E=seg_qvd['E'] / scale)
+            write_maf(seg_qvd, seg['query_x_seg_hits_fn'])
+            write_maf(seg_dvq, seg['seg_x_query_hits_fn'])
+            write_segment_best_hits(seg['query_x_seg_hits_fn'],
+                                    seg['query_x_seg_best_fn'],
+                                    query_hits_frame)
+            write_segment_best_hits(seg['seg_x_query_hits_fn'],
+                                    seg['seg_x_query_best_fn'],
+                                    database_hits_frame)
+
+        results = []
+        for rbl in (full, app):
+            if app_class is RBL:
+                task, output_fn = rbl.reciprocal_best_last_task(), rbl.output_fn
+            else:
+                task, output_fn = rbl.crbl_fit_and_filter_task(), rbl.crbl_output_fn
+            task.actions[1].py_callable()
+            results.append(pd.read_csv(output_fn))
+
+    expected_df, results_df = results
+    assert len(expected_df) > 0
+    assert list(results_df.columns) == list(expected_df.columns)
+    assert list(results_df['ID']) == list(expected_df['ID'])
+    assert list(results_df['s_name']) == list(expected_df['s_name'])
+    assert list(results_df['E']) == pytest.approx(list(expected_df['E']))
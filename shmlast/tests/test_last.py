@@ -9,9 +9,14 @@ import glob
 import os
 import sys
 
-from shmlast.tests.utils import datadir, run_task, run_tasks, check_status, touch, N_THREADS
-from shmlast.last import lastal_task
+import pandas as pd
+
+from shmlast.tests.utils import (datadir, run_task, run_tasks, check_status, touch,
+                                 write_maf, write_last_tab, N_THREADS)
+from shmlast.last import lastal_task, lastal_cmd
 from shmlast.last import lastdb_task
+from shmlast.last import LastConfig, LASTDB_CFG, options_changed
+from shmlast.alignments import LastTabParser, alignment_parser, cache_alignments
 
 LASTDB_EXTENSIONS = ['.bck', '.des', '.prj', '.sds', '.ssp', '.suf', '.tis']
 
@@ -111,6 +116,89 @@ def test_lastal_task_prot_x_prot(tmpdir, datadir):
         assert 'lambda' in aln, 'lambda missing, wrong LAST version?'
 
 
+def test_lastal_task_tab(tmpdir, datadir):
+    with tmpdir.as_cwd():
+        prot = datadir('test-protein.fa')
+        out_maf = tmpdir.join('test-out.maf').strpath
+        out_tab = tmpdir.join('test-out.tab').strpath
+
+        db_task = lastdb_task(prot, prot)
+        maf_task = lastal_task(prot, prot, out_maf,
+                               translate=False,
+                               cutoff=None)
+        tab_task = lastal_task(prot, prot, out_tab,
+                               translate=False,
+                               cutoff=None,
+                               fmt='tab')
+        run_tasks([db_task, maf_task, tab_task], ['run'])
+
+        maf_df = alignment_parser(out_maf).read()
+        tab_df = alignment_parser(out_tab).read()
+
+        assert os.path.getsize(out_tab) < os.path.getsize(out_maf)
+        assert list(tab_df.columns) == list(maf_df.columns)
+        assert all(tab_df['E'].sort_values().values == \
+                   maf_df['E'].sort_values().values)
+
+
+def test_last_tab_parser(tmpdir, datadir):
+    with tmpdir.as_cwd():
+        aln_df = pd.read_csv(datadir('query.maf.csv'))
+        maf_fn = tmpdir.join('alns.maf').strpath
+        tab_fn = tmpdir.join('alns.tab').strpath
+        write_maf(aln_df, maf_fn, q_name_col='translated_q_name')
+        write_last_tab(aln_df, tab_fn, q_name_col='translated_q_name')
+
+        maf_df = MafParser(maf_fn).read()
+        tab_df = alignment_parser(tab_fn, chunksize=7).read()
+        assert isinstance(alignment_parser(tab_fn), LastTabParser)
+
+        assert list(tab_df.columns) == list(maf_df.columns)
+        for col in tab_df.columns:
+            assert list(tab_df[col]) == list(maf_df[col])
+
+
+def test_last_tab_parser_empty(tmpdir):
+    tab_fn = tmpdir.join('empty.tab')
+    tab_fn.write('# lambda=0.3 K=0.1\n')
+
+    tab_df = LastTabParser(tab_fn.strpath).read()
+    assert len(tab_df) == 0
+    assert 'E' in tab_df.columns
+
+
+def test_alignment_cache(tmpdir, datadir):
+    pytest.importorskip('pyarrow')
+    with tmpdir.as_cwd():
+        aln_df = pd.read_csv(datadir('query.maf.csv'))
+        maf_fn = tmpdir.join('alns.maf').strpath
+        cache_fn = tmpdir.join('alns.maf.parquet').strpath
+        write_maf(aln_df, maf_fn, q_name_col='translated_q_name')
+        cache_alignments(maf_fn, cache_fn, chunksize=10)
+
+        maf_df = MafParser(maf_fn).read()
+        cache_df = alignment_parser(cache_fn).read()
+
+        assert list(cache_df.columns) == list(maf_df.columns)
+        chunk = next(iter(alignment_parser(cache_fn)))
+        assert chunk['q_name'].dtype.name == 'category'
+        assert chunk['s_len'].dtype == 'int32'
+        for col in cache_df.columns:
+            assert list(cache_df[col]) == list(maf_df[col])
+
+
+def test_alignment_cache_empty(tmpdir):
+    pytest.importorskip('pyarrow')
+    maf_fn = tmpdir.join('empty.maf')
+    maf_fn.write('# lambda=0.3 K=0.1\n')
+    cache_fn = tmpdir.join('empty.maf.parquet').strpath
+    cache_alignments(maf_fn.strpath, cache_fn)
+
+    cache_df = alignment_parser(cache_fn).read()
+    assert len(cache_df) == 0
+    assert 'E' in cache_df.columns
+
+
 def test_lastal_task_multithreaded(tmpdir, datadir):
     with tmpdir.as_cwd():
         for n_threads in (3,4,5):
@@ -175,3 +263,64 @@ def test_lastal_task_uptodate(tmpdir, datadir):
         status = check_status(aln_task, tasks=[aln_task, db_task])
         assert status.status == 'up-to-date'
 
+
+
+def test_last_config_presets():
+    config = LastConfig()
+    assert config.lastdb_params() == LASTDB_CFG['params']
+    assert config.lastal_params() == []
+
+    config = LastConfig('sensitive')
+    assert config.lastdb_params() == ['-w1']
+    assert config.lastal_params() == ['-m100']
+
+    config = LastConfig('fast', multiplicity=20, seed='MAM8', volume_size='4G')
+    assert config.lastdb_params() == ['-w5', '-u', 'MAM8', '-s', '4G']
+    assert config.lastal_params() == ['-m20']
+
+
+@pytest.mark.parametrize('kwds', [{'preset': 'fastest'},
+                                  {'step': 0},
+                                  {'multiplicity': 2.5},
+                                  {'seed': 'two words'},
+                                  {'volume_size': '4GB'}])
+def test_last_config_invalid(kwds):
+    with pytest.raises(ValueError):
+        LastConfig(**kwds)
+
+
+def test_lastal_cmd_native_threads(monkeypatch):
+    monkeypatch.setattr('shmlast.last.which', lambda program: program)
+    cmd = lastal_cmd('query.fa', 'db', 'out.maf', cutoff=None, n_threads=4,
+                     params=['-m20'], native_threads=True)
+    assert cmd == 'lastal -P4 -m20 db query.fa > out.maf'
+
+
+def test_lastal_task_options_changed(tmpdir, monkeypatch):
+    # echo stands in for lastal, writing its arguments to the output
+    monkeypatch.setattr('shmlast.last.which', lambda program: 'echo')
+    with tmpdir.as_cwd():
+        touch('query.fa')
+        touch('db.prj')
+
+        def status(**kwds):
+            task = lastal_task('query.fa', 'db', 'out.maf', cutoff=None,
+                               native_threads=True, **kwds)
+            return task, check_status(task).status
+
+        task, _ = status(params=['-m20'])
+        assert run_tasks([task], ['run']) == 0
+        assert status(params=['-m20'])[1] == 'up-to-date'
+        assert status(params=['-m20'], n_threads=8)[1] == 'up-to-date'
+        assert status(params=['-m20'], db_params=['-w1'])[1] == 'run'
+        assert status()[1] == 'run'
+
+
+def test_options_changed_unrecorded():
+    # targets from before the options were recorded used the defaults
+    assert options_changed({'params': ['-w3']}, {'params': ['-w3']})(None, {})
+    assert not options_changed({'params': ['-w1']}, {'params': ['-w3']})(None, {})
+
+    check = options_changed({'params': ['-w1']}, {'params': ['-w3']})
+    check(None, {})
+    assert check(None, {'_config_changed': check.config_digest})
@@ -0,0 +1,71 @@
+import pandas as pd
+import pytest
+
+from shmlast.crbl import backmap_names, backmap_names_indexed
+from shmlast.names import NameMap, NameMapWriter, name_map_writer, name_indices
+
+
+NAMES = ['SPAC212.11 RecQ type DNA helicase', 'seq-2', '', 'sëq/4 ünicode']
+
+
+def write_names(filename, names, prefix):
+    with name_map_writer(filename) as name_map:
+        for n, name in enumerate(names):
+            name_map.append((name, '{0}{1}'.format(prefix, n)))
+
+
+def test_name_map_roundtrip(tmpdir):
+    fn = tmpdir.join('names').strpath
+    write_names(fn, NAMES, 'tr')
+
+    with NameMap(fn) as name_map:
+        assert len(name_map) == len(NAMES)
+        assert [name_map[i] for i in range(len(NAMES))] == NAMES
+        assert list(name_map.lookup([3, 0, 0])) == [NAMES[3], NAMES[0], NAMES[0]]
+        with pytest.raises(IndexError):
+            name_map.lookup([len(NAMES)])
+
+
+def test_name_map_empty(tmpdir):
+    fn = tmpdir.join('names').strpath
+    write_names(fn, [], 'tr')
+
+    with NameMap(fn) as name_map:
+        assert len(name_map) == 0
+        assert len(name_map.lookup([])) == 0
+
+
+def test_name_map_bad_file(tmpdir):
+    fn = tmpdir.join('names.csv')
+    fn.write('old_name,new_name\nfoo,tr0\n')
+    with pytest.raises(ValueError):
+        NameMap(fn.strpath)
+
+
+def test_name_indices():
+    assert list(name_indices(pd.Series(['db10', 'db0', 'db3']), 'db')) == [10, 0, 3]
+
+
+def test_backmap_names_indexed(tmpdir):
+    q_names = ['q{0}'.format(i) for i in range(20)]
+    d_names = ['d{0}'.format(i) for i in range(30)]
+    write_names(tmpdir.join('q').strpath, q_names, 'tr')
+    write_names(tmpdir.join('d').strpath, d_names, 'db')
+    write_names(tmpdir.join('q.csv').strpath, q_names, 'tr')
+    write_names(tmpdir.join('d.csv').strpath, d_names, 'db')
+
+    results = pd.DataFrame({'q_name': ['tr5', 'tr0', 'tr19'],
+                            's_name': ['db29', 'db7', 'db7'],
+                            'E': [0.1, 0.2, 0.3]})
+    expected = backmap_names(results.copy(),
+                             pd.read_csv(tmpdir.join('q.csv').strpath),
+                             pd.read_csv(tmpdir.join('d.csv').strpath))
+
+    with NameMap(tmpdir.join('q').strpath) as q_map, \
+         NameMap(tmpdir.join('d').strpath) as d_map:
+        result = backmap_names_indexed(results, q_map, d_map)
+
+    result = result.sort_values('E').reset_index(drop=True)
+    expected = expected.sort_values('E').reset_index(drop=True)
+    assert list(result['q_name']) == list(expected['q_name'])
+    assert list(result['s_name']) == list(expected['s_name'])
@@ -0,0 +1,233 @@
+import csv
+import json
+import os
+import pstats
+import subprocess
+import sys
+
+import pytest
+
+from shmlast.profile import (Profiler, ResourceTimer, StartProfiler,
+                             profile_task, span, read_proc_io,
+                             format_profile_tree, write_chrome_trace,
+                             PROFILE_COLUMNS)
+from shmlast.tests.utils import run_tasks
+from shmlast.util import create_doit_task as doit_task
+
+
+def read_profile(filename):
+    with open(filename) as fp:
+        reader = csv.DictReader(fp)
+        return reader.fieldnames, list(reader)
+
+
+def test_profiler_buffers_rows(tmpdir):
+    profile_fn = tmpdir.join('profile.csv').strpath
+    profiler = Profiler()
+    profiler.start_profiler(filename=profile_fn)
+    profiler.write_result('a', 0, 1, 1)
+    profiler.write_result('b', 1, 3, 2, usage={'user_t': 0.5})
+
+    assert not os.path.exists(profile_fn)
+    profiler.stop_profiler()
+
+    columns, rows = read_profile(profile_fn)
+    assert columns == PROFILE_COLUMNS
+    assert [row['block'] for row in rows] == ['a', 'b', '__main__']
+    assert rows[1]['user_t'] == '0.5'
+    assert float(rows[2]['max_rss_kb']) > 0
+
+    # a second run appends
+    profiler.start_profiler(filename=profile_fn)
+    profiler.stop_profiler()
+    assert len(read_profile(profile_fn)[1]) == 4
+
+
+def test_profiler_upgrades_old_file(tmpdir):
+    profile_fn = tmpdir.join('profile.csv')
+    profile_fn.write('run_id,block,start_t,end_t,elapsed_t\nold,a,0,1,1\n')
+
+    profiler = Profiler()
+    profiler.start_profiler(filename=profile_fn.strpath)
+    profiler.stop_profiler()
+
+    columns, rows = read_profile(profile_fn.strpath)
+    assert columns == PROFILE_COLUMNS
+    assert [(row['run_id'], row['block']) for row in rows][0] == ('old', 'a')
+    assert rows[0]['user_t'] == ''
+    assert rows[1]['block'] == '__main__'
+
+
+def test_resource_timer_children(tmpdir):
+    out_fn = tmpdir.join('out.txt').strpath
+    timer = ResourceTimer()
+    timer.start()
+    subprocess.check_call([sys.executable, '-c',
+                           'sum(range(2 * 10 ** 7)); '
+                           'open({0!r}, "w").write("x" * 10 ** 6)'.format(out_fn)])
+    timer.stop()
+
+    assert timer.usage['child_user_t'] + timer.usage['child_sys_t'] > 0
+    assert timer.usage['child_max_rss_kb'] is None or \
+           timer.usage['child_max_rss_kb'] > 0
+    if read_proc_io() is not None:
+        assert timer.usage['write_bytes'] >= 10 ** 6
+
+
+def test_profile_task_usage(tmpdir):
+
+    @doit_task
+    @profile_task
+    def busy_task():
+        return {'name': 'busy',
+                'actions': [(lambda: sum(range(10 ** 6)) and None)]}
+
+    profile_fn = tmpdir.join('profile.csv').strpath
+    with tmpdir.as_cwd():
+        with StartProfiler(filename=profile_fn):
+            assert run_tasks([busy_task()], ['run']) == 0
+
+    _, rows = read_profile(profile_fn)
+    busy, = [row for row in rows if row['block'] == 'busy']
+    assert float(busy['elapsed_t']) > 0
+    assert float(busy['user_t']) + float(busy['sys_t']) > 0
+
+
+def test_span_not_running():
+
+    @span('step')
+    def step():
+        return 1
+
+    with span('outer'):
+        assert step() == 1
+
+
+def test_spans_in_task(tmpdir):
+
+    @span('step')
+    def step():
+        with span('inner'):
+            sum(range(10 ** 5))
+
+    @doit_task
+    @profile_task
+    def spans_task():
+        def action():
+            with span('outer'):
+                step()
+                step()
+        return {'name': 'spans',
+                'actions': [action]}
+
+    profile_fn = tmpdir.join('profile.csv').strpath
+    with tmpdir.as_cwd():
+        with StartProfiler(filename=profile_fn):
+            assert run_tasks([spans_task()], ['run']) == 0
+
+    _, rows = read_profile(profile_fn)
+    blocks = [row['block'] for row in rows]
+    assert blocks.count('spans > outer > step > inner') == 2
+    assert blocks.count('spans > outer > step') == 2
+    assert blocks.count('spans > outer') == 1
+    outer, = [row for row in rows if row['block'] == 'spans > outer']
+    spans, = [row for row in rows if row['block'] == 'spans']
+    assert float(outer['elapsed_t']) <= float(spans['elapsed_t'])
+    assert outer['thread'] == spans['thread']
+
+
+def test_format_profile_tree():
+    rows = [{'block': 'a > x', 'elapsed_t': 1.0},
+            {'block': 'a > x > y', 'elapsed_t': 0.5},
+            {'block': 'a > x', 'elapsed_t': 2.0},
+            {'block': 'a', 'elapsed_t': 4.0},
+            {'block': 'b', 'elapsed_t': 1.0},
+            {'block': '__main__', 'elapsed_t': 6.0}]
+
+    assert format_profile_tree(rows).splitlines() == ['a: 4.000s',
+                                                      '  x: 3.000s (2 calls)',
+                                                      '    y: 0.500s',
+                                                      'b: 1.000s',
+                                                      '__main__: 6.000s']
+    # a span of a task which failed, and so wasn't recorded
+    assert format_profile_tree([{'block': 'c > z', 'elapsed_t': 1.0}]) == \
+           'c > z: 1.000s'
+
+
+def test_write_chrome_trace(tmpdir):
+    rows = [{'block': 'a > x', 'start_t': 10.5, 'elapsed_t': 0.25,
+             'thread': 'worker', 'user_t': 0.2, 'max_rss_kb': None},
+            {'block': 'a', 'start_t': 10.0, 'elapsed_t': 1.0,
+             'thread': 'worker', 'user_t': 0.9},
+            {'block': '__main__', 'start_t': 10.0, 'elapsed_t': 2.0,
+             'thread': 'MainThread'}]
+    trace_fn = tmpdir.join('trace.json').strpath
+    write_chrome_trace(rows, trace_fn)
+
+    with open(trace_fn) as fp:
+        events = json.load(fp)['traceEvents']
+    spans = [event for event in events if event['ph'] == 'X']
+    assert [event['name'] for event in spans] == ['x', 'a', '__main__']
+    assert spans[0]['ts'] == 0.5e6
+    assert spans[0]['dur'] == 0.25e6
+    assert spans[0]['args'] == {'user_t': 0.2}
+    assert spans[0]['tid'] == spans[1]['tid'] != spans[2]['tid']
+    names = {event['tid']: event['args']['name'] for event in events
+             if event['ph'] == 'M'}
+    assert names == {spans[0]['tid']: 'worker', spans[2]['tid']: 'MainThread'}
+
+
+def hot_function():
+    return sum(i * i for i in range(10 ** 5))
+
+
+def test_profile_mode_cprofile(tmpdir, capsys):
+
+    @doit_task
+    @profile_task
+    def python_task():
+        def action(targets):
+            hot_function()
+            open(targets[0], 'w').close()
+        return {'name': 'python:task',
+                'actions': [action],
+                'targets': ['out.txt']}
+
+    @doit_task
+    @profile_task
+    def cmd_task():
+        return {'name': 'cmd',
+                'actions': ['true']}
+
+    profile_fn = tmpdir.join('profile.csv').strpath
+    with tmpdir.as_cwd():
+        with StartProfiler(filename=profile_fn, mode='cprofile'):
+            assert run_tasks([python_task(), cmd_task()], ['run']) == 0
+        assert os.path.exists('out.txt')
+
+    stats_fn = tmpdir.join('profile.python_task.pstats')
+    assert sorted(fn.basename for fn in tmpdir.listdir()
+                  if fn.ext == '.pstats') == [stats_fn.basename]
+    functions = [name for _, _, name in pstats.Stats(stats_fn.strpath).stats]
+    assert 'hot_function' in functions
+    assert 'hot_function' in capsys.readouterr().err
+
+
+def test_profile_mode_time(tmpdir):
+
+    @doit_task
+    @profile_task
+    def python_task():
+        return {'name': 'python',
+                'actions': [(lambda: hot_function() and None)]}
+
+    profile_fn = tmpdir.join('profile.csv').strpath
+    with tmpdir.as_cwd():
+        with StartProfiler(filename=profile_fn):
+            assert run_tasks([python_task()], ['run']) == 0
+        # without the profiler, the actions still run
+        assert run_tasks([python_task()], ['run']) == 0
+
+    assert tmpdir.listdir(lambda fn: fn.ext == '.pstats') == []
+    with pytest.raises(ValueError):
+        Profiler().start_profiler(filename=profile_fn, mode='nope')
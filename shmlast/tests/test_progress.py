@@ -0,0 +1,160 @@
+import io
+import json
+
+import pandas as pd
+
+from shmlast.crbl import iter_hits_frames, query_hits_frame
+from shmlast.progress import (Progress, AlignmentWatcher, ProgressReporter,
+                              ProgressConsoleReporter, StartProgress,
+                              format_status, name_number, fasta_numbers,
+                              last_query_number, reporter, track_records)
+from shmlast.tests.utils import run_tasks, write_maf, write_last_tab
+from shmlast.util import create_doit_task as doit_task
+
+
+def alignments(q_names, s_name='db0'):
+    n = len(q_names)
+    return pd.DataFrame({'E': [1e-10] * n, 'EG2': [1e-5] * n,
+                         'score': [100] * n, 'q_name': q_names,
+                         's_name': [s_name] * n,
+                         'q_start': [0] * n, 'q_aln_len': [30] * n,
+                         'q_strand': ['+'] * n, 'q_len': [90] * n,
+                         's_start': [0] * n, 's_aln_len': [10] * n,
+                         's_strand': ['+'] * n, 's_len': [30] * n})
+
+
+def test_name_number():
+    assert name_number('tr12') == ('tr', 12)
+    assert name_number('tr12_3') == ('tr', 12)
+    assert name_number('gene') == (None, None)
+
+
+def test_fasta_numbers(tmpdir):
+    fasta_fn = tmpdir.join('q.fa')
+    fasta_fn.write(''.join('>tr{0}\nACGT\n'.format(i) for i in range(5, 20)))
+    assert fasta_numbers(fasta_fn.strpath) == ('tr', 5, 19)
+
+    fasta_fn.write('>gene1\nACGT\n>other\nACGT\n')
+    assert fasta_numbers(fasta_fn.strpath) is None
+
+
+def test_last_query_number(tmpdir):
+    maf_fn = tmpdir.join('q.x.db.maf').strpath
+    write_maf(alignments(['tr0_1', 'tr3_2', 'tr7_0']), maf_fn)
+    assert last_query_number(maf_fn, 'tr') == 7
+    # a half-written last line is skipped
+    with open(maf_fn, 'a') as fp:
+        fp.write('a score=10 EG2=1 E=1\ns db0 0 10 + 30 AAA\ns tr9')
+    assert last_query_number(maf_fn, 'tr') == 7
+    assert last_query_number(maf_fn, 'xx') is None
+
+    tab_fn = tmpdir.join('db.x.q.tab').strpath
+    write_last_tab(alignments(['db0', 'db4'], s_name='tr2_1'), tab_fn)
+    assert last_query_number(tab_fn, 'db') == 4
+
+
+def test_progress_status():
+    progress = Progress('step', total_bytes=1000)
+    progress.start_time -= 10
+    progress.update(5, 250)
+
+    status = progress.status()
+    assert status['fraction'] == 0.25
+    assert round(status['eta_s']) == 30
+    assert round(status['bytes_per_s']) == 25
+    line = format_status(status)
+    assert line.startswith('[progress] step: 5 records')
+    assert '25%' in line and 'ETA 0:00:30' in line
+
+    progress.finish()
+    assert progress.status()['eta_s'] is None
+    assert 'done in' in format_status(progress.status())
+
+
+def test_alignment_watcher(tmpdir):
+    query_fn = tmpdir.join('q.fa')
+    query_fn.write(''.join('>tr{0}\nACGT\n'.format(i) for i in range(10)))
+    maf_fn = tmpdir.join('q.x.db.maf').strpath
+    watcher = AlignmentWatcher('lastal', query_fn.strpath, maf_fn)
+
+    watcher.poll()
+    assert watcher.total == 10 and watcher.done == 0
+
+    write_maf(alignments(['tr0_1', 'tr4_2']), maf_fn)
+    watcher.poll()
+    assert watcher.done == 5
+    assert watcher.fraction() == 0.5
+    assert watcher.bytes_done > 0
+
+
+def test_reporter_status_file(tmpdir):
+    status_fn = tmpdir.join('status.json').strpath
+    stream = io.StringIO()
+    progress_reporter = ProgressReporter()
+    progress_reporter.start(interval=0.01, status_fn=status_fn, stream=stream)
+    progress = Progress('step', total=4)
+    progress_reporter.add(progress)
+    progress.update(1)
+    progress_reporter.report()
+
+    with open(status_fn) as fp:
+        running = json.load(fp)['running']
+    assert [status['done'] for status in running] == [1]
+
+    progress_reporter.remove(progress)
+    progress_reporter.stop()
+    with open(status_fn) as fp:
+        status = json.load(fp)
+    assert status['running'] == []
+    assert status['finished'][0]['name'] == 'step'
+    assert 'step: 1/4 records' in stream.getvalue()
+
+
+def test_track_records(tmpdir):
+    fasta_fn = tmpdir.join('q.fa')
+    fasta_fn.write('>a\nACGT\n>b\nAC\n')
+    status_fn = tmpdir.join('status.json').strpath
+
+    with StartProgress(status_fn=status_fn, stream=None):
+        records = list(track_records([('a', 'ACGT'), ('b', 'AC')], 'rename',
+                                     filename=fasta_fn.strpath))
+        maf_fn = tmpdir.join('q.x.db.maf').strpath
+        write_maf(alignments(['tr0_1', 'tr1_1', 'tr1_2', 'tr3_0']), maf_fn)
+        chunks = list(iter_hits_frames(maf_fn, query_hits_frame, chunksize=2))
+    assert len(records) == 2 and len(chunks) == 2
+
+    with open(status_fn) as fp:
+        finished = {status['name']: status for status in
+                    json.load(fp)['finished']}
+    assert finished['rename']['done'] == 2
+    assert finished['rename']['bytes_done'] == finished['rename']['total_bytes']
+    parsed = finished['parse:' + maf_fn]
+    assert parsed['done'] == 4
+    assert parsed['total'] == 4
+
+
+def test_console_reporter_watches_tasks(tmpdir):
+    status_fn = tmpdir.join('status.json').strpath
+    with tmpdir.as_cwd():
+        with open('q.fa', 'w') as fp:
+            fp.write('>tr0\nACGT\n>tr1\nACGT\n')
+
+        @doit_task
+        def lastal_task():
+            return {'name': 'lastal:out.maf',
+                    'actions': ['printf "s db0 0 4 + 4 ACGT\\n'
+                                's tr1 0 4 + 4 ACGT\\n" > out.maf'],
+                    'targets': ['out.maf'],
+                    'meta': {'progress': {'query_fn': 'q.fa',
+                                          'output_fn': 'out.maf'}}}
+
+        with StartProgress(status_fn=status_fn, stream=None):
+            assert run_tasks([lastal_task()], ['run'],
+                             config={'verbosity': 0,
+                                     'reporter': ProgressConsoleReporter}) == 0
+
+    assert not reporter.running
+    with open(status_fn) as fp:
+        lastal, = json.load(fp)['finished']
+    assert lastal['name'] == 'lastal:out.maf'
+    assert lastal['done'] == lastal['total'] == 2
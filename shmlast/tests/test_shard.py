@@ -0,0 +1,99 @@
+import pytest
+import screed
+
+from doit.exceptions import TaskFailed
+
+from shmlast.shard import (Submitter, LocalSubmitter, CommandTemplateSubmitter,
+                           shard_fns, split_fasta, merge_alignments,
+                           split_fasta_task, sharded_lastal_tasks)
+from shmlast.tests.utils import datadir, run_tasks, touch
+
+
+class CopySubmitter(Submitter):
+    '''Stands in for lastal by copying each shard to its output.'''
+
+    def command(self, cmd, name, n_threads):
+        tokens = cmd.split()
+        return 'cp {0} {1}'.format(tokens[4], tokens[-1])
+
+
+def test_split_fasta(tmpdir, datadir):
+    with tmpdir.as_cwd():
+        input_fn = datadir('pom.50.fa')
+        output_fns = shard_fns(input_fn, 4)
+        split_fasta(input_fn, output_fns)
+
+        names = [record.name for record in screed.open(input_fn)]
+        shards = [[record for record in screed.open(fn)] for fn in output_fns]
+
+    assert [record.name for shard in shards for record in shard] == names
+    letters = [sum(len(record.sequence) for record in shard) for shard in shards]
+    assert all(n > 0 for n in letters)
+    assert max(letters) < 2 * min(letters)
+
+
+def test_split_fasta_more_shards_than_records(tmpdir, datadir):
+    with tmpdir.as_cwd():
+        input_fn = datadir('pom.single.fa')
+        output_fns = shard_fns(input_fn, 3)
+        split_fasta(input_fn, output_fns)
+
+        assert sum(len(list(screed.open(fn))) for fn in output_fns) == 1
+
+
+def test_merge_alignments(tmpdir):
+    aln_fns = [tmpdir.join('a.maf'), tmpdir.join('b.maf')]
+    aln_fns[0].write('# lambda=0.3 K=0.1\na score=1\n\n')
+    aln_fns[1].write('# lambda=0.3 K=0.1\na score=2\n\n# Query sequences=1\n')
+    out_fn = tmpdir.join('out.maf')
+    merge_alignments([fn.strpath for fn in aln_fns], out_fn.strpath)
+
+    assert out_fn.read() == '# lambda=0.3 K=0.1\na score=1\n\na score=2\n\n'
+
+
+def test_submitter_run(tmpdir):
+    submitter = LocalSubmitter(max_workers=2)
+    out_fn = tmpdir.join('out.txt')
+
+    assert submitter.run('echo hi > {0}'.format(out_fn.strpath), 'echo') is None
+    assert out_fn.read() == 'hi\n'
+    assert isinstance(submitter.run('exit 3', 'fail'), TaskFailed)
+    submitter.shutdown()
+
+
+def test_local_submitter_threads():
+    assert LocalSubmitter(max_workers=4).job_threads(8, 4) == 2
+    assert LocalSubmitter(max_workers=4).job_threads(8, 2) == 4
+    assert LocalSubmitter(max_workers=1).job_threads(1, 4) == 1
+
+
+def test_command_template_submitter():
+    submitter = CommandTemplateSubmitter('sbatch --wait -J {name} -c {threads} '
+                                         '--wrap {cmd}')
+    assert submitter.command('lastal db q.fa > out', 'shard0', 4) == \
+           "sbatch --wait -J shard0 -c 4 --wrap 'lastal db q.fa > out'"
+    assert submitter.job_threads(8, 4) == 8
+
+    with pytest.raises(ValueError):
+        CommandTemplateSubmitter('sbatch --wait')
+
+
+def test_sharded_lastal_tasks(tmpdir, datadir, monkeypatch):
+    monkeypatch.setattr('shmlast.last.which', lambda program: program)
+    with tmpdir.as_cwd():
+        query_fn = datadir('pom.50.fa')
+        touch('db.prj')
+        tasks = [split_fasta_task(query_fn, 3)]
+        tasks.extend(sharded_lastal_tasks(query_fn, 'db', 'out.maf', 3,
+                                          submitter=CopySubmitter(max_workers=3),
+                                          n_threads=6))
+
+        assert [tsk.name for tsk in tasks] == \
+               ['split_shards:pom.50.fa'] + \
+               ['lastal:out.maf.shard{0}of3'.format(i) for i in range(3)] + \
+               ['merge_shards:out.maf']
+        assert '-j 6' in tasks[1].actions[1].args[0]
+
+        config = {'verbosity': 0, 'num_process': 3, 'par_type': 'thread'}
+        assert run_tasks(tasks, ['run'], config=config) == 0
+        assert open('out.maf').read() == open(query_fn).read()
@@ -0,0 +1,85 @@
+import random
+
+import pandas as pd
+import pytest
+import screed
+
+from shmlast.tests.utils import datadir, run_tasks, check_status
+from shmlast.translate import (translate, translate_numpy, translate_fastx,
+                               longest_orf, rename_task, translate_task,
+                               rename_translate_task)
+
+
+def random_seq(length, alphabet='ACGTN', seed=0):
+    rng = random.Random(seed)
+    return ''.join(rng.choice(alphabet) for _ in range(length))
+
+
+@pytest.mark.parametrize('length', [0, 1, 2, 3, 4, 5, 6, 7, 100, 1001])
+def test_translate_numpy_matches_python(length):
+    seq = random_seq(length, seed=length)
+    assert list(translate_numpy(seq)) == list(translate(seq))
+
+
+def test_translate_fastx_backends(tmpdir, datadir):
+    with tmpdir.as_cwd():
+        input_fa = datadir('pom.50.fa')
+        translate_fastx(input_fa, 'python.pep', backend='python')
+        translate_fastx(input_fa, 'numpy.pep', backend='numpy')
+
+        assert tmpdir.join('python.pep').read() == \
+            tmpdir.join('numpy.pep').read()
+
+
+def test_translate_fastx_bad_backend(tmpdir, datadir):
+    with tmpdir.as_cwd():
+        with pytest.raises(ValueError):
+            translate_fastx(datadir('pom.single.fa'), 'out.pep', backend='nope')
+
+
+@pytest.mark.parametrize('n_threads', [2, 3])
+def test_translate_fastx_multiprocess(tmpdir, datadir, n_threads):
+    with tmpdir.as_cwd():
+        input_fa = datadir('pom.50.fa')
+        translate_fastx(input_fa, 'serial.pep')
+        translate_fastx(input_fa, 'parallel.pep', n_threads=n_threads,
+                        batch_size=7)
+
+        assert tmpdir.join('serial.pep').read() == \
+            tmpdir.join('parallel.pep').read()
+
+
+def test_translate_fastx_min_orf_len(tmpdir, datadir):
+    with tmpdir.as_cwd():
+        input_fa = datadir('pom.50.fa')
+        translate_fastx(input_fa, 'all.pep')
+        translate_fastx(input_fa, 'pruned.pep', min_orf_len=50, n_threads=2,
+                        batch_size=10)
+
+        all_frames = {r.name: r.sequence for r in screed.open('all.pep')}
+        kept = {r.name: r.sequence for r in screed.open('pruned.pep')}
+        report = pd.read_csv('pruned.pep.pruned.csv')
+
+        assert len(kept) + len(report) == len(all_frames)
+        assert all(longest_orf(seq) >= 50 for seq in kept.values())
+        assert all(report['longest_orf'] < 50)
+        for _, row in report.iterrows():
+            name = '{0}_{1}'.format(row['name'], row['frame'])
+            assert name not in kept
+            assert longest_orf(all_frames[name]) == row['longest_orf']
+
+
+def test_rename_translate_task(tmpdir, datadir):
+    with tmpdir.as_cwd():
+        input_fa = datadir('pom.50.fa')
+        tasks = [rename_task(input_fa, 'two.fa', name_map_fn='two.csv'),
+                 translate_task('two.fa', 'two.pep'),
+                 rename_translate_task(input_fa, 'fused.fa', 'fused.pep',
+                                       name_map_fn='fused.csv', n_threads=2)]
+        assert run_tasks(tasks, ['run']) == 0
+
+        for ext in ('fa', 'csv', 'pep'):
+            assert tmpdir.join('two.' + ext).read() == \
+                tmpdir.join('fused.' + ext).read()
+
+        assert check_status(tasks[-1], tasks=tasks).status == 'up-to-date'
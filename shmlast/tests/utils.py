@@ -48,6 +48,60 @@ def check_status(task, tasks=None, dep_file='.doit.db'):
     return status
 
 
+def write_maf(aln_df, filename, q_name_col='q_name', s_name_col='s_name',
+              lambda_=0.3, K=0.1):
+    '''Write a DataFrame of alignments, as parsed by MafParser, back out
+    as a minimal lastal-style MAF file.
+
+    Args:
+        aln_df (DataFrame): The alignments.
+        filename (str): Destination MAF file.
+        q_name_col (str): Column with the query names.
+        s_name_col (str): Column with the subject names.
+    '''
+
+    with open(filename, 'w') as fp:
+        fp.write('# LAST version 1021\n#\n')
+        fp.write('# lambda={0} K={1}\n#\n'.format(lambda_, K))
+        for _, row in aln_df.iterrows():
+            fp.write('a score={0} EG2={1} E={2}\n'.format(row['score'],
+                                                         row['EG2'],
+                                                         row['E']))
+            for name, prefix in ((row[s_name_col], 's'), (row[q_name_col], 'q')):
+                fp.write('s {0} {1} {2} {3} {4} {5}\n'.format(name,
+                                                             row[prefix + '_start'],
+                                                             row[prefix + '_aln_len'],
+                                                             row[prefix + '_strand'],
+                                                             row[prefix + '_len'],
+                                                             'A' * row[prefix + '_aln_len']))
+            fp.write('\n')
+
+
+def write_last_tab(aln_df, filename, q_name_col='q_name', s_name_col='s_name',
+                   lambda_=0.3, K=0.1):
+    '''Write a DataFrame of alignments as lastal tabular (-f TAB) output.
+
+    Args:
+        aln_df (DataFrame): The alignments.
+        filename (str): Destination file.
+        q_name_col (str): Column with the query names.
+        s_name_col (str): Column with the subject names.
+    '''
+
+    with open(filename, 'w') as fp:
+        fp.write('# LAST version 1021\n#\n')
+        fp.write('# lambda={0} K={1}\n#\n'.format(lambda_, K))
+        fp.write('# score name1 start1 alnSize1 strand1 seqSize1 '
+                 'name2 start2 alnSize2 strand2 seqSize2 blocks\n')
+        for _, row in aln_df.iterrows():
+            fields = [int(row['score']), row[s_name_col], row['s_start'],
+                      row['s_aln_len'], row['s_strand'], row['s_len'],
+                      row[q_name_col], row['q_start'], row['q_aln_len'],
+                      row['q_strand'], row['q_len'], row['q_aln_len'],
+                      'EG2={0}'.format(row['EG2']), 'E={0}'.format(row['E'])]
+            fp.write('\t'.join(str(f) for f in fields) + '\n')
+
+
 def run_tasks(tasks, args, config={'verbosity': 0}):
     
     if type(tasks) is not list:
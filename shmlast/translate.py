@@ -1,8 +1,15 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from functools import lru_cache, partial
+from itertools import islice
+
 from doit.task import clean_targets
-import pandas as pd
-import screed
+from doit.tools import config_changed
 
-from .profile import profile_task
+from .names import name_map_writer
+from .profile import profile_task, span
+from .progress import track_records
 from .util import create_doit_task as doit_task
 from .util import ShortenedPythonAction, title, which
 
@@ -79,19 +86,309 @@ def translate(seq):
         yield "".join(pep)
 
 
-def translate_fastx(input_fn, output_fn):
+@lru_cache(maxsize=None)
+def codon_tables():
+    '''Lookup tables for the vectorized translator: bases are coded 0-3 for
+    ACGT and 4 for anything else, so that a codon indexes into a 5x5x5 table
+    where every codon containing a non-ACGT base translates to X. Built on
+    first use, so that importing this module doesn't pull in numpy.
+
+    Returns:
+        tuple: The base code and codon lookup arrays.
+    '''
+
+    import numpy as np
+
+    base_codes = np.full(256, 4, dtype=np.intp)
+    for code, base in enumerate(b'ACGT'):
+        base_codes[base] = code
+
+    codon_table = np.full(125, ord('X'), dtype=np.uint8)
+    for codon, aa in dna_to_aa.items():
+        a, b, c = (base_codes[ord(n)] for n in codon)
+        codon_table[25 * a + 5 * b + c] = ord(aa)
+
+    return base_codes, codon_table
+
+
+_complement_table = bytes.maketrans(b'ACGTN', b'TGCAN')
+
+
+def encode_codons(seq):
+    '''Encode the codon starting at each position of the sequence as an
+    index into the codon lookup table.
+
+    Args:
+        seq (bytes): The nucleotide sequence.
+    Returns:
+        numpy.ndarray: Codon indices, of length len(seq) - 2.
+    '''
+
+    import numpy as np
+
+    base_codes, _ = codon_tables()
+    codes = base_codes[np.frombuffer(seq, dtype=np.uint8)]
+    return 25 * codes[:-2] + 5 * codes[1:-1] + codes[2:]
+
+
+def translate_frame(codons, seq_len, start):
+    '''Translate one frame from an array of encoded codons.
+
+    A trailing partial codon translates to X, same as in peptides().
+
+    Args:
+        codons (numpy.ndarray): Codon indices from encode_codons().
+        seq_len (int): Length of the nucleotide sequence.
+        start (int): Translation start position.
+    Returns:
+        str: The translated frame.
+    '''
+
+    if start >= seq_len:
+        return ''
+    _, codon_table = codon_tables()
+    pep = codon_table[codons[start::3]].tobytes().decode('ascii')
+    if (seq_len - start) % 3:
+        pep += 'X'
+    return pep
+
+
+def translate_numpy(seq):
+    '''6-frame translation of the given nucleotide sequence using numpy
+    lookup tables. Produces the same frames, in the same order, as
+    translate().
+
+    Args:
+        seq (str): The nucleotide sequence.
+    Yields:
+        str: The translation in each frame.
+    '''
+
+    fwd = seq.encode('ascii')
+    revcomp = fwd.translate(_complement_table)[::-1]
+    for strand in (fwd, revcomp):
+        codons = encode_codons(strand)
+        for i in range(3):
+            yield translate_frame(codons, len(strand), i)
+
+
+TRANSLATORS = {'python': translate,
+               'numpy': translate_numpy}
+
+
+def get_translator(backend):
+    '''Get the 6-frame translation function for the given backend.
+
+    Args:
+        backend (str): One of the keys of TRANSLATORS.
+    Returns:
+        function: The translation function.
+    '''
+
+    try:
+        return TRANSLATORS[backend]
+    except KeyError:
+        raise ValueError('Unknown translation backend: {0} (choose from {1})'.format(
+                         backend, ', '.join(sorted(TRANSLATORS))))
+
+
+def iter_batches(records, batch_size):
+    '''Group an iterable of records into lists of at most batch_size.
+
+    Args:
+        records (iterable): The records to group.
+        batch_size (int): Maximum records per batch.
+    Yields:
+        list: A batch of records.
+    '''
+
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def longest_orf(pep):
+    '''Length of the longest stretch of a translated frame without a stop
+    (or otherwise untranslatable) codon.
+
+    Args:
+        pep (str): The translated frame.
+    Returns:
+        int: The length of the longest stop-free stretch.
+    '''
+
+    return max(len(orf) for orf in pep.split('X'))
+
+
+def translate_batch(batch, backend='numpy', min_orf_len=None):
+    '''Translate a batch of records into a block of FASTA text.
+
+    Args:
+        batch (list): (name, sequence) tuples.
+        backend (str): Translation backend, one of TRANSLATORS.
+        min_orf_len (int): If given, drop frames whose longest stop-free
+            stretch is shorter than this many amino acids.
+    Returns:
+        tuple: The kept frames of each record in FASTA format, and a list
+            of (name, frame, frame_len, longest_orf) for the dropped frames.
+    '''
+
+    translator = get_translator(backend)
+    lines = []
+    pruned = []
+    for name, sequence in batch:
+        for frame, t in enumerate(translator(sequence)):
+            if min_orf_len is not None:
+                orf_len = longest_orf(t)
+                if orf_len < min_orf_len:
+                    pruned.append((name, frame, len(t), orf_len))
+                    continue
+            lines.append('>{0}_{1}\n{2}\n'.format(name, frame, t))
+    return ''.join(lines), pruned
+
+
+def translate_batches(batches, backend='numpy', n_workers=1, min_orf_len=None):
+    '''Translate batches of records, optionally over a process pool.
+
+    Results are yielded in the same order as the input batches. At most
+    2 * n_workers batches are in flight at a time, so the input is
+    streamed rather than read into memory up front.
+
+    Args:
+        batches (iterable): Lists of (name, sequence) tuples.
+        backend (str): Translation backend, one of TRANSLATORS.
+        n_workers (int): Number of worker processes.
+        min_orf_len (int): Passed to translate_batch.
+    Yields:
+        tuple: The results of translate_batch for each batch.
+    '''
+
+    worker = partial(translate_batch, backend=backend, min_orf_len=min_orf_len)
+    if n_workers <= 1:
+        for batch in batches:
+            yield worker(batch)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        pending = deque()
+        for batch in batches:
+            pending.append(pool.submit(worker, batch))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def pruned_frames_fn(translated_fn):
+    '''Filename of the report of frames dropped while translating.
+    '''
+
+    return translated_fn + '.pruned.csv'
+
+
+@span('translate')
+def write_translated(records, output_fn, backend='numpy', n_threads=1,
+                     batch_size=1000, min_orf_len=None, pruned_fn=None):
+    '''Translate (name, sequence) records and write the frames to a FASTA
+    file.
+
+    Args:
+        records (iterable): (name, sequence) tuples.
+        output_fn (str): Filename to store the results.
+        backend (str): Translation backend, one of TRANSLATORS.
+        n_threads (int): Number of worker processes.
+        batch_size (int): Records sent to a worker at a time.
+        min_orf_len (int): If given, drop frames whose longest stop-free
+            stretch is shorter than this many amino acids.
+        pruned_fn (str): Where to report the dropped frames, as CSV. By
+            default, output_fn + '.pruned.csv' when pruning.
+    '''
+
+    get_translator(backend)
+    if min_orf_len is not None and pruned_fn is None:
+        pruned_fn = pruned_frames_fn(output_fn)
+
+    batches = translate_batches(iter_batches(records, batch_size),
+                                backend=backend,
+                                n_workers=n_threads,
+                                min_orf_len=min_orf_len)
+    with open(output_fn, 'w') as fp:
+        if pruned_fn is None:
+            for block, _ in batches:
+                fp.write(block)
+        else:
+            with open(pruned_fn, 'w') as pruned_fp:
+                writer = csv.writer(pruned_fp, delimiter=',')
+                writer.writerow(['name', 'frame', 'frame_len', 'longest_orf'])
+                for block, pruned in batches:
+                    fp.write(block)
+                    writer.writerows(pruned)
+
+
+def translate_fastx(input_fn, output_fn, **translate_kwds):
     '''Translate a nucleotide FASTA file.
 
     Args:
         input_fn (str): The FASTA file to translate.
         output_fn (str): Filename to store the results.
+        translate_kwds: Passed to write_translated.
     '''
 
-    with open(output_fn, 'w') as fp:
-        for record in screed.open(input_fn):
-            for frame, t in enumerate(translate(record.sequence)):
-                name = '{0}_{1}'.format(record.name, frame)
-                fp.write('>{0}\n{1}\n'.format(name, t))
+    import screed
+
+    records = ((record.name, record.sequence) for record in
+               track_records(screed.open(input_fn), 'translate:' + input_fn,
+                             filename=input_fn))
+    write_translated(records, output_fn, **translate_kwds)
+
+
+def rename_records(records, output_fp, name_map, prefix='tr'):
+    '''Rename FASTA records, writing the renamed records as they pass.
+
+    Args:
+        records (iterable): screed records.
+        output_fp (file): Destination for the renamed FASTA.
+        name_map (list or NameMapWriter): Receives an (old_name, new_name)
+            tuple per record.
+        prefix (str): Prefix to use for each new name.
+    Yields:
+        tuple: The new name and sequence of each record.
+    '''
+
+    for n, record in enumerate(records):
+        new_name = '{0}{1}'.format(prefix, n)
+        output_fp.write('>{0}\n{1}\n'.format(new_name, record.sequence))
+        name_map.append((record.name, new_name))
+        yield new_name, record.sequence
+
+
+def rename_and_translate(input_fn, renamed_fn, translated_fn, name_map_fn,
+                         prefix='tr', **translate_kwds):
+    '''Rename and translate a nucleotide FASTA in a single pass over the
+    input.
+
+    Args:
+        input_fn (str): The FASTA to rename and translate.
+        renamed_fn (str): The filename of the renamed version.
+        translated_fn (str): The filename of the translated version.
+        name_map_fn (str): Where to store the mapping of old to new names;
+            CSV if it ends in .csv, the binary format from names.py otherwise.
+        prefix (str): Prefix to use for each transcript.
+        translate_kwds: Passed to write_translated.
+    '''
+
+    import screed
+
+    with open(renamed_fn, 'w') as renamed_fp, \
+         name_map_writer(name_map_fn) as name_map:
+        records = track_records(screed.open(input_fn),
+                                'rename_translate:' + input_fn,
+                                filename=input_fn)
+        records = rename_records(records, renamed_fp, name_map, prefix=prefix)
+        write_translated(records, translated_fn, **translate_kwds)
 
 
 @doit_task
@@ -102,24 +399,23 @@ def rename_task(input_fn, output_fn, name_map_fn='name_map.csv', prefix='tr'):
     Args:
         input_fn (str): The FASTA to rename.
         output_fn (str): The filename of the renamed version.
-        name_map_fn (str): Where to store the mapping of old to new names.
+        name_map_fn (str): Where to store the mapping of old to new names;
+            CSV if it ends in .csv, the binary format from names.py otherwise.
         prefix (str): Prefix to use for each transcript.
     Returns:
         dict: A doit task dictionary.
     '''
     
     def rename_input():
-        name_map = []
-        with open(output_fn, 'w') as output_fp:
-            for n, record in enumerate(screed.open(input_fn)):
-                new_name = '{0}{1}'.format(prefix, n)
-                output_fp.write('>{0}\n{1}\n'.format(new_name,
-                                                     record.sequence))
-                name_map.append((record.name, new_name))
-
-        pd.DataFrame(name_map,
-                     columns=['old_name', 'new_name']).to_csv(name_map_fn,
-                                                              index=False)
+        import screed
+
+        with open(output_fn, 'w') as output_fp, \
+             name_map_writer(name_map_fn) as name_map:
+            records = track_records(screed.open(input_fn),
+                                    'rename:' + input_fn, filename=input_fn)
+            for _ in rename_records(records, output_fp, name_map,
+                                    prefix=prefix):
+                pass
 
     return {'name': 'rename:{0}'.format(input_fn),
             'title': title,
@@ -131,20 +427,80 @@ def rename_task(input_fn, output_fn, name_map_fn='name_map.csv', prefix='tr'):
 
 @doit_task
 @profile_task
-def translate_task(input_fn, output_fn): 
+def translate_task(input_fn, output_fn, backend='numpy', n_threads=1,
+                   min_orf_len=None):
     '''Translate a nucleotide FASTA in six frames.
 
+    If min_orf_len is given, frames whose longest stop-free stretch is
+    shorter are dropped, and reported in output_fn + '.pruned.csv'.
+
     Args:
         input_fn (str): The nucleotide FASTA.
         output_fn (str): Destination translated FASTA.
+        backend (str): Translation backend, one of TRANSLATORS.
+        n_threads (int): Number of worker processes.
+        min_orf_len (int): Minimum longest-ORF length, in amino acids.
     Returns:
         dict: A doit task dictionary.
     '''
 
+    get_translator(backend)
+    targets = [output_fn]
+    if min_orf_len is not None:
+        targets.append(pruned_frames_fn(output_fn))
+
     return {'name': 'translate:{0}'.format(input_fn),
             'title': title,
-            'actions': [ShortenedPythonAction(translate_fastx, args=[input_fn, output_fn])],
-            'targets': [output_fn],
+            'actions': [ShortenedPythonAction(translate_fastx,
+                                              args=[input_fn, output_fn],
+                                              kwargs={'backend': backend,
+                                                      'n_threads': n_threads,
+                                                      'min_orf_len': min_orf_len})],
+            'targets': targets,
             'file_dep': [input_fn],
+            'uptodate': [config_changed({'min_orf_len': min_orf_len})],
             'clean': [clean_targets]}
 
+
+
+@doit_task
+@profile_task
+def rename_translate_task(input_fn, renamed_fn, translated_fn,
+                          name_map_fn='name_map.csv', prefix='tr',
+                          backend='numpy', n_threads=1, min_orf_len=None):
+    '''Rename a nucleotide FASTA and translate it in six frames, reading
+    the input once. Produces the same targets as rename_task followed by
+    translate_task.
+
+    Args:
+        input_fn (str): The nucleotide FASTA.
+        renamed_fn (str): The filename of the renamed version.
+        translated_fn (str): Destination translated FASTA.
+        name_map_fn (str): Where to store the mapping of old to new names;
+            CSV if it ends in .csv, the binary format from names.py otherwise.
+        prefix (str): Prefix to use for each transcript.
+        backend (str): Translation backend, one of TRANSLATORS.
+        n_threads (int): Number of worker processes.
+        min_orf_len (int): Minimum longest-ORF length, in amino acids.
+    Returns:
+        dict: A doit task dictionary.
+    '''
+
+    get_translator(backend)
+    targets = [renamed_fn, name_map_fn, translated_fn]
+    if min_orf_len is not None:
+        targets.append(pruned_frames_fn(translated_fn))
+
+    return {'name': 'rename_translate:{0}'.format(input_fn),
+            'title': title,
+            'actions': [ShortenedPythonAction(rename_and_translate,
+                                              args=[input_fn, renamed_fn,
+                                                    translated_fn, name_map_fn],
+                                              kwargs={'prefix': prefix,
+                                                      'backend': backend,
+                                                      'n_threads': n_threads,
+                                                      'min_orf_len': min_orf_len})],
+            'targets': targets,
+            'file_dep': [input_fn],
+            'uptodate': [config_changed({'min_orf_len': min_orf_len})],
+            'clean': [clean_targets]}